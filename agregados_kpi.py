@@ -0,0 +1,152 @@
+import operator
+from typing import Any, Dict, Iterable, List, Optional
+
+import pandas as pd
+
+# --- Tablas KPI pre-agregadas (se guardan junto a las tablas de hechos) ---
+# Cada entrada define:
+#   'origen':   tabla de hechos de la que sale.
+#   'fecha':    columna de fecha; se agrupa por mes en la columna 'Mes' (primer día del mes).
+#   'por':      columnas de agrupación además de 'Mes'.
+#   'medidas':  {columna_resultado: (columna_origen, función)} con funciones de pandas.
+#   'tasas':    {columna_resultado: (numerador, denominador)} sobre las medidas.
+#   'unir_pacientes': columnas de hechos_pacientes que se agregan por ID_Paciente.
+#   'solo':     [(columna, valores)] filas que se conservan.
+#   'excluir':  [(columna, operador, valor)] filas que se descartan (los nulos se conservan).
+#   'sin_pacientes_prueba': descarta los pacientes de prueba, como pide el prompt de Sherlock
+#                           (si falta hechos_pacientes, la tabla se genera sin ese filtro y se avisa).
+# hechos_citas ya llega sin citas duplicadas (PASO 3), así que no hace falta excluirlas aquí.
+AGREGADOS_KPI: Dict[str, Dict[str, Any]] = {
+    'kpi_citas_mes_sucursal_etiqueta': {
+        'origen': 'hechos_citas', 'fecha': 'Fecha_Cita',
+        'por': ['Sucursal', 'Etiqueta_Cita_Paciente'],
+        'medidas': {'Numero_Citas': ('ID_Cita', 'count'), 'Citas_Asistidas': ('Cita_asistida', 'sum'),
+                    'Pacientes_Unicos': ('ID_Paciente', 'nunique')},
+        'tasas': {'Tasa_Asistencia': ('Citas_Asistidas', 'Numero_Citas')},
+        'sin_pacientes_prueba': True,
+    },
+    'kpi_pacientes_atendidos_mes_sucursal': {
+        'origen': 'hechos_citas', 'fecha': 'Fecha_Cita',
+        'por': ['Sucursal'],
+        'medidas': {'Pacientes_Atendidos': ('ID_Paciente', 'nunique'), 'Citas_Asistidas': ('ID_Cita', 'count')},
+        'solo': [('Cita_asistida', [1])],
+        'sin_pacientes_prueba': True,
+    },
+    'kpi_pacientes_nuevos_mes_origen': {
+        'origen': 'hechos_citas', 'fecha': 'Fecha_Cita',
+        'por': ['Sucursal', 'Paciente_Origen'],
+        'medidas': {'Pacientes_Nuevos_Atendidos': ('ID_Paciente', 'nunique')},
+        'unir_pacientes': ['Paciente_Origen'],
+        'solo': [('Etiqueta_Cita_Paciente', ['Paciente Nuevo Atendido'])],
+        'sin_pacientes_prueba': True,
+    },
+    'kpi_pagos_mes_sucursal_medio': {
+        'origen': 'hechos_pagos_transacciones', 'fecha': 'Pago_fecha_recepcion',
+        'por': ['Sucursal', 'Medio_de_pago'],
+        'medidas': {'Total_Pagado': ('Total_Pago_Transaccion', 'sum'),
+                    'Abono_Libre': ('Monto_Abono_Libre_Original_En_Tx', 'sum'),
+                    'Numero_Pagos': ('ID_Pago', 'nunique'), 'Pacientes_Unicos': ('ID_Paciente', 'nunique')},
+        'sin_pacientes_prueba': True,
+    },
+    'kpi_gastos_mes_sucursal_subcategoria': {
+        'origen': 'hechos_gastos', 'fecha': 'Fecha_del_Gasto',
+        'por': ['Sucursal', 'Subcategoria_gasto', 'Gasto_medio_de_pago'],
+        'medidas': {'Total_Gasto': ('Monto_Gasto', 'sum'), 'Numero_Gastos': ('Monto_Gasto', 'count')},
+    },
+}
+
+COLUMNA_MES = 'Mes'
+# Un paciente es de prueba si su nombre o apellidos contienen este texto.
+TEXTO_PACIENTE_PRUEBA = 'prueba'
+_OPERADORES = {'==': operator.eq, '!=': operator.ne, '>': operator.gt,
+               '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+
+def ids_pacientes_prueba(df_pacientes: pd.DataFrame) -> pd.Index:
+    mascara = pd.Series(False, index=df_pacientes.index)
+    for col in ('Paciente_Nombre', 'Paciente_Apellidos'):
+        if col in df_pacientes.columns:
+            mascara |= df_pacientes[col].astype(str).str.contains(
+                TEXTO_PACIENTE_PRUEBA, case=False, regex=False, na=False)
+    return pd.Index(df_pacientes.loc[mascara, 'ID_Paciente'].dropna().unique())
+
+
+def mes_de(fechas: pd.Series) -> pd.Series:
+    """Primer día del mes de cada fecha (la columna 'Mes' de las tablas KPI)."""
+    return pd.to_datetime(fechas, errors='coerce').dt.to_period('M').dt.to_timestamp()
+
+
+def _filtrar(df: pd.DataFrame, definicion: Dict[str, Any], pacientes_prueba: pd.Index) -> pd.DataFrame:
+    mascara = pd.Series(True, index=df.index)
+    for col, valores in definicion.get('solo', []):
+        mascara &= df[col].isin(valores)
+    for col, simbolo, valor in definicion.get('excluir', []):
+        if col in df.columns:
+            mascara &= ~_OPERADORES[simbolo](pd.to_numeric(df[col], errors='coerce'), valor).fillna(False)
+    if definicion.get('sin_pacientes_prueba') and len(pacientes_prueba) and 'ID_Paciente' in df.columns:
+        mascara &= ~df['ID_Paciente'].isin(pacientes_prueba)
+    return df.loc[mascara]
+
+
+def calcular_agregado(nombre: str, definicion: Dict[str, Any],
+                      tablas: Dict[str, pd.DataFrame], pacientes_prueba: pd.Index) -> pd.DataFrame:
+    """Calcula una tabla KPI según su definición en AGREGADOS_KPI."""
+    df = tablas[definicion['origen']]
+    unir = definicion.get('unir_pacientes', [])
+    columnas = {definicion['fecha'], 'ID_Paciente', *definicion['por'],
+                *(col for col, _ in definicion['medidas'].values()),
+                *(col for col, _ in definicion.get('solo', [])),
+                *(col for col, _, _ in definicion.get('excluir', []))}
+    df = df[[c for c in df.columns if c in columnas and c not in unir]]
+    df = _filtrar(df, definicion, pacientes_prueba)
+    if unir:
+        pacientes = tablas['hechos_pacientes'][['ID_Paciente', *unir]].drop_duplicates('ID_Paciente')
+        df = df.merge(pacientes, on='ID_Paciente', how='left')
+
+    por = definicion['por']
+    faltantes = [c for c in [definicion['fecha'], *por] if c not in df.columns]
+    if faltantes:
+        raise KeyError(f"Faltan columnas {faltantes} en '{definicion['origen']}' para '{nombre}'.")
+    df = df.assign(**{COLUMNA_MES: mes_de(df[definicion['fecha']])})
+    resultado = df.groupby([COLUMNA_MES, *por], dropna=False, observed=True).agg(
+        **{salida: (col, funcion) for salida, (col, funcion) in definicion['medidas'].items()}).reset_index()
+    for salida, (numerador, denominador) in definicion.get('tasas', {}).items():
+        resultado[salida] = (resultado[numerador] / resultado[denominador].where(resultado[denominador] != 0)).round(4)
+    return resultado.sort_values([COLUMNA_MES, *por], na_position='last', ignore_index=True)
+
+
+def tablas_de_origen(definicion: Dict[str, Any]) -> List[str]:
+    """Tablas sin las que no se puede calcular una definición."""
+    return [definicion['origen']] + (['hechos_pacientes'] if definicion.get('unir_pacientes') else [])
+
+
+def tablas_opcionales(definicion: Dict[str, Any]) -> List[str]:
+    """Tablas que una definición usa si están (hechos_pacientes para filtrar pacientes de prueba)."""
+    usa_pacientes = definicion.get('sin_pacientes_prueba') and not definicion.get('unir_pacientes')
+    return ['hechos_pacientes'] if usa_pacientes else []
+
+
+def generar_agregados_kpi(tablas: Dict[str, pd.DataFrame], advertencias: List[str],
+                          nombres: Optional[Iterable[str]] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Devuelve las tablas de AGREGADOS_KPI (o solo las de `nombres`) que se pueden calcular con `tablas`.
+    Si falta una tabla de origen o una columna, esa tabla KPI se omite con una advertencia.
+    """
+    pacientes_prueba = pd.Index([])
+    if tablas.get('hechos_pacientes') is not None:
+        pacientes_prueba = ids_pacientes_prueba(tablas['hechos_pacientes'])
+    agregados = {}
+    for nombre in (AGREGADOS_KPI if nombres is None else nombres):
+        definicion = AGREGADOS_KPI[nombre]
+        requeridas = tablas_de_origen(definicion)
+        if any(tablas.get(t) is None for t in requeridas):
+            advertencias.append(f"ADVERTENCIA (KPI): No se generó '{nombre}': falta la tabla {requeridas}.")
+            continue
+        if definicion.get('sin_pacientes_prueba') and tablas.get('hechos_pacientes') is None:
+            advertencias.append(
+                f"ADVERTENCIA (KPI): '{nombre}' se generó sin excluir pacientes de prueba: falta 'hechos_pacientes'.")
+        try:
+            agregados[nombre] = calcular_agregado(nombre, definicion, tablas, pacientes_prueba)
+        except KeyError as e_columna:
+            advertencias.append(f"ADVERTENCIA (KPI): No se generó '{nombre}': {e_columna}")
+    return agregados
@@ -0,0 +1 @@
+"""Benchmarks de rendimiento de Sherlock (se ejecutan con `python -m benchmarks.<modulo>`)."""
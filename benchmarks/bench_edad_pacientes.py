@@ -0,0 +1,92 @@
+"""
+Micro-benchmark del cálculo de Edad y Rango_de_Edad (PASO 2 de
+generar_insights_pacientes) sobre una tabla sintética de pacientes.
+
+Compara la implementación anterior fila por fila (`.apply`) contra la
+vectorizada y verifica que ambas den exactamente el mismo resultado.
+
+Uso: python -m benchmarks.bench_edad_pacientes [--filas 1000000]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import procesador_datos
+
+
+def generar_fechas_nacimiento(filas: int, semilla: int = 0) -> pd.Series:
+    """Fechas de nacimiento entre hace 130 años y dentro de 2 años, con ~2% nulas."""
+    rng = np.random.default_rng(semilla)
+    hoy = pd.Timestamp('today').normalize()
+    dias = rng.integers(-2 * 365, 130 * 365, filas)
+    fechas = pd.Series(hoy - pd.to_timedelta(dias, unit='D'))
+    return fechas.mask(rng.random(filas) < 0.02)
+
+
+# --- Implementación anterior, copiada tal cual como referencia ---
+def _calcular_edad_por_fila(fecha_nac):
+    if pd.isnull(fecha_nac):
+        return pd.NA
+    try:
+        edad_dias = (pd.to_datetime('today').normalize(
+        ) - pd.Timestamp(fecha_nac).normalize()).days
+        edad = int(edad_dias / 365.25)
+        return edad if 0 <= edad <= 120 else pd.NA
+    except (ValueError, TypeError):
+        return pd.NA
+
+
+def _categorize_age_por_fila(edad):
+    if pd.isnull(edad):
+        return 'Desconocido'
+    try:
+        edad = int(edad)
+    except (ValueError, TypeError):
+        return 'Desconocido'
+    if edad < 18:
+        return 'Menor a 18'
+    elif 18 <= edad <= 25:
+        return '18 a 25'
+    elif 26 <= edad <= 35:
+        return '26 a 35'
+    elif 36 <= edad <= 50:
+        return '36 a 50'
+    elif 51 <= edad <= 65:
+        return '51 a 65'
+    else:
+        return 'Mayor de 65'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--filas', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    fechas = generar_fechas_nacimiento(args.filas)
+    print(f"Pacientes sintéticos: {args.filas:,}")
+
+    inicio = time.perf_counter()
+    edad_antes = pd.to_datetime(fechas, errors='coerce').apply(
+        _calcular_edad_por_fila).astype('Int64')
+    rango_antes = edad_antes.apply(_categorize_age_por_fila)
+    t_antes = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    edad_ahora = procesador_datos.calcular_edades(
+        fechas, pd.Timestamp('today'))
+    rango_ahora = procesador_datos.categorizar_rangos_edad(edad_ahora)
+    t_ahora = time.perf_counter() - inicio
+
+    pd.testing.assert_series_equal(edad_antes, edad_ahora)
+    pd.testing.assert_series_equal(
+        rango_antes, rango_ahora.astype(object), check_names=False)
+
+    print(f"  Fila por fila (.apply): {t_antes:8.3f} s")
+    print(f"  Vectorizado:            {t_ahora:8.3f} s")
+    print(f"  Aceleración:            {t_antes / t_ahora:8.1f}x  (resultados idénticos)")
+
+
+if __name__ == '__main__':
+    main()
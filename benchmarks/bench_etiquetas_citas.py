@@ -0,0 +1,103 @@
+"""
+Micro-benchmark de Etiqueta_Cita_Paciente (PASO 3 de generar_insights_pacientes)
+sobre una tabla sintética de citas.
+
+Compara la implementación anterior (diez asignaciones `.loc` con máscaras y
+`.dt.to_period('M')`) contra `procesador_datos.etiquetar_citas` y verifica
+que ambas den exactamente las mismas etiquetas.
+
+Uso: python -m benchmarks.bench_etiquetas_citas [--filas 2000000]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import procesador_datos
+
+
+def generar_citas(filas: int, hoy: pd.Timestamp, semilla: int = 0) -> pd.DataFrame:
+    """
+    Citas entre hace 3 años y dentro de 6 meses (~3% sin fecha), con fecha de
+    primera cita atendida nula en ~25% de las filas, a veces igual a la fecha
+    de la cita o en el mismo mes, y citas justo en la fecha de referencia.
+    """
+    rng = np.random.default_rng(semilla)
+    fecha = hoy + pd.to_timedelta(rng.integers(-3 * 365, 180, filas), unit='D')
+    fecha = pd.Series(fecha).mask(rng.random(filas) < 0.03)
+    fecha = fecha.mask(rng.random(filas) < 0.01, hoy)
+    primera = fecha - pd.to_timedelta(rng.integers(-60, 400, filas), unit='D')
+    primera = primera.mask(rng.random(filas) < 0.10, fecha)
+    primera = primera.mask(rng.random(filas) < 0.25)
+    return pd.DataFrame({'Fecha_Cita': fecha, 'Fecha_Primera_Cita_Atendida_Real': primera,
+                         'Cita_asistida': rng.integers(0, 2, filas)})
+
+
+# --- Implementación anterior, copiada tal cual como referencia ---
+def _etiquetar_con_loc(hechos_citas_df: pd.DataFrame, today: pd.Timestamp) -> pd.Series:
+    col_asistida, col_fecha_cita = 'Cita_asistida', 'Fecha_Cita'
+    hechos_citas_df = hechos_citas_df.copy()
+    hechos_citas_df['Etiqueta_Cita_Paciente'] = 'Indeterminada'
+    cond_fecha_cita_valida = hechos_citas_df[col_fecha_cita].notna(
+    )
+    cond_primera_atendida_existe = hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'].notna(
+    )
+    cond_asistio = hechos_citas_df[col_asistida] == 1
+    cond_es_nuevo = ~cond_primera_atendida_existe | (
+        hechos_citas_df[col_fecha_cita] <= hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'])
+    hechos_citas_df.loc[cond_es_nuevo & cond_fecha_cita_valida & (
+        hechos_citas_df[col_fecha_cita] >= today), 'Etiqueta_Cita_Paciente'] = "Paciente Nuevo en Agenda"
+    hechos_citas_df.loc[cond_es_nuevo & cond_fecha_cita_valida & (
+        hechos_citas_df[col_fecha_cita] < today) & cond_asistio, 'Etiqueta_Cita_Paciente'] = "Paciente Nuevo Atendido"
+    hechos_citas_df.loc[cond_es_nuevo & cond_fecha_cita_valida & (
+        hechos_citas_df[col_fecha_cita] < today) & ~cond_asistio, 'Etiqueta_Cita_Paciente'] = "Paciente Nuevo No Atendido"
+    cond_es_recurrente = cond_primera_atendida_existe & (
+        hechos_citas_df[col_fecha_cita] > hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'])
+    cond_mismo_mes_debut = cond_es_recurrente & (hechos_citas_df[col_fecha_cita].dt.to_period(
+        'M') == hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'].dt.to_period('M'))
+    cond_mes_posterior_debut = cond_es_recurrente & (hechos_citas_df[col_fecha_cita].dt.to_period(
+        'M') > hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'].dt.to_period('M'))
+    hechos_citas_df.loc[cond_mismo_mes_debut & cond_asistio,
+                        'Etiqueta_Cita_Paciente'] = "Paciente Atendido Mismo Mes que Debutó"
+    hechos_citas_df.loc[cond_mismo_mes_debut & ~cond_asistio,
+                        'Etiqueta_Cita_Paciente'] = "Paciente No Atendido Mismo Mes que Debutó"
+    hechos_citas_df.loc[cond_mes_posterior_debut & (
+        hechos_citas_df[col_fecha_cita] >= today), 'Etiqueta_Cita_Paciente'] = "Paciente Recurrente en Agenda"
+    hechos_citas_df.loc[cond_mes_posterior_debut & (
+        hechos_citas_df[col_fecha_cita] < today) & cond_asistio, 'Etiqueta_Cita_Paciente'] = "Paciente Recurrente Atendido"
+    hechos_citas_df.loc[cond_mes_posterior_debut & (
+        hechos_citas_df[col_fecha_cita] < today) & ~cond_asistio, 'Etiqueta_Cita_Paciente'] = "Paciente Recurrente No Atendido"
+    return hechos_citas_df['Etiqueta_Cita_Paciente']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--filas', type=int, default=2_000_000)
+    args = parser.parse_args()
+
+    hoy = pd.Timestamp('today').normalize()
+    citas = generar_citas(args.filas, hoy)
+    print(f"Citas sintéticas: {args.filas:,}")
+
+    inicio = time.perf_counter()
+    etiquetas_antes = _etiquetar_con_loc(citas, hoy)
+    t_antes = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    etiquetas_ahora = procesador_datos.etiquetar_citas(
+        citas['Fecha_Cita'], citas['Fecha_Primera_Cita_Atendida_Real'], citas['Cita_asistida'], hoy)
+    t_ahora = time.perf_counter() - inicio
+
+    pd.testing.assert_series_equal(
+        etiquetas_antes, pd.Series(etiquetas_ahora, index=citas.index).astype(object),
+        check_names=False)
+
+    print(etiquetas_antes.value_counts().to_string())
+    print(f"  Asignaciones .loc: {t_antes:8.3f} s")
+    print(f"  np.select:         {t_ahora:8.3f} s")
+    print(f"  Aceleración:       {t_antes / t_ahora:8.1f}x  (etiquetas idénticas)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+Benchmark del ETL completo por etapas sobre datos sintéticos
+(benchmarks/datos_sinteticos.py):
+
+  parse      load_dataframes_from_uploads sobre libros .xlsx en disco
+             (sin la caché de hojas, para medir siempre el parseo).
+  transform  generar_insights_pacientes.
+  write      escritor_postgres.escribir_df de cada tabla final, en SQLite
+             (por defecto) o en la base que indique --destino.
+
+Cada escala corre en un proceso aparte y cada etapa se mide con
+`metricas.etapa` (tiempo y pico de RSS, igual que en los trabajos). Por
+encima del límite de filas de Excel no hay parse: la transformación parte de
+las tablas generadas en memoria.
+
+Escribir los libros es lo más lento: con --libros se guardan en
+<directorio>/<filas> y se reutilizan en las siguientes corridas (y entre
+commits, así todos parsean los mismos archivos).
+
+Los resultados se guardan en JSON (con el commit, las versiones y la
+máquina) para comparar entre commits:
+
+Uso: python -m benchmarks.bench_etl [--escalas 10k 100k] [--etapas parse transform write]
+                                    [--destino postgresql+psycopg2://...] [--repeticiones 3]
+                                    [--libros /tmp/sherlock_libros] [--solo-conservadas]
+     python -m benchmarks.bench_etl --comparar antes.json despues.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+ETAPAS = ('parse', 'transform', 'write')
+DIRECTORIO_RESULTADOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resultados")
+RAIZ_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _filas_de_escala(escala: str) -> int:
+    from benchmarks.datos_sinteticos import ESCALAS
+    return ESCALAS[escala.lower()] if escala.lower() in ESCALAS else int(escala.replace('_', ''))
+
+
+def medir(filas: int, etapas: List[str], destino: Optional[str], semilla: int,
+          directorio_libros: Optional[str] = None, solo_conservadas: bool = False) -> Dict[str, Any]:
+    """Corre las etapas pedidas en este proceso y devuelve las etapas de metricas."""
+    # La caché de hojas parseadas haría que el parse no lea los Excel.
+    os.environ["SHERLOCK_CACHE_DIR"] = ""
+    import pandas as pd
+    from sqlalchemy import create_engine
+
+    import escritor_postgres
+    import metricas
+    import procesador_datos
+    import staging_lotes
+    from benchmarks import datos_sinteticos
+
+    procesador_datos.DIRECTORIO_CACHE = ""
+    hoy = pd.Timestamp('today').normalize()
+    reporte = metricas.iniciar_reporte(f"bench-{filas}")
+    advertencias: List[str] = []
+    with tempfile.TemporaryDirectory(prefix="sherlock_bench_") as temporal:
+        if 'parse' in etapas and filas <= datos_sinteticos.LIMITE_FILAS_EXCEL:
+            libros = os.path.join(directorio_libros, str(filas)) if directorio_libros else temporal
+            with metricas.etapa("generar_libros"):
+                datos_sinteticos.preparar_libros(libros, filas, semilla, hoy, solo_conservadas)
+            indice = staging_lotes.ArchivoEnStaging("indice.xlsx", os.path.join(libros, "indice.xlsx"))
+            archivos = [staging_lotes.ArchivoEnStaging(nombre, os.path.join(libros, nombre))
+                        for nombre in sorted(os.listdir(libros)) if nombre.endswith(".xlsx")
+                        and nombre != "indice.xlsx"]
+            with metricas.etapa("parse") as medicion:
+                processed_dfs, _, _, advertencias = procesador_datos.load_dataframes_from_uploads(
+                    data_files=archivos, index_file=indice)
+                medicion["filas"] = sum(len(df) for df in processed_dfs.values())
+        else:
+            with metricas.etapa("generar_tablas"):
+                processed_dfs = datos_sinteticos.generar_processed_dfs(filas, semilla, hoy)
+
+        if 'transform' in etapas or 'write' in etapas:
+            with metricas.etapa("transform") as medicion:
+                resultados = procesador_datos.generar_insights_pacientes(processed_dfs, advertencias)
+                medicion["filas"] = sum(len(df) for df in resultados.values())
+            del processed_dfs
+
+        if 'write' in etapas:
+            url = destino or f"sqlite:///{os.path.join(temporal, 'bench.db')}"
+            engine = create_engine(url)
+            try:
+                with metricas.etapa("write", filas=sum(len(df) for df in resultados.values())):
+                    for nombre_tabla, df in resultados.items():
+                        if df is None or df.empty:
+                            continue
+                        with metricas.etapa(nombre_tabla, filas=len(df), tabla=nombre_tabla):
+                            with engine.begin() as conn:
+                                escritor_postgres.escribir_df(df, nombre_tabla, conn, if_exists='replace')
+            finally:
+                engine.dispose()
+    return {"filas": filas, "advertencias": len(advertencias), "etapas": reporte.etapas}
+
+
+def _correr_escala(filas: int, args: argparse.Namespace) -> Dict[str, Any]:
+    comando = [sys.executable, "-m", "benchmarks.bench_etl", "--medir", str(filas),
+               "--etapas", *args.etapas, "--semilla", str(args.semilla)]
+    if args.destino:
+        comando += ["--destino", args.destino]
+    if args.libros:
+        comando += ["--libros", os.path.abspath(args.libros)]
+    if args.solo_conservadas:
+        comando.append("--solo-conservadas")
+    salida = subprocess.run(comando, cwd=RAIZ_REPO, capture_output=True, text=True)
+    if salida.returncode != 0:
+        raise RuntimeError(f"Falló la escala {filas:,}:\n{salida.stderr[-4000:]}")
+    return json.loads(salida.stdout.strip().splitlines()[-1])
+
+
+def _commit_actual() -> Dict[str, Any]:
+    def git(*argumentos: str) -> str:
+        try:
+            return subprocess.run(["git", *argumentos], cwd=RAIZ_REPO, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ""
+    return {"commit": git("rev-parse", "HEAD"), "rama": git("rev-parse", "--abbrev-ref", "HEAD"),
+            "cambios_sin_commit": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def _entorno() -> Dict[str, Any]:
+    import numpy as np
+    import pandas as pd
+    import sqlalchemy
+    return {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+            "sqlalchemy": sqlalchemy.__version__, "plataforma": platform.platform(),
+            "procesador": platform.processor() or platform.machine(), "cpus": os.cpu_count()}
+
+
+def _resumir(corridas: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Por etapa: el menor tiempo de las repeticiones y el mayor pico de RSS."""
+    resumen: Dict[str, Dict[str, Any]] = {}
+    for corrida in corridas:
+        for etapa in corrida["etapas"]:
+            previo = resumen.get(etapa["etapa"])
+            if previo is None:
+                resumen[etapa["etapa"]] = dict(etapa, tiempos=[etapa["segundos"]])
+                continue
+            previo["tiempos"].append(etapa["segundos"])
+            previo["segundos"] = min(previo["segundos"], etapa["segundos"])
+            if etapa["rss_pico_mb"] is not None:
+                previo["rss_pico_mb"] = max(previo["rss_pico_mb"] or 0, etapa["rss_pico_mb"])
+    return list(resumen.values())
+
+
+def ejecutar(args: argparse.Namespace) -> Dict[str, Any]:
+    from sqlalchemy.engine import make_url
+
+    resultado = {
+        "fecha": datetime.now(timezone.utc).isoformat(timespec="seconds"), **_commit_actual(),
+        "entorno": _entorno(), "semilla": args.semilla, "repeticiones": args.repeticiones,
+        "solo_conservadas": args.solo_conservadas,
+        "destino": make_url(args.destino).get_backend_name() if args.destino else "sqlite",
+        "escalas": []}
+    for escala in args.escalas:
+        filas = _filas_de_escala(escala)
+        corridas = [_correr_escala(filas, args) for _ in range(args.repeticiones)]
+        etapas = _resumir(corridas)
+        resultado["escalas"].append({"escala": escala, "filas": filas,
+                                     "advertencias": corridas[0]["advertencias"], "etapas": etapas})
+        print(f"Escala {escala} ({filas:,} citas):")
+        for etapa in etapas:
+            if "/" not in etapa["etapa"]:
+                print(f"  {etapa['etapa']:16s} {etapa['segundos']:9.2f} s   pico RSS {etapa['rss_pico_mb']:9.1f} MB"
+                      + (f"   {etapa['filas']:,} filas" if etapa["filas"] else ""))
+    return resultado
+
+
+def comparar(ruta_antes: str, ruta_despues: str):
+    """Tiempo y pico de RSS por escala y etapa entre dos resultados."""
+    with open(ruta_antes, encoding="utf-8") as f:
+        antes = json.load(f)
+    with open(ruta_despues, encoding="utf-8") as f:
+        despues = json.load(f)
+    print(f"Antes:   {antes['commit'][:10]} ({antes['fecha']})")
+    print(f"Después: {despues['commit'][:10]} ({despues['fecha']})")
+    previas = {(e["filas"], etapa["etapa"]): etapa for e in antes["escalas"] for etapa in e["etapas"]}
+    for escala in despues["escalas"]:
+        print(f"Escala {escala['escala']} ({escala['filas']:,} citas):")
+        for etapa in escala["etapas"]:
+            previa = previas.get((escala["filas"], etapa["etapa"]))
+            if previa is None or "/" in etapa["etapa"] or etapa["etapa"].startswith("generar_"):
+                continue
+            razon = etapa["segundos"] / previa["segundos"] if previa["segundos"] else float("nan")
+            print(f"  {etapa['etapa']:16s} {previa['segundos']:9.2f} s -> {etapa['segundos']:9.2f} s ({razon:5.2f}x)"
+                  f"   pico RSS {previa['rss_pico_mb']:9.1f} -> {etapa['rss_pico_mb']:9.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--escalas', nargs='+', default=['10k'],
+                        help="Citas por escala: 10k, 100k, 1m, 10m o un número.")
+    parser.add_argument('--etapas', nargs='+', choices=ETAPAS, default=list(ETAPAS))
+    parser.add_argument('--destino', default=None,
+                        help="URL de SQLAlchemy para 'write' (por defecto, SQLite en un temporal).")
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--repeticiones', type=int, default=1)
+    parser.add_argument('--libros', default=None,
+                        help="Directorio donde se guardan y reutilizan los libros generados.")
+    parser.add_argument('--solo-conservadas', action='store_true',
+                        help="Libros sin las columnas DROP (más rápidos de generar y de parsear).")
+    parser.add_argument('--salida', default=None, help="Archivo JSON de resultados.")
+    parser.add_argument('--comparar', nargs=2, metavar=('ANTES', 'DESPUES'))
+    parser.add_argument('--medir', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.comparar:
+        comparar(*args.comparar)
+        return
+    if args.medir is not None:
+        # La salida del ETL va a stderr; la última línea de stdout es el JSON.
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        try:
+            resultado = medir(args.medir, args.etapas, args.destino, args.semilla,
+                              args.libros, args.solo_conservadas)
+        finally:
+            sys.stdout = stdout
+        print(json.dumps(resultado, ensure_ascii=False))
+        return
+
+    resultado = ejecutar(args)
+    salida = args.salida or os.path.join(
+        DIRECTORIO_RESULTADOS,
+        f"{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}-{(resultado['commit'] or 'sin_git')[:10]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(salida)), exist_ok=True)
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=1)
+    print(f"Resultados en '{salida}'.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Benchmark de memoria pico de generar_insights_pacientes sobre tablas sintéticas
+con las mismas columnas que deja load_dataframes_from_uploads.
+
+Mide con `tracemalloc` (numpy y pandas reportan ahí sus buffers) el pico de
+memoria asignada durante la transformación, por encima de lo que ya ocupan
+los DataFrames de entrada, con y sin Copy-on-Write. Cada modo corre en un
+proceso aparte porque la opción de pandas es global.
+
+Uso: python -m benchmarks.bench_memoria_pipeline [--filas 500000]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+MB = 1024 * 1024
+
+
+def generar_processed_dfs(filas: int, semilla: int = 0) -> Dict[str, pd.DataFrame]:
+    """Tablas de hechos con `filas` filas (pacientes: filas/4) y dimensiones pequeñas."""
+    rng = np.random.default_rng(semilla)
+    n_pacientes = max(filas // 4, 1)
+    hoy = pd.Timestamp('today').normalize()
+    sucursales = np.array(['Centro', 'Norte', 'Sur', 'Poniente', 'Oriente'], dtype=object)
+    tipos = np.array(['Facebook', 'Google', 'Referido', 'Otro'], dtype=object)
+    medios = np.array(['Efectivo', 'Tarjeta', 'Transferencia'], dtype=object)
+    procedimientos = np.array([f"P{i:04d}" for i in range(500)], dtype=object)
+
+    def ids(n, maximo):
+        return rng.integers(1, maximo + 1, n)
+
+    def fechas(n, desde_dias=-3 * 365, hasta_dias=180):
+        return hoy + pd.to_timedelta(rng.integers(desde_dias, hasta_dias, n), unit='D')
+
+    def elegir(valores, n):
+        return valores[rng.integers(0, len(valores), n)]
+
+    def horas(n, base):
+        return np.array([f"{h:02d}:{m:02d}:00" for h, m in
+                         zip(rng.integers(base, base + 10, n), rng.integers(0, 4, n) * 15)], dtype=object)
+
+    id_cita = np.arange(1, filas + 1)
+    return {
+        "Tipos de pacientes_df": pd.DataFrame({'Tipo Dentalink': tipos, 'Paciente_Origen': tipos}),
+        "Tabla_Procedimientos_df": pd.DataFrame({'ID_Procedimiento': procedimientos,
+                                                 'Categoria_procedimiento': elegir(tipos, 500)}),
+        "Sucursal_df": pd.DataFrame({'Sucursal': sucursales}),
+        "Medios_de_pago_df": pd.DataFrame({'Medio_de_pago': medios}),
+        "Tratamiento Generado Mex_df": pd.DataFrame({
+            'ID_Tratamiento': np.arange(1, filas // 2 + 2), 'ID_Paciente': ids(filas // 2 + 1, n_pacientes),
+            'Tratamiento_Fecha_Generacion': fechas(filas // 2 + 1)}),
+        "Pacientes_Nuevos_df": pd.DataFrame({
+            'ID_Paciente': np.arange(1, n_pacientes + 1),
+            'Paciente_Nombre': elegir(np.array(['Ana', 'Luis', 'Eva', 'Juan'], dtype=object), n_pacientes),
+            'Fecha de nacimiento': fechas(n_pacientes, -90 * 365, 0),
+            'Sexo': elegir(np.array(['F', 'M'], dtype=object), n_pacientes),
+            'Tipo Dentalink': elegir(tipos, n_pacientes)}),
+        "Citas_Pacientes_df": pd.DataFrame({
+            'ID_Paciente': ids(filas, n_pacientes), 'ID_Cita': id_cita, 'Fecha Cita': fechas(filas),
+            'Cita_asistida': rng.integers(0, 2, filas), 'Cita duplicada': (rng.random(filas) < 0.02).astype(int)}),
+        "Citas_Motivo_df": pd.DataFrame({
+            'ID_Cita': id_cita, 'Hora Inicio Cita': horas(filas, 8), 'Hora Fin Cita': horas(filas, 9),
+            'Sucursal': elegir(sucursales, filas), 'Cita_Creacion': fechas(filas),
+            'Motivo Cita': elegir(np.array(['Revisión', 'Limpieza', 'Urgencia'], dtype=object), filas),
+            'ID_Tratamiento': ids(filas, filas // 2)}),
+        "Presupuesto por Accion_df": pd.DataFrame({
+            'Sucursal': elegir(sucursales, filas), 'ID_Tratamiento': ids(filas, filas // 2),
+            'Tratamiento_fecha_de_generacion': fechas(filas), 'ID_Detalle Presupuesto': np.arange(filas),
+            'ID_Procedimiento': elegir(procedimientos, filas), 'ID_Paciente': ids(filas, n_pacientes)}),
+        "Acciones_df": pd.DataFrame({
+            'Sucursal': elegir(sucursales, filas), 'ID_Paciente': ids(filas, n_pacientes),
+            'ID_Procedimiento': elegir(procedimientos, filas), 'Procedimiento_Fecha_Realizacion': fechas(filas)}),
+        "Movimiento_df": pd.DataFrame({
+            'Sucursal': elegir(sucursales, filas), 'ID_Pago': ids(filas, filas // 2),
+            'Pago_fecha_recepcion': fechas(filas), 'ID_Paciente': ids(filas, n_pacientes),
+            'ID_Detalle_Presupuesto': np.arange(filas), 'Pagado_ID_Detalle_Presupuesto': rng.integers(100, 5000, filas),
+            'Abono Libre': rng.integers(0, 100, filas), 'Total Pago': rng.integers(100, 5000, filas),
+            'Medio_de_pago': elegir(medios, filas)}),
+        "Tabla Gastos Aliadas Mexico_df": pd.DataFrame({
+            'Sucursal': elegir(sucursales, filas // 4), 'Fecha del Gasto': fechas(filas // 4),
+            'Monto Gasto': rng.integers(100, 10000, filas // 4)}),
+    }
+
+
+def medir(filas: int) -> Dict[str, float]:
+    """Corre generar_insights_pacientes en este proceso y mide su memoria pico."""
+    import procesador_datos
+
+    processed_dfs = generar_processed_dfs(filas)
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    inicio = time.perf_counter()
+    resultados = procesador_datos.generar_insights_pacientes(processed_dfs, [])
+    segundos = time.perf_counter() - inicio
+    actual, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"copy_on_write": procesador_datos.COPY_ON_WRITE, "segundos": segundos,
+            "pico_mb": (pico - base) / MB, "retenido_mb": (actual - base) / MB,
+            "entrada_mb": sum(df.memory_usage(deep=True).sum() for df in processed_dfs.values()) / MB,
+            "tablas": len(resultados)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--filas', type=int, default=500_000)
+    parser.add_argument('--medir', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.medir:
+        print(json.dumps(medir(args.filas)))
+        return
+
+    print(f"Filas sintéticas por tabla de hechos: {args.filas:,}")
+    for cow in ("0", "1"):
+        entorno = dict(os.environ, SHERLOCK_COPY_ON_WRITE=cow)
+        salida = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_memoria_pipeline", "--filas", str(args.filas), "--medir"],
+            env=entorno, capture_output=True, text=True, check=True)
+        r = json.loads(salida.stdout.strip().splitlines()[-1])
+        modo = "Copy-on-Write" if r["copy_on_write"] else "Copias completas"
+        print(f"  {modo:17s} pico {r['pico_mb']:8.1f} MB  retenido {r['retenido_mb']:8.1f} MB  "
+              f"(entrada {r['entrada_mb']:.1f} MB, {r['segundos']:.2f} s, {r['tablas']} tablas)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+Generadores de datos sintéticos con la forma de los exportes de Dentalink.
+
+Las columnas salen de `indice.txt` (mismo contenido que indice.xlsx): cada
+archivo del índice se genera con sus columnas originales (KEEP y DROP) y
+valores coherentes entre tablas (los ID_Cita de Citas_Pacientes y
+Citas_Motivo coinciden, los pacientes, tratamientos, procedimientos,
+sucursales y medios de pago referencian a sus tablas, etc.).
+
+El tamaño se define con `filas` (citas); el resto de las tablas se escala a
+partir de ahí (ver `filas_por_archivo`). Con la misma `filas`, `semilla` y
+fecha de referencia los datos son idénticos en cada corrida.
+
+Excel admite como máximo 1.048.576 filas por hoja (incluido el encabezado),
+así que `escribir_libros` no acepta escalas mayores; para medir la
+transformación y la escritura por encima de eso se usa `generar_processed_dfs`,
+que arma en memoria las mismas tablas que devolvería load_dataframes_from_uploads.
+
+Uso: python -m benchmarks.datos_sinteticos <directorio> [--filas 10000] [--semilla 0]
+"""
+import argparse
+import datetime as dt
+import io
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import procesador_datos
+import reglas_indice
+
+RUTA_INDICE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "indice.txt")
+# Filas de datos que caben en una hoja de Excel (sin contar el encabezado).
+LIMITE_FILAS_EXCEL = 1_048_575
+# Parámetros con los que se generó un directorio de libros (para reutilizarlo).
+NOMBRE_PARAMETROS = "sherlock_bench.json"
+# Escalas con nombre para la línea de comandos (filas de citas).
+ESCALAS = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000, '10m': 10_000_000}
+
+SUCURSALES = np.array(['Polanco', 'Satélite', 'Coyoacán', 'Puebla', 'Querétaro', 'Monterrey'], dtype=object)
+TIPOS_DENTALINK = np.array(['Facebook', 'Google', 'Referido', 'Instagram', 'Espontáneo'], dtype=object)
+ORIGENES = np.array(['FB ads', 'Google ads', 'Referido', 'IG ads', 'Orgánico'], dtype=object)
+MEDIOS_PAGO = np.array(['Efectivo', 'Tarjeta de crédito', 'Tarjeta de débito', 'Transferencia'], dtype=object)
+MEDIOS_PAGO_PBI = np.array(['Efectivo', 'Tarjeta', 'Tarjeta', 'Transferencia'], dtype=object)
+MOTIVOS_CITA = np.array(['Valoración', 'Control', 'Urgencia', 'Limpieza', 'Ortodoncia'], dtype=object)
+ESTADOS_CITA = np.array(['Atendido', 'Confirmado', 'No asistió', 'Anulado'], dtype=object)
+NOMBRES = np.array(['Ana', 'Luis', 'Eva', 'Juan', 'María', 'José', 'Sofía', 'Diego'], dtype=object)
+APELLIDOS = np.array(['García', 'López', 'Martínez', 'Hernández', 'Pérez', 'Sánchez'], dtype=object)
+CIUDADES = np.array(['CDMX', 'Puebla', 'Querétaro', 'Monterrey', 'Toluca'], dtype=object)
+N_PROCEDIMIENTOS = 500
+N_LADAS = 300
+# Proporción de pacientes de prueba (los que las tablas KPI excluyen).
+PROPORCION_PACIENTES_PRUEBA = 0.001
+# Texto de relleno para las columnas DROP (se leen del Excel pero no se usan).
+_RELLENO = np.array(['', 'N/A', 'Sin dato', 'Otro', 'Pendiente', 'OK'], dtype=object)
+# Horas de cita posibles (de 8:00 a 19:45, cada 15 minutos).
+_HORAS = np.array([dt.time(h, m) for h in range(8, 20) for m in (0, 15, 30, 45)], dtype=object)
+
+
+def leer_indice(ruta: str = RUTA_INDICE) -> pd.DataFrame:
+    return pd.read_csv(ruta, sep='\t', encoding='cp1252', dtype=str)
+
+
+def filas_por_archivo(filas: int) -> Dict[str, int]:
+    """Filas de cada archivo (sin extensión) para `filas` citas."""
+    return {
+        'Citas_Pacientes': filas, 'Citas_Motivo': filas, 'Acciones': filas,
+        'Presupuesto por Accion': filas, 'Movimiento': filas,
+        'Pacientes_Nuevos': max(filas // 4, 10), 'Tratamiento Generado Mex': max(filas // 3, 10),
+        'Respuesta_Encuestas': max(filas // 10, 10), 'Tabla Gastos Aliadas Mexico': max(filas // 10, 10),
+        'Sucursal': len(SUCURSALES), 'Tipos de pacientes': len(TIPOS_DENTALINK),
+        'Medios_de_pago': len(MEDIOS_PAGO), 'Tabla_Procedimientos': N_PROCEDIMIENTOS, 'Lada': N_LADAS,
+    }
+
+
+class _Generador:
+    """Valores por columna (según su nombre unificado) con claves coherentes entre tablas."""
+
+    def __init__(self, filas: int, semilla: int, hoy: pd.Timestamp):
+        self.rng = np.random.default_rng(semilla)
+        self.filas = filas
+        self.hoy = hoy
+        self.tamanios = filas_por_archivo(filas)
+        self.n_pacientes = self.tamanios['Pacientes_Nuevos']
+        self.n_tratamientos = self.tamanios['Tratamiento Generado Mex']
+        self.procedimientos = np.array([f"Procedimiento {i:04d}" for i in range(1, N_PROCEDIMIENTOS + 1)],
+                                       dtype=object)
+
+    def _elegir(self, valores: np.ndarray, n: int) -> np.ndarray:
+        return valores[self.rng.integers(0, len(valores), n)]
+
+    def _ids(self, n: int, maximo: int) -> np.ndarray:
+        return self.rng.integers(1, max(maximo, 1) + 1, n)
+
+    def _fechas(self, n: int, desde_dias: int = -3 * 365, hasta_dias: int = 180) -> np.ndarray:
+        return (self.hoy + pd.to_timedelta(self.rng.integers(desde_dias, hasta_dias, n), unit='D')).values
+
+    def _montos(self, n: int) -> np.ndarray:
+        return np.round(self.rng.gamma(2.0, 900.0, n), 2)
+
+    def columna_conservada(self, archivo: str, nombre: str, n: int) -> np.ndarray:
+        nombre = procesador_datos.replace_spaces_with_underscores(nombre)
+        if nombre == 'ID_Paciente':
+            if archivo == 'Pacientes_Nuevos':
+                return np.arange(1, n + 1)
+            return self._ids(n, self.n_pacientes)
+        if nombre == 'ID_Cita':
+            ids = np.arange(1, n + 1)
+            return self.rng.permutation(ids) if archivo == 'Citas_Motivo' else ids
+        if nombre == 'ID_Tratamiento':
+            if archivo == 'Tratamiento Generado Mex':
+                return np.arange(1, n + 1)
+            return self._ids(n, self.n_tratamientos)
+        if nombre == 'ID_Detalle_Presupuesto':
+            if archivo == 'Presupuesto por Accion':
+                return np.arange(1, n + 1)
+            return self._ids(n, self.filas)
+        if nombre == 'ID_Pago':
+            return self._ids(n, max(self.filas // 2, 1))
+        if nombre == 'ID_Procedimiento':
+            if archivo == 'Tabla_Procedimientos':
+                return self.procedimientos[:n]
+            return self._elegir(self.procedimientos, n)
+        if nombre == 'Sucursal':
+            return SUCURSALES[:n] if archivo == 'Sucursal' else self._elegir(SUCURSALES, n)
+        if nombre == 'Tipo_Dentalink':
+            return TIPOS_DENTALINK[:n] if archivo == 'Tipos de pacientes' else self._elegir(TIPOS_DENTALINK, n)
+        if nombre == 'Paciente_Origen':
+            return ORIGENES[:n]
+        if nombre == 'Medio_de_pago_Key':
+            return MEDIOS_PAGO[:n]
+        if nombre == 'Medio_de_pago':
+            return MEDIOS_PAGO_PBI[:n] if archivo == 'Medios_de_pago' else self._elegir(MEDIOS_PAGO, n)
+        if nombre == 'Gasto_medio_de_pago':
+            return self._elegir(MEDIOS_PAGO, n)
+        if nombre == 'Paciente_Nombre':
+            nombres = self._elegir(NOMBRES, n)
+            nombres[self.rng.random(n) < PROPORCION_PACIENTES_PRUEBA] = 'Paciente Prueba'
+            return nombres
+        if nombre == 'Paciente_Apellidos':
+            return self._elegir(APELLIDOS, n)
+        if nombre == 'Sexo':
+            return self._elegir(np.array(['F', 'M'], dtype=object), n)
+        if nombre == 'Celular':
+            if archivo == 'Lada':
+                return np.arange(200, 200 + n).astype(str).astype(object)
+            return self.rng.integers(2_000_000_000, 9_999_999_999, n).astype(str).astype(object)
+        if nombre == 'Ciudad':
+            return self._elegir(CIUDADES, n)
+        if nombre == 'Cita_asistida':
+            return self.rng.integers(0, 2, n)
+        if nombre == 'Cita_duplicada':
+            return (self.rng.random(n) < 0.02).astype(int)
+        if nombre == 'Consecutivo_cita':
+            return self.rng.integers(1, 30, n)
+        if nombre == 'Estado_Cita':
+            return self._elegir(ESTADOS_CITA, n)
+        if nombre == 'Motivo_Cita':
+            return self._elegir(MOTIVOS_CITA, n)
+        if nombre in ('Hora_Inicio_Cita', 'Hora_Fin_Cita'):
+            return self._elegir(_HORAS, n)
+        if nombre == 'Fecha_de_nacimiento':
+            return self._fechas(n, -90 * 365, 0)
+        if 'fecha' in nombre.lower() or nombre == 'Cita_Creacion':
+            return self._fechas(n)
+        if any(texto in nombre.lower() for texto in ('monto', 'precio', 'total', 'pagado', 'abono')):
+            return self._montos(n)
+        if nombre in ('Tratamiento_iniciado', 'Tratamiento_Aceptado'):
+            return self._elegir(np.array(['Sí', 'No'], dtype=object), n)
+        if nombre == 'Resultado':
+            return self.rng.integers(1, 11, n)
+        return self._elegir(np.array([f"{nombre} {i}" for i in range(1, 21)], dtype=object), n)
+
+    def columna_descartada(self, nombre: str, n: int) -> np.ndarray:
+        if 'fecha' in nombre.lower():
+            return self._fechas(n)
+        return self._elegir(_RELLENO, n)
+
+
+def generar_hojas(filas: int, semilla: int = 0, hoy: Optional[pd.Timestamp] = None,
+                  solo_conservadas: bool = False) -> Dict[str, Tuple[str, pd.DataFrame]]:
+    """
+    {archivo (con extensión): (hoja, DataFrame)} con los nombres de columna
+    originales del índice. Con `solo_conservadas` se omiten las columnas DROP.
+    """
+    hoy = (hoy or pd.Timestamp('today')).normalize()
+    generador = _Generador(filas, semilla, hoy)
+    indice = leer_indice()
+    hojas = {}
+    for (archivo, hoja), columnas in indice.groupby(['Archivo', 'Sheet'], sort=False):
+        base, _ = os.path.splitext(archivo)
+        n = generador.tamanios[base]
+        datos = {}
+        for fila in columnas.itertuples(index=False):
+            original, unificado, accion = fila[2], fila[3], str(fila[4]).strip().upper()
+            if original in datos:
+                continue
+            if accion == 'KEEP':
+                datos[original] = generador.columna_conservada(base, unificado, n)
+            elif not solo_conservadas:
+                datos[original] = generador.columna_descartada(original, n)
+        hojas[archivo] = (hoja, pd.DataFrame(datos))
+    return hojas
+
+
+def contenido_indice_xlsx() -> bytes:
+    """indice.xlsx armado a partir de indice.txt."""
+    salida = io.BytesIO()
+    leer_indice().to_excel(salida, index=False)
+    return salida.getvalue()
+
+
+def escribir_libros(directorio: str, filas: int, semilla: int = 0, hoy: Optional[pd.Timestamp] = None,
+                    solo_conservadas: bool = False) -> List[str]:
+    """Escribe indice.xlsx y un libro por archivo del índice; devuelve las rutas de los libros de datos."""
+    if filas > LIMITE_FILAS_EXCEL:
+        raise ValueError(
+            f"{filas:,} filas no caben en una hoja de Excel (máximo {LIMITE_FILAS_EXCEL:,}).")
+    os.makedirs(directorio, exist_ok=True)
+    with open(os.path.join(directorio, "indice.xlsx"), "wb") as f:
+        f.write(contenido_indice_xlsx())
+    rutas = []
+    for archivo, (hoja, df) in generar_hojas(filas, semilla, hoy, solo_conservadas).items():
+        ruta = os.path.join(directorio, archivo)
+        df.to_excel(ruta, sheet_name=hoja, index=False)
+        rutas.append(ruta)
+    return rutas
+
+
+def preparar_libros(directorio: str, filas: int, semilla: int = 0, hoy: Optional[pd.Timestamp] = None,
+                    solo_conservadas: bool = False) -> bool:
+    """
+    Deja en `directorio` los libros para estos parámetros. Si ya estaban (mismo
+    NOMBRE_PARAMETROS) no se regeneran: escribir Excel es mucho más lento que
+    leerlo. Devuelve True si se generaron.
+    """
+    hoy = (hoy or pd.Timestamp('today')).normalize()
+    parametros = {"filas": filas, "semilla": semilla, "hoy": hoy.date().isoformat(),
+                  "solo_conservadas": solo_conservadas, "indice": os.path.getmtime(RUTA_INDICE)}
+    ruta_parametros = os.path.join(directorio, NOMBRE_PARAMETROS)
+    if os.path.exists(ruta_parametros):
+        with open(ruta_parametros, encoding="utf-8") as f:
+            if json.load(f) == parametros:
+                return False
+        os.remove(ruta_parametros)
+    escribir_libros(directorio, filas, semilla, hoy, solo_conservadas)
+    with open(ruta_parametros, "w", encoding="utf-8") as f:
+        json.dump(parametros, f)
+    return True
+
+
+def generar_processed_dfs(filas: int, semilla: int = 0, hoy: Optional[pd.Timestamp] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Las tablas que devolvería load_dataframes_from_uploads para estos datos,
+    sin pasar por Excel (se les aplican las mismas reglas del índice).
+    """
+    reglas = reglas_indice.compilar_indice(leer_indice())
+    processed_dfs = {}
+    for archivo, (hoja, df) in generar_hojas(filas, semilla, hoy, solo_conservadas=True).items():
+        base, _ = os.path.splitext(archivo)
+        processed_dfs[f"{base}_df"] = procesador_datos.limpiar_hoja(df, reglas.regla_para(base, hoja))
+    return processed_dfs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directorio')
+    parser.add_argument('--filas', type=int, default=10_000)
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--solo-conservadas', action='store_true',
+                        help="No escribe las columnas DROP (libros más chicos y rápidos de generar).")
+    args = parser.parse_args()
+    if preparar_libros(args.directorio, args.filas, args.semilla, solo_conservadas=args.solo_conservadas):
+        print(f"Libros e indice.xlsx escritos en '{args.directorio}' ({args.filas:,} citas).")
+    else:
+        print(f"'{args.directorio}' ya tiene los libros para estos parámetros.")
+
+
+if __name__ == '__main__':
+    main()
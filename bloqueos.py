@@ -0,0 +1,65 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin flock, el bloqueo vale solo dentro de este proceso.
+    fcntl = None
+
+# --- Bloqueos entre procesos ---
+# Con varios workers web (uvicorn --workers / gunicorn) cada subida o
+# disparador puede caer en un proceso distinto. Los bloqueos son archivos con
+# flock: los comparten todos los procesos que ven el mismo directorio y el
+# sistema los libera solo si el proceso que los tiene muere.
+
+_bloqueos_locales: Dict[str, threading.Lock] = {}
+_guardia_locales = threading.Lock()
+
+
+def tomar_bloqueo(ruta: str, esperar: bool = True) -> Optional[BinaryIO]:
+    """
+    Toma el bloqueo exclusivo de `ruta` (el archivo se crea si no existe) y
+    devuelve el archivo abierto: el bloqueo dura hasta cerrarlo. Con
+    `esperar=False` devuelve None si otro proceso lo tiene.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(ruta)), exist_ok=True)
+    archivo = open(ruta, "a+b")
+    if fcntl is None:
+        return archivo
+    try:
+        fcntl.flock(archivo.fileno(), fcntl.LOCK_EX if esperar else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        archivo.close()
+        return None
+    return archivo
+
+
+def esta_bloqueado(ruta: str) -> bool:
+    """True si algún proceso vivo tiene el bloqueo de `ruta` (sin flock, siempre False)."""
+    if fcntl is None or not os.path.exists(ruta):
+        return False
+    archivo = tomar_bloqueo(ruta, esperar=False)
+    if archivo is None:
+        return True
+    archivo.close()
+    return False
+
+
+@contextmanager
+def bloqueo(ruta: str) -> Iterator[None]:
+    """Bloqueo exclusivo sobre el archivo `ruta` mientras dura el `with`; espera hasta obtenerlo."""
+    if fcntl is None:
+        with _guardia_locales:
+            local = _bloqueos_locales.setdefault(os.path.abspath(ruta), threading.Lock())
+        with local:
+            yield
+        return
+    # Cada open() es una descripción de archivo propia, así que flock también
+    # excluye a los hilos de un mismo proceso.
+    archivo = tomar_bloqueo(ruta)
+    try:
+        yield
+    finally:
+        archivo.close()
@@ -0,0 +1,300 @@
+import pandas as pd
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import inspect, text
+
+import escritor_postgres
+
+
+# --- Claves naturales por tabla para la carga incremental ---
+# Las tablas que no aparecen aquí (dimensiones pequeñas, perfiles agregados,
+# hechos con IDs posicionales como ID_Accion_Unico) se reescriben completas.
+CLAVES_NATURALES: Dict[str, List[str]] = {
+    "hechos_pacientes": ["ID_Paciente"],
+    "hechos_citas": ["ID_Cita"],
+    "hechos_pagos_transacciones": ["ID_Pago"],
+    "hechos_pagos_aplicaciones_detalle": ["ID_Pago", "ID_Detalle_Presupuesto"],
+    "hechos_presupuesto_detalle": ["ID_Detalle_Presupuesto"],
+    "dimension_tratamientos_generados": ["ID_Tratamiento"],
+}
+
+# Tabla auxiliar con el hash de cada fila de la última carga.
+TABLA_HASHES = "sherlock_hashes_filas"
+# Tabla temporal con las claves a borrar/reemplazar durante una carga.
+TABLA_CLAVES_TMP = "sherlock_claves_tmp"
+# Tabla temporal con los valores por los que se filtra una lectura parcial.
+TABLA_FILTRO_TMP = "sherlock_filtro_tmp"
+COL_CLAVE = "_clave_sherlock"
+
+
+def calcular_hashes_filas(df: pd.DataFrame) -> pd.Series:
+    """
+    Calcula un hash de 64 bits por fila (sin incluir el índice).
+    Se guarda como entero con signo para que quepa en un BIGINT.
+    """
+    return pd.util.hash_pandas_object(df, index=False).astype('int64')
+
+
+def claves_como_texto(df: pd.DataFrame, claves: List[str]) -> pd.Series:
+    """
+    Serializa la clave natural (simple o compuesta) de cada fila a un string.
+    Ej: ['ID_Pago', 'ID_Detalle_Presupuesto'] -> '1234|5678'
+    """
+    serie = df[claves[0]].astype(str)
+    for col in claves[1:]:
+        serie = serie + "|" + df[col].astype(str)
+    return serie
+
+
+def _validar_claves(df: pd.DataFrame, claves: List[str]) -> Optional[str]:
+    faltantes = [c for c in claves if c not in df.columns]
+    if faltantes:
+        return f"faltan columnas clave {faltantes}"
+    if df[claves].isna().any().any():
+        return "hay claves nulas"
+    if df.duplicated(subset=claves).any():
+        return "hay claves duplicadas"
+    return None
+
+
+def _leer_hashes_previos(conn: Any, table_name: str) -> pd.DataFrame:
+    resultado = conn.execute(
+        text(f'SELECT clave, hash_fila FROM "{TABLA_HASHES}" WHERE tabla = :tabla'),
+        {"tabla": table_name})
+    return pd.DataFrame(resultado.fetchall(), columns=["clave", "hash_fila"])
+
+
+def _reescribir_hashes(conn: Any, table_name: str, claves_txt: pd.Series, hashes: pd.Series):
+    if inspect(conn).has_table(TABLA_HASHES):
+        conn.execute(text(f'DELETE FROM "{TABLA_HASHES}" WHERE tabla = :tabla'),
+                     {"tabla": table_name})
+    escritor_postgres.escribir_df(
+        pd.DataFrame({"tabla": table_name, "clave": claves_txt.values, "hash_fila": hashes.values}),
+        TABLA_HASHES, conn, if_exists='append')
+
+
+def _claves_eliminadas(claves_txt: pd.Series, df: pd.DataFrame, claves: List[str]) -> pd.DataFrame:
+    """
+    Reconstruye los valores tipados de las claves que ya no vienen en la
+    exportación a partir de su forma de texto guardada en la carga anterior.
+    """
+    if claves_txt.empty:
+        partes = pd.DataFrame({col: pd.Series(dtype=df[col].dtype) for col in claves})
+        partes[COL_CLAVE] = pd.Series(dtype=object)
+        return partes
+    if len(claves) == 1:
+        partes = pd.DataFrame({claves[0]: claves_txt.values})
+    else:
+        partes = claves_txt.str.split("|", n=len(claves) - 1, expand=True)
+        partes.columns = claves
+    for col in claves:
+        partes[col] = partes[col].astype(df[col].dtype)
+    partes[COL_CLAVE] = claves_txt.values
+    return partes
+
+
+def _borrar_claves(conn: Any, table_name: str, df_claves: pd.DataFrame, claves: List[str]):
+    """Borra de `table_name` y de sus hashes las filas con las claves de `df_claves` (con COL_CLAVE)."""
+    # Las claves a borrar se suben a una tabla temporal para que el
+    # DELETE funcione igual con claves simples o compuestas.
+    escritor_postgres.escribir_df(
+        df_claves, TABLA_CLAVES_TMP, conn, if_exists='replace', analizar=False)
+    condicion = " AND ".join(
+        f'c."{col}" = "{table_name}"."{col}"' for col in claves)
+    conn.execute(text(
+        f'DELETE FROM "{table_name}" WHERE EXISTS '
+        f'(SELECT 1 FROM "{TABLA_CLAVES_TMP}" AS c WHERE {condicion})'))
+    if inspect(conn).has_table(TABLA_HASHES):
+        conn.execute(text(
+            f'DELETE FROM "{TABLA_HASHES}" WHERE tabla = :tabla AND clave IN '
+            f'(SELECT "{COL_CLAVE}" FROM "{TABLA_CLAVES_TMP}")'), {"tabla": table_name})
+    conn.execute(text(f'DROP TABLE "{TABLA_CLAVES_TMP}"'))
+
+
+def _agregar_con_hashes(conn: Any, df: pd.DataFrame, table_name: str, claves_txt: pd.Series, hashes: pd.Series):
+    escritor_postgres.escribir_df(df, table_name, conn, if_exists='append')
+    escritor_postgres.escribir_df(
+        pd.DataFrame({"tabla": table_name, "clave": claves_txt.values, "hash_fila": hashes.values}),
+        TABLA_HASHES, conn, if_exists='append')
+
+
+def guardar_df_incremental(
+    df: pd.DataFrame, table_name: str, db_engine: Any,
+    guardar_completo: Callable[[pd.DataFrame, str, Any], None],
+    claves: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    """
+    Guarda `df` en `table_name` escribiendo solo las filas nuevas o modificadas
+    y borrando las que ya no vienen en la exportación.
+
+    Compara el hash de cada fila entrante contra el de la carga anterior
+    (tabla `sherlock_hashes_filas`). Si la tabla no tiene clave natural, no
+    existe aún, cambió de columnas o la clave no es única, se hace una carga
+    completa con `guardar_completo` y se regeneran los hashes.
+    """
+    if db_engine is None:
+        raise ConnectionError("Conexión a la base de datos no establecida.")
+    claves = claves or CLAVES_NATURALES.get(table_name)
+    if not claves:
+        guardar_completo(df, table_name, db_engine)
+        return {"modo": "completo", "filas": len(df)}
+    if df.empty:
+        print(
+            f"ADVERTENCIA: DataFrame para tabla '{table_name}' vacío. No se guardará.")
+        return {"modo": "omitido", "filas": 0}
+
+    hashes = calcular_hashes_filas(df)
+    claves_txt = None
+    previos = pd.DataFrame(columns=["clave", "hash_fila"])
+    motivo_completo = _validar_claves(df, claves)
+    if motivo_completo is None:
+        claves_txt = claves_como_texto(df, claves)
+        inspector = inspect(db_engine)
+        if not inspector.has_table(table_name):
+            motivo_completo = "la tabla no existe"
+        elif [c["name"] for c in inspector.get_columns(table_name)] != list(df.columns):
+            motivo_completo = "cambiaron las columnas"
+        elif not inspector.has_table(TABLA_HASHES):
+            motivo_completo = "no hay hashes de una carga anterior"
+        else:
+            with db_engine.connect() as conn:
+                previos = _leer_hashes_previos(conn, table_name)
+            if previos.empty:
+                motivo_completo = "no hay hashes de una carga anterior"
+
+    if motivo_completo is None:
+        entrantes = pd.DataFrame(
+            {"clave": claves_txt.values, "hash_nuevo": hashes.values})
+        comparacion = entrantes.merge(
+            previos, on="clave", how="outer", indicator=True)
+        es_nueva = comparacion["_merge"] == "left_only"
+        es_modificada = (comparacion["_merge"] == "both") & (
+            comparacion["hash_nuevo"] != comparacion["hash_fila"])
+        es_eliminada = comparacion["_merge"] == "right_only"
+        try:
+            df_eliminadas = _claves_eliminadas(
+                comparacion.loc[es_eliminada, "clave"], df, claves)
+        except (ValueError, TypeError) as e_claves:
+            motivo_completo = f"no se pudieron interpretar claves previas ({e_claves})"
+
+    if motivo_completo is not None:
+        print(
+            f"--- Log Sherlock (BG Task - incremental): '{table_name}' se carga COMPLETA ({motivo_completo}).")
+        guardar_completo(df, table_name, db_engine)
+        if claves_txt is not None:
+            with db_engine.begin() as conn:
+                _reescribir_hashes(conn, table_name, claves_txt, hashes)
+        return {"modo": "completo", "filas": len(df)}
+
+    mascara_modificada = claves_txt.isin(
+        set(comparacion.loc[es_modificada, "clave"])).to_numpy()
+    mascara_escribir = mascara_modificada | claves_txt.isin(
+        set(comparacion.loc[es_nueva, "clave"])).to_numpy()
+    stats = {"modo": "incremental", "nuevas": int(es_nueva.sum()),
+             "modificadas": int(es_modificada.sum()), "eliminadas": int(es_eliminada.sum()),
+             "sin_cambios": int(len(df) - mascara_escribir.sum())}
+
+    with db_engine.begin() as conn:
+        if mascara_modificada.any() or not df_eliminadas.empty:
+            df_claves = df.loc[mascara_modificada, claves].copy()
+            df_claves[COL_CLAVE] = claves_txt[mascara_modificada].values
+            _borrar_claves(conn, table_name, pd.concat([df_claves, df_eliminadas], ignore_index=True), claves)
+
+        if mascara_escribir.any():
+            _agregar_con_hashes(conn, df.loc[mascara_escribir], table_name,
+                                claves_txt[mascara_escribir], hashes[mascara_escribir])
+
+    print(
+        f"--- Log Sherlock (BG Task - incremental): '{table_name}': {stats['nuevas']} nuevas, "
+        f"{stats['modificadas']} modificadas, {stats['eliminadas']} eliminadas, {stats['sin_cambios']} sin cambios.")
+    return stats
+
+
+# --- Cargas parciales dentro de una transacción abierta ---
+# Con el estado por paciente (estado_pacientes.py) cada lote trae solo una
+# parte de la historia de citas: se reemplazan las filas del lote y se
+# leen de la base solo las filas que el lote puede cambiar.
+
+def reemplazar_filas(df: pd.DataFrame, table_name: str, conn: Any,
+                     claves: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Borra de `table_name` las filas con las claves de `df` y agrega `df`
+    (con sus hashes), sin tocar el resto de la tabla. Si la tabla no existe
+    se crea; si la clave no sirve o cambiaron las columnas se lanza ValueError.
+    """
+    claves = claves or CLAVES_NATURALES[table_name]
+    existe = inspect(conn).has_table(table_name)
+    motivo = _validar_claves(df, claves)
+    if motivo is None and existe and [c["name"] for c in inspect(conn).get_columns(table_name)] != list(df.columns):
+        motivo = "cambiaron las columnas"
+    if motivo is not None:
+        raise ValueError(
+            f"'{table_name}' no se puede cargar sin borrar las filas de lotes anteriores: {motivo}.")
+    if df.empty:
+        return {"modo": "parcial", "filas": 0}
+    claves_txt = claves_como_texto(df, claves)
+    if existe:
+        df_claves = df[claves].copy()
+        df_claves[COL_CLAVE] = claves_txt.values
+        _borrar_claves(conn, table_name, df_claves, claves)
+    _agregar_con_hashes(conn, df, table_name, claves_txt, calcular_hashes_filas(df))
+    print(f"--- Log Sherlock (BG Task - incremental): '{table_name}': {len(df)} filas reemplazadas o agregadas.")
+    return {"modo": "parcial", "filas": len(df)}
+
+
+def condicion_meses(columna: str, meses: pd.Series) -> Tuple[str, Dict[str, Any]]:
+    """
+    Condición SQL (y sus parámetros) para las filas de `columna` que caen en
+    `meses` (primer día de cada mes; NaT = fecha nula). Los meses seguidos se
+    juntan en un solo rango.
+    """
+    partes, parametros = [], {}
+    validos = sorted(pd.Series(meses).dropna().unique())
+    rangos: List[List[pd.Timestamp]] = []
+    for mes in validos:
+        mes = pd.Timestamp(mes)
+        if rangos and rangos[-1][1] == mes:
+            rangos[-1][1] = mes + pd.DateOffset(months=1)
+        else:
+            rangos.append([mes, mes + pd.DateOffset(months=1)])
+    for i, (desde, hasta) in enumerate(rangos):
+        partes.append(f'("{columna}" >= :desde_{i} AND "{columna}" < :hasta_{i})')
+        parametros[f"desde_{i}"], parametros[f"hasta_{i}"] = desde.to_pydatetime(), hasta.to_pydatetime()
+    if pd.Series(meses).isna().any():
+        partes.append(f'"{columna}" IS NULL')
+    return (" OR ".join(partes) or "1 = 0"), parametros
+
+
+def leer_filas(conn: Any, table_name: str, condicion: Optional[str] = None,
+               parametros: Optional[Dict[str, Any]] = None, valores: Optional[pd.DataFrame] = None,
+               columnas_fecha: Iterable[str] = ()) -> pd.DataFrame:
+    """
+    Filas de `table_name` que cumplen `condicion` o cuyas columnas de
+    `valores` coinciden con alguna fila de `valores` (subida a una tabla
+    temporal, así el filtro no depende de cuántos valores son).
+    """
+    partes = [f"({condicion})"] if condicion else []
+    if valores is not None and not valores.empty:
+        escritor_postgres.escribir_df(valores, TABLA_FILTRO_TMP, conn, if_exists='replace', analizar=False)
+        coinciden = " AND ".join(f'f."{col}" = t."{col}"' for col in valores.columns)
+        partes.append(f'EXISTS (SELECT 1 FROM "{TABLA_FILTRO_TMP}" AS f WHERE {coinciden})')
+    try:
+        return pd.read_sql(text(f'SELECT t.* FROM "{table_name}" AS t WHERE {" OR ".join(partes) or "1 = 0"}'),
+                           conn, params=parametros or {}, parse_dates=list(columnas_fecha))
+    finally:
+        if valores is not None and not valores.empty:
+            conn.execute(text(f'DROP TABLE "{TABLA_FILTRO_TMP}"'))
+
+
+def reemplazar_meses(df: pd.DataFrame, table_name: str, conn: Any, columna_mes: str, meses: pd.Series):
+    """
+    Reemplaza en `table_name` (tabla KPI con una fila por mes y grupo) las
+    filas de `meses` por las de `df`; los demás meses no se tocan.
+    """
+    if inspect(conn).has_table(table_name):
+        columnas = [c["name"] for c in inspect(conn).get_columns(table_name)]
+        if columnas != list(df.columns):
+            raise ValueError(f"No se pueden reemplazar meses de '{table_name}': cambiaron las columnas.")
+        condicion, parametros = condicion_meses(columna_mes, meses)
+        conn.execute(text(f'DELETE FROM "{table_name}" WHERE {condicion}'), parametros)
+    if not df.empty:
+        escritor_postgres.escribir_df(df, table_name, conn, if_exists='append')
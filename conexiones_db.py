@@ -0,0 +1,58 @@
+import os
+from typing import Any, Dict
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+# --- Pools de conexiones: uno para el ETL (carga) y otro para las queries ---
+# Variables con prefijo SHERLOCK_DB_CARGA_ (pool del ETL) o SHERLOCK_DB_LECTURA_
+# (pool de /execute_sql_query/): POOL_SIZE, MAX_OVERFLOW, POOL_TIMEOUT,
+# POOL_RECYCLE y PRE_PING.
+DEFAULTS_POOL = {
+    "carga": {"POOL_SIZE": 2, "MAX_OVERFLOW": 0, "POOL_TIMEOUT": 30, "POOL_RECYCLE": 1800, "PRE_PING": True},
+    "lectura": {"POOL_SIZE": 5, "MAX_OVERFLOW": 5, "POOL_TIMEOUT": 10, "POOL_RECYCLE": 1800, "PRE_PING": True},
+}
+# Tiempo máximo de cada query de lectura en milisegundos (0 = sin límite).
+TIMEOUT_QUERY_LECTURA_MS = int(os.environ.get("SHERLOCK_SQL_TIMEOUT_MS", 30000))
+
+
+def _valor_env(nombre: str, default: Any) -> Any:
+    valor = os.environ.get(nombre)
+    if valor is None:
+        return default
+    if isinstance(default, bool):
+        return valor.strip().lower() in ("1", "true", "si", "sí", "yes", "on")
+    return type(default)(valor)
+
+
+def opciones_pool(rol: str) -> Dict[str, Any]:
+    prefijo = f"SHERLOCK_DB_{rol.upper()}_"
+    valores = {clave: _valor_env(prefijo + clave, default)
+               for clave, default in DEFAULTS_POOL[rol].items()}
+    return {"pool_size": valores["POOL_SIZE"], "max_overflow": valores["MAX_OVERFLOW"],
+            "pool_timeout": valores["POOL_TIMEOUT"], "pool_recycle": valores["POOL_RECYCLE"],
+            "pool_pre_ping": valores["PRE_PING"]}
+
+
+def crear_engine_carga(database_url: str) -> Engine:
+    """Engine del ETL: pocas conexiones, usadas para las escrituras masivas."""
+    return create_engine(database_url, **opciones_pool("carga"))
+
+
+def crear_engine_lectura(database_url: str) -> Engine:
+    """
+    Engine de /execute_sql_query/. En PostgreSQL cada transacción se abre
+    como READ ONLY y con `statement_timeout` (con SET LOCAL, para que también
+    funcione detrás del pooler de Supabase en modo transacción).
+    """
+    engine_lectura = create_engine(database_url, **opciones_pool("lectura"))
+    if engine_lectura.dialect.name == "postgresql":
+        @event.listens_for(engine_lectura, "begin")
+        def _transaccion_solo_lectura(conn):
+            # Sin cursor del servidor aunque la conexión tenga stream_results.
+            opciones = {"stream_results": False}
+            conn.exec_driver_sql("SET TRANSACTION READ ONLY", execution_options=opciones)
+            if TIMEOUT_QUERY_LECTURA_MS > 0:
+                conn.exec_driver_sql(
+                    f"SET LOCAL statement_timeout = {TIMEOUT_QUERY_LECTURA_MS}", execution_options=opciones)
+    return engine_lectura
@@ -0,0 +1,147 @@
+import os
+import threading
+from typing import Any, List, Literal, Optional, get_args
+
+import duckdb
+
+import conexiones_db
+import snapshots_parquet
+
+# --- Backend local de /execute_sql_query/: DuckDB sobre el último snapshot Parquet ---
+BackendConsultas = Literal['postgres', 'duckdb']
+BACKENDS_SQL = get_args(BackendConsultas)
+
+
+def validar_backend(backend: str) -> BackendConsultas:
+    """Normaliza `backend` y lanza ValueError si no es uno de BACKENDS_SQL."""
+    normalizado = backend.strip().lower()
+    if normalizado not in BACKENDS_SQL:
+        raise ValueError(f"Backend SQL desconocido: '{backend}'. Valores posibles: {list(BACKENDS_SQL)}.")
+    return normalizado  # type: ignore[return-value]
+
+
+# Backend por defecto (cada petición puede pedir otro con el campo `backend`).
+# Un valor inválido falla al arrancar, no en la primera query.
+BACKEND_SQL: BackendConsultas = validar_backend(os.environ.get("SHERLOCK_SQL_BACKEND", "postgres"))
+# Si PostgreSQL no responde, las queries se atienden con DuckDB (si hay snapshot).
+RESPALDO_LOCAL = os.environ.get(
+    "SHERLOCK_SQL_RESPALDO_LOCAL", "1").strip().lower() not in ("0", "false", "no")
+# Límites opcionales de DuckDB (vacío = los de DuckDB).
+HILOS_DUCKDB = os.environ.get("SHERLOCK_DUCKDB_HILOS", "")
+MEMORIA_DUCKDB = os.environ.get("SHERLOCK_DUCKDB_MEMORIA", "")
+
+# Solo se aceptan consultas (SELECT/WITH/VALUES) y EXPLAIN.
+_TIPOS_PERMITIDOS = {duckdb.StatementType.SELECT, duckdb.StatementType.EXPLAIN}
+
+
+class ErrorConsultaLocal(Exception):
+    """Error de la query en DuckDB (se devuelve como 400, igual que los de SQLAlchemy)."""
+
+
+class ResultadoDuckDB:
+    """
+    Resultado de una query en DuckDB con la misma interfaz que usa el
+    endpoint sobre el de SQLAlchemy (keys, fetchmany, close). Mientras está
+    abierto corre el temporizador de SHERLOCK_SQL_TIMEOUT_MS.
+    """
+    returns_rows = True
+    rowcount = -1
+
+    def __init__(self, cursor: Any, temporizador: Optional[threading.Timer], id_snapshot: str):
+        self._cursor = cursor
+        self._temporizador = temporizador
+        self.id_snapshot = id_snapshot
+
+    def keys(self) -> List[str]:
+        return [columna[0] for columna in self._cursor.description]
+
+    def fetchmany(self, filas: int) -> List[tuple]:
+        try:
+            return self._cursor.fetchmany(filas)
+        except duckdb.Error as e_duckdb:
+            raise ErrorConsultaLocal(str(e_duckdb)) from e_duckdb
+
+    def close(self):
+        if self._temporizador is not None:
+            self._temporizador.cancel()
+        self._cursor.close()
+
+
+class MotorDuckDB:
+    """
+    Base DuckDB en memoria con una vista por tabla del último snapshot
+    (mismos nombres que en Supabase). Cuando aparece un snapshot nuevo se arma
+    otra base; las queries en curso terminan sobre la anterior. La base solo
+    puede leer el directorio de su snapshot y su configuración queda bloqueada.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conexion: Optional[duckdb.DuckDBPyConnection] = None
+        self._id_snapshot: Optional[str] = None
+
+    def _abrir(self, id_snapshot: str) -> duckdb.DuckDBPyConnection:
+        conexion = duckdb.connect(":memory:")
+        directorio = os.path.abspath(snapshots_parquet.directorio_snapshot(id_snapshot))
+        for nombre_tabla in snapshots_parquet.leer_manifiesto(id_snapshot)["tablas"]:
+            rutas = [os.path.abspath(r) for r in snapshots_parquet.archivos_tabla(id_snapshot, nombre_tabla)]
+            if not rutas:
+                continue
+            lista = ", ".join("'" + r.replace("'", "''") + "'" for r in rutas)
+            nombre = nombre_tabla.replace('"', '""')
+            conexion.execute(
+                f'CREATE VIEW "{nombre}" AS SELECT * FROM read_parquet([{lista}], hive_partitioning = false)')
+        if HILOS_DUCKDB:
+            conexion.execute(f"SET threads = {int(HILOS_DUCKDB)}")
+        if MEMORIA_DUCKDB:
+            conexion.execute("SET memory_limit = ?", [MEMORIA_DUCKDB])
+        conexion.execute("SET allowed_directories = ?", [[directorio + os.sep]])
+        conexion.execute("SET enable_external_access = false")
+        conexion.execute("SET lock_configuration = true")
+        print(f"--- Log Sherlock (DuckDB): Vistas creadas sobre el snapshot '{id_snapshot}'.")
+        return conexion
+
+    def cursor(self):
+        """Cursor nuevo (una conexión por petición) sobre el último snapshot."""
+        id_snapshot = snapshots_parquet.ultimo_snapshot()
+        if id_snapshot is None:
+            raise ErrorConsultaLocal("No hay snapshots Parquet para consultar con DuckDB.")
+        with self._lock:
+            if id_snapshot != self._id_snapshot:
+                self._conexion = self._abrir(id_snapshot)
+                self._id_snapshot = id_snapshot
+            return self._conexion.cursor(), id_snapshot
+
+    def ejecutar(self, sql_query: str, limite: Optional[int] = None, desplazamiento: int = 0) -> ResultadoDuckDB:
+        """
+        Ejecuta una query de solo lectura. Con `limite` la envuelve para traer
+        una sola página, como `consultas_sql.sql_paginada` en PostgreSQL.
+        """
+        cursor, id_snapshot = self.cursor()
+        temporizador = None
+        try:
+            sentencias = cursor.extract_statements(sql_query)
+            if len(sentencias) != 1 or sentencias[0].type not in _TIPOS_PERMITIDOS:
+                raise ErrorConsultaLocal("En el backend 'duckdb' solo se permite una consulta SELECT.")
+            if limite is not None:
+                sql_query = (f"SELECT * FROM ({sql_query.strip().rstrip(';')}) AS sherlock_pagina "
+                             f"LIMIT {int(limite)} OFFSET {int(desplazamiento)}")
+            if conexiones_db.TIMEOUT_QUERY_LECTURA_MS > 0:
+                temporizador = threading.Timer(conexiones_db.TIMEOUT_QUERY_LECTURA_MS / 1000, cursor.interrupt)
+                temporizador.daemon = True
+                temporizador.start()
+            cursor.execute(sql_query)
+        except Exception as e_duckdb:
+            if temporizador is not None:
+                temporizador.cancel()
+            cursor.close()
+            if isinstance(e_duckdb, ErrorConsultaLocal):
+                raise
+            if isinstance(e_duckdb, duckdb.Error):
+                raise ErrorConsultaLocal(str(e_duckdb)) from e_duckdb
+            raise
+        return ResultadoDuckDB(cursor, temporizador, id_snapshot)
+
+
+def respaldo_disponible() -> bool:
+    return RESPALDO_LOCAL and snapshots_parquet.ultimo_snapshot() is not None
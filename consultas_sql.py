@@ -0,0 +1,237 @@
+import base64
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Dict, Iterator, List, Literal, Optional, Sequence, Tuple
+
+import pandas as pd
+
+# --- Límites y tamaños para /execute_sql_query/ ---
+# Máximo de filas que se devuelven por petición (por página).
+MAX_FILAS_CONSULTA = int(os.environ.get("SHERLOCK_SQL_MAX_FILAS", 100000))
+# Filas que se traen del cursor del servidor en cada bloque.
+FILAS_POR_BLOQUE_CONSULTA = int(
+    os.environ.get("SHERLOCK_SQL_FILAS_POR_BLOQUE", 5000))
+
+# Caché de resultados: máximo de entradas y de bytes en total (0 la desactiva).
+MAX_ENTRADAS_CACHE = int(os.environ.get("SHERLOCK_CACHE_SQL_ENTRADAS", 256))
+MAX_BYTES_CACHE = int(os.environ.get(
+    "SHERLOCK_CACHE_SQL_MAX_BYTES", 64 * 1024 * 1024))
+
+FormatoRespuesta = Literal['json', 'ndjson']
+MEDIA_TYPES = {'json': "application/json", 'ndjson': "application/x-ndjson"}
+
+
+# --- Cursor de paginación (opaco para el cliente) ---
+def codificar_cursor(desplazamiento: int) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps({"offset": desplazamiento}).encode("utf-8")).decode("ascii")
+
+
+def decodificar_cursor(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    try:
+        desplazamiento = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))["offset"]
+    except Exception:
+        raise ValueError(f"Cursor inválido: '{cursor}'.")
+    if not isinstance(desplazamiento, int) or desplazamiento < 0:
+        raise ValueError(f"Cursor inválido: '{cursor}'.")
+    return desplazamiento
+
+
+def sql_paginada(sql_query: str) -> str:
+    """
+    Envuelve la query para traer una sola página (parámetros :limite y
+    :desplazamiento). Solo sirve para SELECT/WITH; para que las páginas sean
+    estables la query debe tener ORDER BY.
+    """
+    return (f"SELECT * FROM ({sql_query.strip().rstrip(';')}) AS sherlock_pagina "
+            f"LIMIT :limite OFFSET :desplazamiento")
+
+
+# --- Serialización de filas ---
+def serializar_filas(filas: Sequence[Any], columnas: List[str], formato: FormatoRespuesta) -> str:
+    """
+    Serializa un bloque de filas con `to_json` (mismo formato de fechas y
+    nulos que la respuesta completa). En 'json' devuelve los objetos separados
+    por comas, sin corchetes, para poder concatenar bloques dentro de un arreglo.
+    """
+    if not filas:
+        return ""
+    df_bloque = pd.DataFrame(filas, columns=columnas)
+    if formato == 'ndjson':
+        return df_bloque.to_json(orient='records', date_format='iso', lines=True).rstrip("\n") + "\n"
+    return df_bloque.to_json(orient='records', date_format='iso')[1:-1]
+
+
+def generar_respuesta(primer_bloque: Sequence[Any], resto_bloques: Iterator[Sequence[Any]],
+                      columnas: List[str], formato: FormatoRespuesta) -> Iterator[str]:
+    """Produce el cuerpo de la respuesta bloque por bloque ('json' = un arreglo)."""
+    if formato == 'json':
+        yield "["
+    separador = ""
+    for filas in _encadenar(primer_bloque, resto_bloques):
+        texto = serializar_filas(filas, columnas, formato)
+        if not texto:
+            continue
+        yield separador + texto
+        if formato == 'json':
+            separador = ","
+    if formato == 'json':
+        yield "]"
+
+
+def _encadenar(primero: Sequence[Any], resto: Iterator[Sequence[Any]]) -> Iterator[Sequence[Any]]:
+    yield primero
+    yield from resto
+
+
+def bloques_limitados(result: Any, maximo_filas: int, filas_por_bloque: int) -> Iterator[List[Any]]:
+    """Lee el resultado en bloques de `filas_por_bloque` sin pasar de `maximo_filas`."""
+    restantes = maximo_filas
+    while restantes > 0:
+        filas = result.fetchmany(min(filas_por_bloque, restantes))
+        if not filas:
+            return
+        restantes -= len(filas)
+        yield filas
+
+
+def cerrar_al_terminar(cuerpo: Iterator[str], connection: Any) -> Iterator[str]:
+    """Mantiene la conexión abierta mientras se envía la respuesta y la cierra al final."""
+    try:
+        yield from cuerpo
+    except Exception as e_stream:
+        print(f"--- Log Sherlock (SQL): ERROR durante el streaming de la respuesta: {e_stream}")
+        raise
+    finally:
+        connection.close()
+
+
+# --- Caché LRU de resultados de queries de solo lectura ---
+_PATRON_COMENTARIOS = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_PATRON_LITERALES = re.compile(r"'(?:[^']|'')*'")
+_PATRON_ESCRITURA = re.compile(
+    r"\b(insert|update|delete|merge|upsert|truncate|drop|alter|create|grant|revoke|"
+    r"copy|call|do|vacuum|analyze|refresh|lock|set|reset|into|for\s+update|for\s+share|"
+    r"nextval|setval|pg_sleep)\b", re.IGNORECASE)
+# Funciones que dependen del momento de la consulta: las de fecha se pueden
+# cachear durante el día; las demás no se cachean.
+_PATRON_VOLATIL_DIA = re.compile(r"\b(current_date)\b", re.IGNORECASE)
+_PATRON_VOLATIL = re.compile(
+    r"\b(now|current_time|current_timestamp|localtime|localtimestamp|clock_timestamp|"
+    r"statement_timestamp|transaction_timestamp|timeofday|random|gen_random_uuid)\b",
+    re.IGNORECASE)
+
+
+def normalizar_sql(sql_query: str) -> str:
+    """
+    Quita comentarios, espacios sobrantes y el ';' final, sin tocar el
+    contenido de los literales entre comillas simples.
+    """
+    partes = []
+    ultimo = 0
+    for literal in _PATRON_LITERALES.finditer(sql_query):
+        partes.append(_normalizar_fragmento(sql_query[ultimo:literal.start()]))
+        partes.append(literal.group(0))
+        ultimo = literal.end()
+    partes.append(_normalizar_fragmento(sql_query[ultimo:]))
+    return "".join(partes).strip().rstrip(";").strip()
+
+
+def _normalizar_fragmento(fragmento: str) -> str:
+    return re.sub(r"\s+", " ", _PATRON_COMENTARIOS.sub(" ", fragmento))
+
+
+def admite_cursor_servidor(sql_query: str) -> bool:
+    """
+    Un cursor del servidor (DECLARE ... CURSOR) solo acepta SELECT, WITH,
+    VALUES o TABLE; el resto de las sentencias se ejecutan sin streaming.
+    """
+    sin_literales = _PATRON_LITERALES.sub("''", normalizar_sql(sql_query))
+    return re.match(r"^\(*\s*(select|with|values|table)\b", sin_literales, re.IGNORECASE) is not None
+
+
+def clave_cache_consulta(sql_query: str, limite: int, desplazamiento: int) -> Optional[str]:
+    """
+    Clave de caché de una query o None si no se puede cachear: solo SELECT/WITH
+    sin sentencias de escritura ni funciones volátiles.
+    """
+    sql_normalizada = normalizar_sql(sql_query)
+    sin_literales = _PATRON_LITERALES.sub("''", sql_normalizada)
+    if not re.match(r"^\(*\s*(select|with)\b", sin_literales, re.IGNORECASE):
+        return None
+    if ";" in sin_literales or _PATRON_ESCRITURA.search(sin_literales) or _PATRON_VOLATIL.search(sin_literales):
+        return None
+    dia = date.today().isoformat() if _PATRON_VOLATIL_DIA.search(sin_literales) else ""
+    return f"{limite}|{desplazamiento}|{dia}|{sql_normalizada}"
+
+
+class CacheConsultas:
+    """
+    Caché LRU (por entradas y por bytes) de respuestas JSON ya serializadas.
+    Cada entrada guarda la generación de carga con la que se calculó; si el
+    ETL escribió tablas después, la entrada se descarta al consultarla.
+    """
+
+    def __init__(self, max_entradas: int = MAX_ENTRADAS_CACHE, max_bytes: int = MAX_BYTES_CACHE):
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self._entradas: "OrderedDict[str, Tuple[int, str, Dict[str, str]]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.no_cacheables = 0
+        self.invalidadas = 0
+        self.desalojadas = 0
+
+    @property
+    def activa(self) -> bool:
+        return self.max_entradas > 0 and self.max_bytes > 0
+
+    def obtener(self, clave: Optional[str], generacion: int) -> Optional[Tuple[str, Dict[str, str]]]:
+        with self._lock:
+            if clave is None:
+                self.no_cacheables += 1
+                return None
+            entrada = self._entradas.get(clave)
+            if entrada is not None and entrada[0] != generacion:
+                self._quitar(clave)
+                self.invalidadas += 1
+                entrada = None
+            if entrada is None:
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[1], entrada[2]
+
+    def guardar(self, clave: Optional[str], generacion: int, contenido: str, cabeceras: Dict[str, str]):
+        if clave is None or not self.activa or len(contenido) > self.max_bytes:
+            return
+        with self._lock:
+            if clave in self._entradas:
+                self._quitar(clave)
+            self._entradas[clave] = (generacion, contenido, dict(cabeceras))
+            self._bytes += len(contenido)
+            while len(self._entradas) > self.max_entradas or self._bytes > self.max_bytes:
+                self._quitar(next(iter(self._entradas)))
+                self.desalojadas += 1
+
+    def _quitar(self, clave: str):
+        self._bytes -= len(self._entradas.pop(clave)[1])
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            consultas = self.aciertos + self.fallos
+            return {"activa": self.activa, "entradas": len(self._entradas), "bytes": self._bytes,
+                    "max_entradas": self.max_entradas, "max_bytes": self.max_bytes,
+                    "aciertos": self.aciertos, "fallos": self.fallos,
+                    "tasa_aciertos": round(self.aciertos / consultas, 4) if consultas else 0.0,
+                    "no_cacheables": self.no_cacheables, "invalidadas": self.invalidadas,
+                    "desalojadas": self.desalojadas}
@@ -0,0 +1,219 @@
+import hashlib
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+from sqlalchemy import text
+
+from agregados_kpi import AGREGADOS_KPI, COLUMNA_MES
+
+# --- Diseño físico de las tablas del warehouse ---
+# Cada carga 'replace' vuelve a crear las tablas, así que las claves y los
+# índices se declaran aquí y el escritor (escritor_postgres.escribir_df) los
+# aplica después de cada escritura, seguido de ANALYZE. Sin esto, las queries
+# del asistente sobre las tablas de hechos recorren la tabla completa.
+
+# Filas desde las que una tabla de hechos con `particion_por` se crea
+# particionada por año (en tablas chicas las particiones no pagan su costo).
+FILAS_MIN_PARTICION = int(os.environ.get("SHERLOCK_FILAS_MIN_PARTICION", 1_000_000))
+# Motores en los que se aplican claves, índices y ANALYZE.
+DIALECTOS_CON_DISENO = ("postgresql", "sqlite")
+# Largo máximo de un identificador en PostgreSQL.
+_LARGO_MAX_NOMBRE = 63
+
+
+@dataclass(frozen=True)
+class DisenoTabla:
+    """
+    Diseño físico de una tabla. `clave_primaria` se aplica solo si los
+    valores son únicos y no nulos (si no, queda como índice común);
+    `indices` son las columnas por las que se filtra o se une;
+    `particion_por` es la columna de fecha por la que se particiona por año.
+    """
+    clave_primaria: Tuple[str, ...] = ()
+    indices: Tuple[Tuple[str, ...], ...] = ()
+    particion_por: Optional[str] = None
+
+
+DISENO_TABLAS: Dict[str, DisenoTabla] = {
+    # Dimensiones (tablas de procesador_datos.DIMENSION_MAPPING).
+    "dimension_procedimientos": DisenoTabla(("ID_Procedimiento",)),
+    "dimension_sucursales": DisenoTabla(("Sucursal",)),
+    "dimension_medios_de_pago": DisenoTabla(("Medio_de_pago_Key",)),
+    "dimension_tipos_pacientes": DisenoTabla(("Tipo_Dentalink",)),
+    "dimension_tratamientos_generados": DisenoTabla(
+        ("ID_Tratamiento",), (("ID_Paciente",), ("Sucursal",))),
+    # Hechos.
+    "hechos_pacientes": DisenoTabla(("ID_Paciente",)),
+    "hechos_citas": DisenoTabla(
+        ("ID_Cita",),
+        (("ID_Paciente",), ("ID_Tratamiento",), ("Sucursal",), ("Fecha_Cita",)),
+        particion_por="Fecha_Cita"),
+    "hechos_presupuesto_detalle": DisenoTabla(
+        ("ID_Detalle_Presupuesto",),
+        (("ID_Paciente",), ("ID_Tratamiento",), ("Sucursal",), ("ID_Procedimiento",),
+         ("Tratamiento_fecha_de_generacion",)),
+        particion_por="Tratamiento_fecha_de_generacion"),
+    "hechos_acciones_realizadas": DisenoTabla(
+        ("ID_Accion_Unico",),
+        (("ID_Paciente",), ("ID_Tratamiento",), ("ID_Detalle_Presupuesto",), ("Sucursal",),
+         ("Procedimiento_Fecha_Realizacion",)),
+        particion_por="Procedimiento_Fecha_Realizacion"),
+    "hechos_pagos_transacciones": DisenoTabla(
+        ("ID_Pago",), (("ID_Paciente",), ("Sucursal",), ("Pago_fecha_recepcion",)),
+        particion_por="Pago_fecha_recepcion"),
+    "hechos_pagos_aplicaciones_detalle": DisenoTabla(
+        ("ID_Pago", "ID_Detalle_Presupuesto"), (("ID_Detalle_Presupuesto",), ("Sucursal",))),
+    "hechos_gastos": DisenoTabla(
+        ("ID_Gasto_Unico",), (("Sucursal",), ("Fecha_del_Gasto",)),
+        particion_por="Fecha_del_Gasto"),
+    # Las tablas KPI tienen una fila por mes y columnas de agrupación.
+    **{nombre: DisenoTabla((COLUMNA_MES, *definicion['por']), (("Sucursal",),))
+       for nombre, definicion in AGREGADOS_KPI.items()},
+}
+
+
+def _nombre(prefijo: str, tabla: str, columnas: Tuple[str, ...] = ()) -> str:
+    """Nombre de índice o restricción; si es muy largo se acorta con un hash."""
+    nombre = "_".join((prefijo, tabla, *columnas))
+    if len(nombre) <= _LARGO_MAX_NOMBRE:
+        return nombre
+    huella = hashlib.sha1(nombre.encode("utf-8")).hexdigest()[:8]
+    return f"{nombre[:_LARGO_MAX_NOMBRE - 9]}_{huella}"
+
+
+def _columnas_sql(columnas: Tuple[str, ...]) -> str:
+    return ", ".join(f'"{col}"' for col in columnas)
+
+
+# --- Particiones por año (solo PostgreSQL, en la ruta con COPY) ---
+def columna_particion(diseno: Optional[DisenoTabla], df: pd.DataFrame) -> Optional[str]:
+    """Columna por la que se particiona `df`, o None si no corresponde."""
+    if diseno is None or diseno.particion_por is None or len(df) < FILAS_MIN_PARTICION:
+        return None
+    columna = diseno.particion_por
+    if columna not in df.columns or not pd.api.types.is_datetime64_any_dtype(df[columna]):
+        return None
+    return columna
+
+
+def sentencias_particiones(tabla: str, df: pd.DataFrame, columna: str) -> List[str]:
+    """
+    Una partición por cada año con datos y una DEFAULT para las fechas nulas
+    y para los años que traigan las cargas incrementales siguientes (ver
+    sentencias_diseno).
+    """
+    anios = sorted(int(anio) for anio in df[columna].dropna().dt.year.unique())
+    sentencias = [
+        f'CREATE TABLE "{tabla}_p{anio}" PARTITION OF "{tabla}" '
+        f"FOR VALUES FROM ('{anio}-01-01') TO ('{anio + 1}-01-01')" for anio in anios]
+    sentencias.append(f'CREATE TABLE "{tabla}_pdefault" PARTITION OF "{tabla}" DEFAULT')
+    return sentencias
+
+
+def renombrar_particiones(conn: Any, tabla_origen: str, tabla_destino: str):
+    """Renombra las particiones de la tabla de staging junto con la tabla."""
+    particiones = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = CAST(:tabla AS regclass)"), {"tabla": f'"{tabla_destino}"'}).scalars().all()
+    for particion in particiones:
+        if particion.startswith(f"{tabla_origen}_p"):
+            nuevo = tabla_destino + particion[len(tabla_origen):]
+            conn.execute(text(f'ALTER TABLE "{particion}" RENAME TO "{nuevo}"'))
+
+
+def _esta_particionada(conn: Any, tabla: str) -> bool:
+    if conn.dialect.name != "postgresql":
+        return False
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = CAST(:tabla AS regclass)"),
+        {"tabla": f'"{tabla}"'}).first() is not None
+
+
+# --- Claves, índices y ANALYZE ---
+def _motivo_clave_invalida(df: pd.DataFrame, columnas: Tuple[str, ...]) -> Optional[str]:
+    faltantes = [col for col in columnas if col not in df.columns]
+    if faltantes:
+        return f"faltan columnas {faltantes}"
+    if df[list(columnas)].isna().any().any():
+        return "hay valores nulos"
+    if df.duplicated(subset=list(columnas)).any():
+        return "hay valores duplicados"
+    return None
+
+
+def sentencias_diseno(tabla: str, df: pd.DataFrame, diseno: DisenoTabla, dialecto: str,
+                      tabla_nueva: bool, particionada: bool) -> Tuple[List[str], List[str]]:
+    """
+    Devuelve (sentencias, avisos) con la clave primaria y los índices de
+    `tabla`. La clave primaria solo se agrega a una tabla recién creada; en
+    PostgreSQL es una PRIMARY KEY y en SQLite un índice único. Una tabla
+    particionada no admite una clave que no incluya la columna de partición,
+    así que ahí la clave queda como índice común (la unicidad ya se validó
+    con pandas). Los índices usan IF NOT EXISTS: también se crean sobre una
+    tabla existente que se carga en modo 'append'.
+
+    Las particiones por año solo se crean en una carga 'replace': en modo
+    'append' (carga incremental) las filas de un año nuevo caen en la
+    partición `_pdefault` y se quedan ahí hasta la próxima carga 'replace',
+    que vuelve a crear una partición por año. Mientras tanto las queries de
+    esos años no aprovechan la poda de particiones.
+    """
+    sentencias: List[str] = []
+    avisos: List[str] = []
+    indices = list(diseno.indices)
+    if diseno.clave_primaria and tabla_nueva:
+        motivo = _motivo_clave_invalida(df, diseno.clave_primaria)
+        if motivo is not None:
+            avisos.append(f"sin clave primaria {list(diseno.clave_primaria)} ({motivo})")
+            if not motivo.startswith("faltan"):
+                indices.insert(0, diseno.clave_primaria)
+        elif particionada:
+            indices.insert(0, diseno.clave_primaria)
+        elif dialecto == "postgresql":
+            sentencias.append(
+                f'ALTER TABLE "{tabla}" ADD CONSTRAINT "{_nombre("pk", tabla)}" '
+                f"PRIMARY KEY ({_columnas_sql(diseno.clave_primaria)})")
+        else:
+            sentencias.append(
+                f'CREATE UNIQUE INDEX IF NOT EXISTS "{_nombre("pk", tabla)}" '
+                f'ON "{tabla}" ({_columnas_sql(diseno.clave_primaria)})')
+    for columnas in dict.fromkeys(indices):
+        faltantes = [col for col in columnas if col not in df.columns]
+        if faltantes:
+            avisos.append(f"sin índice {list(columnas)} (faltan columnas {faltantes})")
+            continue
+        sentencias.append(
+            f'CREATE INDEX IF NOT EXISTS "{_nombre("ix", tabla, columnas)}" '
+            f'ON "{tabla}" ({_columnas_sql(columnas)})')
+    return sentencias, avisos
+
+
+def aplicar_diseno(conn: Any, tabla: str, df: pd.DataFrame, tabla_nueva: bool,
+                   analizar: bool = True) -> Dict[str, Any]:
+    """
+    Aplica el diseño de DISENO_TABLAS a `tabla` (ya escrita en la transacción
+    de `conn`) y actualiza sus estadísticas con ANALYZE. Cada sentencia corre
+    en un savepoint: si una falla, se avisa y la carga sigue.
+    """
+    resumen = {"sentencias": 0, "avisos": []}
+    if conn.dialect.name not in DIALECTOS_CON_DISENO:
+        return resumen
+    sentencias: List[str] = []
+    diseno = DISENO_TABLAS.get(tabla)
+    if diseno is not None:
+        sentencias, resumen["avisos"] = sentencias_diseno(
+            tabla, df, diseno, conn.dialect.name, tabla_nueva, _esta_particionada(conn, tabla))
+    if analizar:
+        sentencias.append(f'ANALYZE "{tabla}"')
+    for sentencia in sentencias:
+        try:
+            with conn.begin_nested():
+                conn.execute(text(sentencia))
+            resumen["sentencias"] += 1
+        except Exception as e_diseno:
+            resumen["avisos"].append(f"falló '{sentencia}': {e_diseno}")
+    for aviso in resumen["avisos"]:
+        print(f"ADVERTENCIA (diseño de tablas): '{tabla}': {aviso}")
+    return resumen
@@ -0,0 +1,376 @@
+import functools
+import glob
+import hashlib
+import marshal
+import os
+import pickle
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+# --- Ejecución de pasos como grafo (DAG) ---
+# Cada paso declara las tablas que lee (`entradas`) y las que produce
+# (`salidas`). Si un paso falla, solo se omiten los pasos que dependen de él.
+
+# Hilos del pool (1 = en orden, en el hilo que llama). Con más de uno, los
+# pasos independientes corren a la vez y cada uno recibe una copia
+# superficial de las tablas que lee: con Copy-on-Write los datos se comparten
+# hasta que el paso los modifica. Sin CoW habría que copiarlas completas (más
+# lento y con más memoria que correr en orden), así que los pasos van en orden.
+HILOS_PASOS = int(os.environ.get("SHERLOCK_HILOS_PASOS", min(4, os.cpu_count() or 1)))
+# Reutiliza la salida de un paso si sus entradas no cambiaron desde la última corrida.
+CACHE_PASOS = os.environ.get(
+    "SHERLOCK_CACHE_PASOS", "1").strip().lower() not in ("0", "false", "no")
+# Solo se guarda un paso que tarda más en ejecutarse que en leer su salida
+# del disco, estimado con esta velocidad de lectura (bytes por segundo).
+BYTES_POR_SEGUNDO_CACHE = int(os.environ.get("SHERLOCK_CACHE_PASOS_BYTES_S", 200 * 1024 ** 2))
+# Límites de la caché de pasos: al pasarlos se borran primero las entradas
+# que hace más tiempo no se usan.
+MAX_BYTES_CACHE_PASOS = int(os.environ.get("SHERLOCK_CACHE_PASOS_MAX_BYTES", 2 * 1024 ** 3))
+MAX_DIAS_CACHE_PASOS = float(os.environ.get("SHERLOCK_CACHE_PASOS_MAX_DIAS", 7))
+# Cambiar este número invalida la caché de todos los pasos (el código de los
+# módulos del proyecto ya entra en la huella; esto es para otros cambios).
+VERSION_PASOS = 1
+# Módulos cuyo código entra en la huella de cada paso: los .py del proyecto.
+DIRECTORIO_CODIGO = os.path.dirname(os.path.abspath(__file__))
+
+ESTADO_OK = "ok"
+ESTADO_CACHE = "cache"
+ESTADO_FALLIDO = "fallido"
+ESTADO_OMITIDO = "omitido"
+
+
+@dataclass(frozen=True)
+class Paso:
+    """
+    Un paso del grafo. `funcion(entradas, advertencias, **parametros)` recibe
+    solo las tablas declaradas que existan y devuelve {tabla: DataFrame} con
+    tablas de `salidas` (puede omitir alguna si no se pudo generar).
+    Las tablas de `opcionales` también se esperan y se entregan si existen,
+    pero si el paso que las produce falla, este paso corre igual sin ellas.
+    """
+    nombre: str
+    entradas: Tuple[str, ...]
+    salidas: Tuple[str, ...]
+    funcion: Callable[..., Dict[str, pd.DataFrame]]
+    parametros: Dict[str, Any] = field(default_factory=dict)
+    opcionales: Tuple[str, ...] = ()
+
+
+@dataclass
+class ResultadoPaso:
+    nombre: str
+    estado: str
+    segundos: float = 0.0
+    tablas: Dict[str, pd.DataFrame] = field(default_factory=dict)
+    advertencias: List[str] = field(default_factory=list)
+    huella: Optional[str] = None
+
+
+def validar_grafo(pasos: List[Paso]) -> Dict[str, str]:
+    """Devuelve {tabla: paso que la produce}; falla si hay salidas repetidas o ciclos."""
+    productores: Dict[str, str] = {}
+    for paso in pasos:
+        for tabla in paso.salidas:
+            if tabla in productores:
+                raise ValueError(f"La tabla '{tabla}' la producen '{productores[tabla]}' y '{paso.nombre}'.")
+            productores[tabla] = paso.nombre
+    pendientes = {p.nombre: {productores[t] for t in (*p.entradas, *p.opcionales) if t in productores}
+                  for p in pasos}
+    while pendientes:
+        listos = [nombre for nombre, previos in pendientes.items() if not previos & pendientes.keys()]
+        if not listos:
+            raise ValueError(f"Los pasos {sorted(pendientes)} forman un ciclo.")
+        for nombre in listos:
+            del pendientes[nombre]
+    return productores
+
+
+# --- Huellas y caché de salidas ---
+def huella_tabla(df: pd.DataFrame) -> Optional[str]:
+    """Hash del contenido, columnas y tipos de una tabla (None si no se puede calcular)."""
+    try:
+        huella = hashlib.sha256(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    except (TypeError, ValueError):
+        return None
+    huella.update(repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode("utf-8"))
+    return huella.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def huella_codigo() -> str:
+    """
+    Hash del código de los módulos del proyecto. Los pasos llaman a funciones
+    auxiliares y leen definiciones de otros módulos (ej. etiquetar_citas,
+    optimizacion_tipos, AGREGADOS_KPI): un cambio en cualquiera invalida la caché.
+    """
+    huella = hashlib.sha256()
+    for ruta in sorted(glob.glob(os.path.join(DIRECTORIO_CODIGO, "*.py"))):
+        huella.update(os.path.basename(ruta).encode("utf-8"))
+        with open(ruta, "rb") as f:
+            huella.update(f.read())
+    return huella.hexdigest()
+
+
+def _huella_paso(paso: Paso, huellas_entradas: Dict[str, Optional[str]]) -> Optional[str]:
+    if any(h is None for h in huellas_entradas.values()):
+        return None
+    huella = hashlib.sha256(f"{VERSION_PASOS}|{huella_codigo()}|{paso.nombre}".encode("utf-8"))
+    funcion = getattr(paso.funcion, "func", paso.funcion)  # functools.partial
+    codigo = getattr(funcion, "__code__", None)
+    if codigo is not None:
+        huella.update(marshal.dumps(codigo))
+    huella.update(repr(sorted(paso.parametros.items())).encode("utf-8"))
+    huella.update(repr(sorted(huellas_entradas.items())).encode("utf-8"))
+    return huella.hexdigest()
+
+
+def _directorio_cache_pasos(directorio_cache: str) -> Optional[str]:
+    """
+    Directorio de la caché de pasos, solo si es privado de este usuario: la
+    caché se lee con pickle y no puede venir de un directorio compartido.
+    """
+    directorio = os.path.join(directorio_cache, "pasos")
+    try:
+        os.makedirs(directorio, mode=0o700, exist_ok=True)
+        estado = os.stat(directorio)
+    except OSError as e_cache:
+        print(f"ADVERTENCIA: No se pudo usar la caché de pasos '{directorio}': {e_cache}")
+        return None
+    if hasattr(os, "getuid") and (estado.st_uid != os.getuid() or estado.st_mode & 0o022):
+        print(f"ADVERTENCIA: Caché de pasos desactivada: '{directorio}' no es un directorio privado.")
+        return None
+    return directorio
+
+
+_LARGO_HUELLA_ARCHIVO = 32
+
+
+def _ruta_cache(directorio: str, paso: Paso, huella: str) -> str:
+    # La huella va en el nombre: si no coincide, no hace falta abrir el archivo.
+    return os.path.join(directorio, f"{paso.nombre.replace(':', '_')}-{huella[:_LARGO_HUELLA_ARCHIVO]}.pkl")
+
+
+def _es_entrada_de(nombre_archivo: str, paso: Paso) -> bool:
+    base, extension = os.path.splitext(nombre_archivo)
+    return extension == ".pkl" and base[:-_LARGO_HUELLA_ARCHIVO - 1] == paso.nombre.replace(':', '_')
+
+
+def _leer_cache(directorio: str, paso: Paso, huella: str) -> Optional[Dict[str, Any]]:
+    ruta = _ruta_cache(directorio, paso, huella)
+    if not os.path.exists(ruta):
+        return None
+    try:
+        with open(ruta, "rb") as f:
+            guardado = pickle.load(f)
+        os.utime(ruta)  # Marca la entrada como usada (la poda borra primero las más viejas).
+        return guardado if guardado.get("huella") == huella else None
+    except Exception as e_cache:
+        print(f"ADVERTENCIA: No se pudo leer la caché del paso '{paso.nombre}': {e_cache}")
+        return None
+
+
+def _borrar_cache(directorio: str, paso: Paso, conservar: Optional[str] = None):
+    """Borra las entradas de `paso` (menos `conservar`): de cada paso queda a lo sumo una."""
+    for nombre in os.listdir(directorio):
+        ruta = os.path.join(directorio, nombre)
+        if _es_entrada_de(nombre, paso) and ruta != conservar:
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+
+def _conviene_cache(resultado: ResultadoPaso) -> bool:
+    """True si el paso tardó más de lo que tardaría leer su salida del disco."""
+    nbytes = sum(int(df.memory_usage(index=True, deep=True).sum()) for df in resultado.tablas.values())
+    return resultado.segundos > nbytes / BYTES_POR_SEGUNDO_CACHE and nbytes <= MAX_BYTES_CACHE_PASOS
+
+
+def _guardar_cache(directorio: str, paso: Paso, resultado: ResultadoPaso):
+    ruta = _ruta_cache(directorio, paso, resultado.huella)
+    try:
+        if not _conviene_cache(resultado):
+            _borrar_cache(directorio, paso)
+            return
+        with open(ruta + ".tmp", "wb") as f:
+            pickle.dump({"huella": resultado.huella, "tablas": resultado.tablas,
+                         "advertencias": resultado.advertencias}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(ruta + ".tmp", ruta)
+        _borrar_cache(directorio, paso, conservar=ruta)
+    except Exception as e_cache:
+        print(f"ADVERTENCIA: No se guardó en caché el paso '{paso.nombre}': {e_cache}")
+
+
+def podar_cache(directorio: str):
+    """
+    Borra las entradas sin usar hace más de SHERLOCK_CACHE_PASOS_MAX_DIAS y,
+    si la caché sigue pasando SHERLOCK_CACHE_PASOS_MAX_BYTES, las usadas hace más tiempo.
+    """
+    entradas = []
+    for nombre in os.listdir(directorio):
+        ruta = os.path.join(directorio, nombre)
+        try:
+            estado = os.stat(ruta)
+        except OSError:
+            continue
+        entradas.append((estado.st_mtime, estado.st_size, ruta))
+    limite_edad = time.time() - MAX_DIAS_CACHE_PASOS * 86400
+    total = sum(tamano for _, tamano, _ in entradas)
+    for modificado, tamano, ruta in sorted(entradas):
+        if modificado >= limite_edad and total <= MAX_BYTES_CACHE_PASOS:
+            break
+        try:
+            os.remove(ruta)
+            total -= tamano
+        except OSError:
+            pass
+
+
+# --- Ejecución ---
+def _correr_paso(paso: Paso, entradas: Dict[str, pd.DataFrame], huella: Optional[str],
+                 directorio_cache: Optional[str],
+                 al_producir: Optional[Callable[[str, pd.DataFrame], pd.DataFrame]]) -> ResultadoPaso:
+    inicio = time.perf_counter()
+    if huella is not None and directorio_cache:
+        guardado = _leer_cache(directorio_cache, paso, huella)
+        if guardado is not None:
+            print(f"    - Paso '{paso.nombre}': entradas sin cambios, se toma de la caché.")
+            return ResultadoPaso(paso.nombre, ESTADO_CACHE, time.perf_counter() - inicio,
+                                 guardado["tablas"], guardado["advertencias"], huella)
+    advertencias: List[str] = []
+    try:
+        tablas = paso.funcion(entradas, advertencias, **paso.parametros) or {}
+        desconocidas = set(tablas) - set(paso.salidas)
+        if desconocidas:
+            raise ValueError(f"El paso devolvió tablas no declaradas: {sorted(desconocidas)}")
+        tablas = {nombre: df for nombre, df in tablas.items() if df is not None}
+        if al_producir is not None:
+            tablas = {nombre: al_producir(nombre, df) for nombre, df in tablas.items()}
+    except Exception as e_paso:
+        print(f"--- Log Sherlock (BG Task - pasos): ERROR en el paso '{paso.nombre}': {e_paso}")
+        traceback.print_exc()
+        advertencias.append(f"ERROR en el paso '{paso.nombre}': {e_paso}")
+        return ResultadoPaso(paso.nombre, ESTADO_FALLIDO, time.perf_counter() - inicio,
+                             advertencias=advertencias)
+    resultado = ResultadoPaso(paso.nombre, ESTADO_OK, time.perf_counter() - inicio, tablas, advertencias, huella)
+    if huella is not None and directorio_cache:
+        _guardar_cache(directorio_cache, paso, resultado)
+    return resultado
+
+
+def _copia_para_hilo(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Copia superficial de una tabla para un paso que corre en otro hilo (con
+    CoW los datos se comparten sin riesgo). Los ejes sí se copian: su tabla
+    hash de búsqueda se arma la primera vez que se usa y pandas no la
+    protege entre hilos.
+    """
+    copia = df.copy(deep=False)
+    copia.index = df.index.copy(deep=True)
+    copia.columns = df.columns.copy(deep=True)
+    return copia
+
+
+def ejecutar_pasos(
+    pasos: List[Paso], tablas_iniciales: Dict[str, pd.DataFrame], advertencias: List[str],
+    hilos: int = HILOS_PASOS, directorio_cache: Optional[str] = None,
+    al_producir: Optional[Callable[[str, pd.DataFrame], pd.DataFrame]] = None
+) -> Tuple[Dict[str, pd.DataFrame], List[ResultadoPaso]]:
+    """
+    Ejecuta el grafo y devuelve (tablas producidas, resultado de cada paso).
+    Las tablas salen en el orden de los pasos y las advertencias se agregan
+    en ese mismo orden, así no dependen de cuál terminó primero.
+    `al_producir(tabla, df)` se aplica a cada salida en el hilo del paso.
+    Con `directorio_cache` (y SHERLOCK_CACHE_PASOS) un paso cuyas entradas
+    y cuyo código tienen la misma huella que en la corrida anterior no se
+    vuelve a ejecutar. Solo se guardan los pasos que tardan más que leer su
+    salida del disco, y la caché se poda por antigüedad y tamaño.
+    """
+    productores = validar_grafo(pasos)
+    por_nombre = {p.nombre: p for p in pasos}
+    dependencias = {p.nombre: {productores[t] for t in p.entradas if t in productores} for p in pasos}
+    esperas = {p.nombre: dependencias[p.nombre] | {productores[t] for t in p.opcionales if t in productores}
+               for p in pasos}
+    directorio_pasos = _directorio_cache_pasos(directorio_cache) if directorio_cache and CACHE_PASOS else None
+    usar_cache = directorio_pasos is not None
+    if not pd.get_option("mode.copy_on_write"):
+        hilos = 1
+    huellas_tablas: Dict[str, Optional[str]] = {}
+    if usar_cache:
+        fuentes = {t for p in pasos for t in (*p.entradas, *p.opcionales)
+                   if t not in productores and t in tablas_iniciales}
+        huellas_tablas = {t: huella_tabla(tablas_iniciales[t]) for t in fuentes}
+    tablas: Dict[str, pd.DataFrame] = {}
+    resultados: Dict[str, ResultadoPaso] = {}
+    bloqueo = threading.Lock()
+
+    def preparar(paso: Paso) -> Tuple[Dict[str, pd.DataFrame], Optional[str]]:
+        """Corre en el hilo que llama: con el pool, las copias se hacen antes de repartir los pasos."""
+        entradas = {}
+        for t in (*paso.entradas, *paso.opcionales):
+            origen = tablas if t in productores else tablas_iniciales
+            if t in origen:
+                entradas[t] = _copia_para_hilo(origen[t]) if hilos > 1 else origen[t]
+        huella = None
+        if usar_cache:
+            huella = _huella_paso(paso, {t: huellas_tablas.get(t, "ausente")
+                                         for t in (*paso.entradas, *paso.opcionales)})
+        return entradas, huella
+
+    def registrar(resultado: ResultadoPaso):
+        with bloqueo:
+            resultados[resultado.nombre] = resultado
+            tablas.update(resultado.tablas)
+            for t in por_nombre[resultado.nombre].salidas:
+                huellas_tablas[t] = (f"{resultado.huella}:{t}" if resultado.huella and t in resultado.tablas
+                                     else "ausente" if resultado.huella else None)
+
+    def listos() -> List[Paso]:
+        """Pasos sin ejecutar cuyas dependencias terminaron; omite los que dependen de un fallo."""
+        salida = []
+        for paso in pasos:
+            if paso.nombre in resultados or paso.nombre in en_curso:
+                continue
+            if not esperas[paso.nombre] <= resultados.keys():
+                continue
+            fallidos = [p for p in dependencias[paso.nombre]
+                        if resultados[p].estado in (ESTADO_FALLIDO, ESTADO_OMITIDO)]
+            if fallidos:
+                registrar(ResultadoPaso(paso.nombre, ESTADO_OMITIDO, advertencias=[
+                    f"ADVERTENCIA: Se omitió el paso '{paso.nombre}' porque falló {sorted(fallidos)}."]))
+                return listos()
+            salida.append(paso)
+        return salida
+
+    en_curso: Dict[str, Future] = {}
+    if hilos <= 1:
+        while len(resultados) < len(pasos):
+            for paso in listos():
+                registrar(_correr_paso(paso, *preparar(paso), directorio_pasos,
+                                       al_producir))
+    else:
+        with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="sherlock-paso") as pool:
+            while len(resultados) < len(pasos):
+                for paso in listos():
+                    en_curso[paso.nombre] = pool.submit(
+                        _correr_paso, paso, *preparar(paso), directorio_pasos,
+                        al_producir)
+                if not en_curso:
+                    continue
+                terminados, _ = wait(en_curso.values(), return_when=FIRST_COMPLETED)
+                for nombre in [n for n, futuro in en_curso.items() if futuro in terminados]:
+                    registrar(en_curso.pop(nombre).result())
+
+    if usar_cache:
+        podar_cache(directorio_pasos)
+    ordenados = [resultados[p.nombre] for p in pasos]
+    for resultado in ordenados:
+        advertencias.extend(resultado.advertencias)
+    salida = {t: tablas[t] for p in pasos for t in p.salidas if t in tablas}
+    return salida, ordenados
@@ -0,0 +1,184 @@
+import time
+import pandas as pd
+from typing import Any, Dict, Literal, Optional
+from sqlalchemy import inspect, text
+from sqlalchemy.types import (BigInteger, Boolean, Date, DateTime, Float, Interval,
+                              SmallInteger, Text, Time, TypeEngine)
+
+import diseno_tablas
+import optimizacion_tipos
+
+# Filas que se serializan a CSV por cada bloque enviado a COPY.
+FILAS_POR_BLOQUE_COPY = 50000
+# Marcador de nulos en el CSV (no colisiona con strings vacíos).
+NULO_CSV = "\\N"
+
+
+# --- Mapeo de tipos pandas -> SQLAlchemy ---
+def tipo_sqlalchemy_para_serie(serie: pd.Series) -> TypeEngine:
+    """
+    Devuelve el tipo SQL explícito para una columna según su dtype:
+    enteros como BIGINT (SMALLINT solo para las banderas de
+    optimizacion_tipos), también los nullable, y categóricas con el tipo de
+    sus categorías.
+    Para columnas object se infiere el contenido igual que hace `to_sql`.
+    """
+    dtype = serie.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return Boolean()
+    if pd.api.types.is_integer_dtype(dtype):
+        # El ancho en memoria no decide el de la base: optimizacion_tipos
+        # reduce enteros a int32, y una tabla creada como INTEGER fallaría en
+        # una carga incremental posterior con IDs o montos más grandes.
+        if optimizacion_tipos.es_bandera(serie.name) and dtype.itemsize <= 2 \
+                and not pd.api.types.is_unsigned_integer_dtype(dtype):
+            return SmallInteger()
+        return BigInteger()
+    if pd.api.types.is_float_dtype(dtype):
+        return Float(precision=24 if dtype.itemsize == 4 else 53)
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return DateTime(timezone=True)
+    if pd.api.types.is_datetime64_dtype(dtype):
+        return DateTime()
+    if pd.api.types.is_timedelta64_dtype(dtype):
+        return Interval()
+    if isinstance(dtype, pd.CategoricalDtype):
+        return tipo_sqlalchemy_para_serie(pd.Series(dtype.categories)) if len(dtype.categories) else Text()
+
+    inferido = pd.api.types.infer_dtype(serie, skipna=True)
+    if inferido == "integer":
+        return BigInteger()
+    if inferido in ("floating", "mixed-integer-float", "decimal"):
+        return Float(precision=53)
+    if inferido == "boolean":
+        return Boolean()
+    if inferido in ("datetime64", "datetime"):
+        return DateTime()
+    if inferido == "date":
+        return Date()
+    if inferido == "time":
+        return Time()
+    return Text()
+
+
+def mapear_tipos_sqlalchemy(df: pd.DataFrame) -> Dict[str, TypeEngine]:
+    return {col: tipo_sqlalchemy_para_serie(df[col]) for col in df.columns}
+
+
+# --- Lector tipo archivo que genera el CSV por bloques ---
+class LectorCsvDataFrame:
+    """
+    Objeto tipo archivo que serializa el DataFrame a CSV bajo demanda,
+    bloque por bloque, para que COPY no necesite el CSV completo en memoria.
+    """
+
+    def __init__(self, df: pd.DataFrame, filas_por_bloque: int = FILAS_POR_BLOQUE_COPY):
+        self.df = df
+        self.filas_por_bloque = filas_por_bloque
+        self.posicion = 0
+        self.buffer = ""
+
+    def _siguiente_bloque(self) -> str:
+        bloque = self.df.iloc[self.posicion:self.posicion + self.filas_por_bloque]
+        self.posicion += self.filas_por_bloque
+        return bloque.to_csv(header=False, index=False, na_rep=NULO_CSV)
+
+    def read(self, size: int = -1) -> str:
+        while (size < 0 or len(self.buffer) < size) and self.posicion < len(self.df):
+            self.buffer += self._siguiente_bloque()
+        if size < 0:
+            datos, self.buffer = self.buffer, ""
+        else:
+            datos, self.buffer = self.buffer[:size], self.buffer[size:]
+        return datos
+
+    def readline(self, size: int = -1) -> str:
+        return self.read(size)
+
+
+def _cursor_con_copy(conn: Any) -> Optional[Any]:
+    """Cursor DBAPI con `copy_expert` (psycopg2) o None si el driver no lo soporta."""
+    cursor = conn.connection.dbapi_connection.cursor()
+    if hasattr(cursor, "copy_expert"):
+        return cursor
+    cursor.close()
+    return None
+
+
+def _crear_tabla(conn: Any, table_name: str, df: pd.DataFrame, particion_por: Optional[str] = None):
+    tipos = mapear_tipos_sqlalchemy(df)
+    columnas_ddl = ", ".join(
+        f'"{col}" {tipos[col].compile(dialect=conn.dialect)}' for col in df.columns)
+    particion = f' PARTITION BY RANGE ("{particion_por}")' if particion_por else ""
+    conn.execute(text(f'CREATE TABLE "{table_name}" ({columnas_ddl}){particion}'))
+    if particion_por:
+        for sentencia in diseno_tablas.sentencias_particiones(table_name, df, particion_por):
+            conn.execute(text(sentencia))
+
+
+def _copiar(cursor: Any, df: pd.DataFrame, table_name: str):
+    columnas = ", ".join(f'"{col}"' for col in df.columns)
+    cursor.copy_expert(
+        f"COPY \"{table_name}\" ({columnas}) FROM STDIN WITH (FORMAT csv, NULL '{NULO_CSV}')",
+        LectorCsvDataFrame(df))
+
+
+def escribir_df(
+    df: pd.DataFrame, table_name: str, conn: Any,
+    if_exists: Literal['fail', 'replace', 'append'] = 'replace', analizar: bool = True
+) -> Dict[str, Any]:
+    """
+    Escribe `df` usando una conexión SQLAlchemy ya abierta (dentro de una transacción).
+
+    En PostgreSQL con psycopg2 usa COPY: para 'replace' copia a una tabla de
+    staging y la intercambia con la definitiva en la misma transacción; para
+    'append' copia directo a la tabla existente. En cualquier otro motor usa
+    `df.to_sql(method='multi')` con los mismos tipos explícitos.
+
+    Después aplica las claves, índices y particiones de diseno_tablas y,
+    con `analizar`, actualiza las estadísticas de la tabla (ANALYZE).
+    """
+    inicio = time.perf_counter()
+    cursor = _cursor_con_copy(conn) if conn.dialect.name == 'postgresql' else None
+    existe = inspect(conn).has_table(table_name)
+    if if_exists == 'fail' and existe:
+        raise ValueError(f"La tabla '{table_name}' ya existe.")
+
+    tabla_nueva = not (if_exists == 'append' and existe)
+    if cursor is None:
+        metodo = "to_sql"
+        df.to_sql(table_name, conn, if_exists=if_exists, index=False, chunksize=1000,
+                  method='multi', dtype=mapear_tipos_sqlalchemy(df))
+    else:
+        metodo = "COPY"
+        try:
+            if if_exists == 'append' and existe:
+                _copiar(cursor, df, table_name)
+            else:
+                tabla_staging = f"{table_name}__staging"
+                # Las tablas de hechos grandes se crean particionadas por año:
+                # COPY sobre la tabla madre reparte las filas entre las particiones.
+                particion_por = diseno_tablas.columna_particion(
+                    diseno_tablas.DISENO_TABLAS.get(table_name), df)
+                conn.execute(text(f'DROP TABLE IF EXISTS "{tabla_staging}"'))
+                _crear_tabla(conn, tabla_staging, df, particion_por)
+                _copiar(cursor, df, tabla_staging)
+                conn.execute(text(f'DROP TABLE IF EXISTS "{table_name}"'))
+                conn.execute(
+                    text(f'ALTER TABLE "{tabla_staging}" RENAME TO "{table_name}"'))
+                if particion_por:
+                    diseno_tablas.renombrar_particiones(conn, tabla_staging, table_name)
+        finally:
+            cursor.close()
+
+    segundos = time.perf_counter() - inicio
+    # Los índices se crean con la tabla ya cargada (más rápido que mantenerlos durante el COPY).
+    diseno = diseno_tablas.aplicar_diseno(conn, table_name, df, tabla_nueva, analizar)
+    segundos_diseno = time.perf_counter() - inicio - segundos
+    filas_por_segundo = len(df) / segundos if segundos > 0 else float(len(df))
+    print(
+        f"--- Log Sherlock (BG Task - save_df): '{table_name}' escrita con {metodo}: "
+        f"{len(df)} filas en {segundos:.2f}s ({filas_por_segundo:,.0f} filas/s)"
+        + (f"; claves, índices y ANALYZE en {segundos_diseno:.2f}s." if diseno["sentencias"] else "."))
+    return {"metodo": metodo, "filas": len(df), "segundos": segundos,
+            "filas_por_segundo": filas_por_segundo, "segundos_diseno": segundos_diseno}
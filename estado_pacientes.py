@@ -0,0 +1,350 @@
+"""
+Estado por paciente para etiquetar las citas de forma incremental.
+
+La primera cita atendida de cada paciente (y con ella la etiqueta de cada
+cita) depende de toda su historia. Con SHERLOCK_ESTADO_PACIENTES=<ruta.parquet>
+ese dato se guarda entre corridas y cada lote de citas se combina con él, en
+vez de recalcular el groupby().min() sobre toda la historia.
+
+Cada corrida deja el estado nuevo como pendiente (<ruta>.pendiente) y el
+trabajo lo confirma solo después de guardar las tablas en la base: si la
+carga falla, el estado no avanza.
+
+--reconstruir y --verificar leen toda la historia de citas desde la tabla
+hechos_citas de la base (DATABASE_URL), que con el estado activo acumula
+las citas de todos los lotes. Con --snapshot ID se lee hechos_citas de ese
+snapshot Parquet, que sirve solo si tiene la historia completa.
+
+Uso: python -m estado_pacientes --reconstruir [--snapshot ID]
+     python -m estado_pacientes --verificar [--snapshot ID]
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import pandas as pd
+from sqlalchemy import text
+
+# Archivo Parquet con el estado ('' = desactivado: la primera cita se calcula con el lote).
+RUTA_ESTADO = os.environ.get("SHERLOCK_ESTADO_PACIENTES", "")
+
+COLUMNAS_ESTADO = ['ID_Paciente', 'Fecha_Primera_Cita_Atendida_Real', 'ID_Cita_Primera',
+                   'Fecha_Ultima_Cita', 'ID_Ultima_Cita', 'Actualizado']
+# Columnas de un resumen de lote (una fila por paciente, combinable entre particiones).
+COLUMNAS_RESUMEN = ['ID_Paciente', 'Fecha_Primera_Cita_Atendida_Real', 'ID_Cita_Primera',
+                    'Fecha_Ultima_Cita', 'ID_Ultima_Cita']
+# Columnas de hechos_citas que hacen falta para reconstruir o verificar el estado.
+COLUMNAS_CITAS = ['ID_Cita', 'ID_Paciente', 'Fecha_Cita', 'Cita_asistida']
+
+
+def activo() -> bool:
+    return bool(RUTA_ESTADO)
+
+
+def _ruta_pendiente() -> str:
+    return RUTA_ESTADO + ".pendiente"
+
+
+def huella() -> str:
+    """
+    Cambia cada vez que se escribe el estado o el pendiente (para la caché de
+    pasos). Como cada corrida deja un pendiente nuevo, el paso de citas no se
+    toma de la caché mientras el estado está activo.
+    """
+    partes = []
+    for ruta in (RUTA_ESTADO, _ruta_pendiente()):
+        try:
+            info = os.stat(ruta)
+        except OSError:
+            partes.append("sin_estado")
+            continue
+        partes.append(f"{info.st_mtime_ns}:{info.st_size}")
+    return "|".join(partes)
+
+
+# --- Resumen de un lote de citas ---
+def _reducir(filas: pd.DataFrame) -> pd.DataFrame:
+    """
+    Una fila por paciente: la primera cita atendida (la más temprana; a igual
+    fecha, el menor ID_Cita) y la última cita procesada (la más reciente).
+    """
+    primera = filas.sort_values(['ID_Paciente', 'Fecha_Primera_Cita_Atendida_Real', 'ID_Cita_Primera'],
+                                kind='stable', na_position='last').drop_duplicates('ID_Paciente')
+    ultima = filas.sort_values(['ID_Paciente', 'Fecha_Ultima_Cita', 'ID_Ultima_Cita'],
+                               kind='stable', na_position='first').drop_duplicates('ID_Paciente', keep='last')
+    resumen = primera[['ID_Paciente', 'Fecha_Primera_Cita_Atendida_Real', 'ID_Cita_Primera']].merge(
+        ultima[['ID_Paciente', 'Fecha_Ultima_Cita', 'ID_Ultima_Cita']], on='ID_Paciente', how='left')
+    # Sin cita atendida no hay primera cita (ni ID que la identifique).
+    resumen.loc[resumen['Fecha_Primera_Cita_Atendida_Real'].isna(), 'ID_Cita_Primera'] = None
+    return resumen.reset_index(drop=True)
+
+
+def resumen_lote(hechos_citas: pd.DataFrame) -> pd.DataFrame:
+    """Resumen por paciente de las citas del lote (ya unidas con motivos y con Fecha_Cita normalizada)."""
+    con_paciente = hechos_citas[hechos_citas['ID_Paciente'].notna()]
+    fechas = con_paciente['Fecha_Cita']
+    atendida = (con_paciente['Cita_asistida'] == 1) & fechas.notna()
+    ids = con_paciente['ID_Cita'].astype(str)
+    return _reducir(pd.DataFrame({
+        'ID_Paciente': con_paciente['ID_Paciente'],
+        'Fecha_Primera_Cita_Atendida_Real': fechas.where(atendida),
+        'ID_Cita_Primera': ids.where(atendida),
+        'Fecha_Ultima_Cita': fechas,
+        'ID_Ultima_Cita': ids.where(fechas.notna()),
+    }))
+
+
+def combinar_resumenes(resumenes: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """Combina resúmenes parciales (ej. uno por partición) en uno solo."""
+    resumenes = [r for r in resumenes if r is not None and not r.empty]
+    if not resumenes:
+        return pd.DataFrame(columns=COLUMNAS_RESUMEN)
+    return _reducir(pd.concat(resumenes, ignore_index=True))
+
+
+def primeras_reenviadas(ids_cita: pd.Series, ids_primera_estado: Set[str]) -> Set[str]:
+    """IDs de cita del lote que son la primera cita atendida guardada de algún paciente."""
+    if not ids_primera_estado:
+        return set()
+    ids = ids_cita.astype(str)
+    return set(ids[ids.isin(ids_primera_estado)])
+
+
+# --- Estado guardado ---
+def _vacio(tipo_id: Any = object) -> pd.DataFrame:
+    return pd.DataFrame({
+        'ID_Paciente': pd.Series(dtype=tipo_id),
+        'Fecha_Primera_Cita_Atendida_Real': pd.Series(dtype='datetime64[ns]'),
+        'ID_Cita_Primera': pd.Series(dtype=object),
+        'Fecha_Ultima_Cita': pd.Series(dtype='datetime64[ns]'),
+        'ID_Ultima_Cita': pd.Series(dtype=object), 'Actualizado': pd.Series(dtype=object)})
+
+
+def _leer(ruta: str, tipo_id: Any) -> pd.DataFrame:
+    import pyarrow.parquet as pq  # Solo hace falta con el estado activo.
+
+    estado = pq.read_table(ruta).to_pandas()
+    estado['ID_Paciente'] = estado['ID_Paciente'].astype(tipo_id)
+    for col in ('Fecha_Primera_Cita_Atendida_Real', 'Fecha_Ultima_Cita'):
+        estado[col] = estado[col].astype('datetime64[ns]')
+    return estado[COLUMNAS_ESTADO]
+
+
+def cargar(tipo_id: Any, advertencias: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Lee el estado con ID_Paciente del tipo de las citas del lote. Si no
+    existe o no se puede usar, se empieza vacío (el lote pasa a ser la historia).
+    """
+    if not RUTA_ESTADO or not os.path.exists(RUTA_ESTADO):
+        return _vacio(tipo_id)
+    try:
+        return _leer(RUTA_ESTADO, tipo_id)
+    except Exception as e_estado:
+        mensaje = (f"ADVERTENCIA (estado de pacientes): No se pudo usar '{RUTA_ESTADO}' ({e_estado}); "
+                   "se reconstruye con las citas de este lote.")
+        print(mensaje)
+        if advertencias is not None:
+            advertencias.append(mensaje)
+        return _vacio(tipo_id)
+
+
+def guardar(estado: pd.DataFrame, ruta: Optional[str] = None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    ruta = ruta or RUTA_ESTADO
+    directorio = os.path.dirname(os.path.abspath(ruta))
+    os.makedirs(directorio, exist_ok=True)
+    tabla = pa.Table.from_pandas(estado[COLUMNAS_ESTADO], preserve_index=False)
+    pq.write_table(tabla, ruta + ".tmp")
+    os.replace(ruta + ".tmp", ruta)
+
+
+def aplicar_lote(estado: pd.DataFrame, resumen: pd.DataFrame,
+                 reenviadas: Set[str]) -> Tuple[pd.DataFrame, int]:
+    """
+    Combina el resumen de un lote con el estado y devuelve (estado nuevo,
+    pacientes revisados). La primera cita es la más temprana entre la
+    guardada y la del lote, salvo que el lote vuelva a traer la cita que la
+    definía (`reenviadas`): entonces manda el lote, porque esa cita pudo
+    cambiar de fecha o dejar de estar atendida. Si con eso la fecha cambia,
+    el paciente cuenta como revisado (el valor es exacto solo si el lote trae
+    toda su historia).
+    """
+    if resumen.empty:
+        return estado, 0
+    c = resumen.merge(estado, on='ID_Paciente', how='left', suffixes=('', '_estado'))
+    revisar = c['ID_Cita_Primera_estado'].isin(reenviadas)
+    fecha_lote, fecha_estado = c['Fecha_Primera_Cita_Atendida_Real'], c['Fecha_Primera_Cita_Atendida_Real_estado']
+    usar_estado = fecha_estado.notna() & ~revisar & (fecha_lote.isna() | (fecha_estado <= fecha_lote))
+    revisados = int((revisar & ~((fecha_lote == fecha_estado) | (fecha_lote.isna() & fecha_estado.isna()))).sum())
+    ultima_lote, ultima_estado = c['Fecha_Ultima_Cita'], c['Fecha_Ultima_Cita_estado']
+    usar_ultima_estado = ultima_estado.notna() & (ultima_lote.isna() | (ultima_estado > ultima_lote))
+
+    actualizados = pd.DataFrame({
+        'ID_Paciente': c['ID_Paciente'],
+        'Fecha_Primera_Cita_Atendida_Real': fecha_estado.where(usar_estado, fecha_lote),
+        'ID_Cita_Primera': c['ID_Cita_Primera_estado'].where(usar_estado, c['ID_Cita_Primera']),
+        'Fecha_Ultima_Cita': ultima_estado.where(usar_ultima_estado, ultima_lote),
+        'ID_Ultima_Cita': c['ID_Ultima_Cita_estado'].where(usar_ultima_estado, c['ID_Ultima_Cita']),
+        'Actualizado': datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    })
+    sin_cambios = estado[~estado['ID_Paciente'].isin(resumen['ID_Paciente'])]
+    partes = [p for p in (sin_cambios, actualizados) if not p.empty]
+    nuevo = pd.concat(partes, ignore_index=True) if len(partes) > 1 else partes[0].reset_index(drop=True)
+    return nuevo.sort_values('ID_Paciente', kind='stable', ignore_index=True)[COLUMNAS_ESTADO], revisados
+
+
+def primeras_citas(estado: pd.DataFrame, pacientes: Optional[pd.Series] = None) -> Optional[pd.DataFrame]:
+    """Tabla (ID_Paciente, Fecha_Primera_Cita_Atendida_Real) para unir a las citas; None si está vacía."""
+    primera = estado[estado['Fecha_Primera_Cita_Atendida_Real'].notna()]
+    if pacientes is not None:
+        primera = primera[primera['ID_Paciente'].isin(pacientes)]
+    if primera.empty:
+        return None
+    return primera[['ID_Paciente', 'Fecha_Primera_Cita_Atendida_Real']].reset_index(drop=True)
+
+
+def actualizar(resumen: pd.DataFrame, reenviadas: Set[str], estado: pd.DataFrame,
+               advertencias: List[str]) -> Optional[pd.DataFrame]:
+    """
+    Aplica el lote, deja el estado nuevo como pendiente (ver `confirmar`) y
+    devuelve la primera cita de los pacientes del lote.
+    """
+    nuevo, revisados = aplicar_lote(estado, resumen, reenviadas)
+    if revisados:
+        advertencias.append(
+            f"ADVERTENCIA (estado de pacientes): {revisados} pacientes con su primera cita atendida "
+            "modificada en este lote. Si el lote no trae toda su historia, reconstruya el estado "
+            "con 'python -m estado_pacientes --reconstruir'.")
+    guardar(nuevo, _ruta_pendiente())
+    print(f"--- Log Sherlock (BG Task - estado pacientes): {len(resumen)} pacientes en el lote, "
+          f"{len(nuevo)} en el estado (pendiente de confirmar).")
+    return primeras_citas(nuevo, resumen['ID_Paciente'])
+
+
+def pendiente(tipo_id: Any) -> Optional[pd.DataFrame]:
+    """Estado pendiente de esta corrida (todos los pacientes), o None si no hay."""
+    if not RUTA_ESTADO or not os.path.exists(_ruta_pendiente()):
+        return None
+    return _leer(_ruta_pendiente(), tipo_id)
+
+
+def confirmar() -> bool:
+    """Reemplaza el estado por el pendiente de esta corrida, una vez guardadas las tablas."""
+    if not RUTA_ESTADO or not os.path.exists(_ruta_pendiente()):
+        return False
+    os.replace(_ruta_pendiente(), RUTA_ESTADO)
+    print(f"--- Log Sherlock (BG Task - estado pacientes): Estado confirmado en '{RUTA_ESTADO}'.")
+    return True
+
+
+def descartar_pendiente():
+    try:
+        os.remove(_ruta_pendiente())
+    except FileNotFoundError:
+        pass
+
+
+# --- Reconstrucción completa y verificación ---
+def reconstruir(hechos_citas: pd.DataFrame) -> pd.DataFrame:
+    """Estado calculado desde cero con toda la historia de citas."""
+    return aplicar_lote(_vacio(hechos_citas['ID_Paciente'].dtype), resumen_lote(hechos_citas), set())[0]
+
+
+def verificar(hechos_citas: pd.DataFrame, estado: pd.DataFrame,
+              fecha_referencia: Optional[pd.Timestamp] = None) -> Dict[str, Any]:
+    """
+    Compara el estado incremental con el cálculo completo sobre `hechos_citas`
+    (toda la historia): primera cita por paciente y etiqueta de cada cita.
+    """
+    from procesador_datos import etiquetar_citas  # procesador_datos importa este módulo.
+
+    fecha_referencia = pd.Timestamp(
+        fecha_referencia if fecha_referencia is not None else 'today').normalize()
+    completo = reconstruir(hechos_citas)
+    estado = estado.assign(ID_Paciente=estado['ID_Paciente'].astype(completo['ID_Paciente'].dtype))
+    cols = ['ID_Paciente', 'Fecha_Primera_Cita_Atendida_Real']
+    c = completo[cols].merge(estado[cols], on='ID_Paciente', how='outer', suffixes=('_completo', '_estado'),
+                             indicator=True)
+    a, b = c['Fecha_Primera_Cita_Atendida_Real_completo'], c['Fecha_Primera_Cita_Atendida_Real_estado']
+    distintas = (c['_merge'] == 'both') & ~((a == b) | (a.isna() & b.isna()))
+
+    etiquetas = {}
+    for nombre, tabla in (('completo', completo), ('estado', estado)):
+        primera = hechos_citas[['ID_Paciente']].merge(
+            tabla[cols], on='ID_Paciente', how='left')['Fecha_Primera_Cita_Atendida_Real']
+        etiquetas[nombre] = pd.Series(etiquetar_citas(
+            hechos_citas['Fecha_Cita'].reset_index(drop=True), primera, hechos_citas['Cita_asistida'].reset_index(drop=True),
+            fecha_referencia)).astype(str)
+    citas_distintas = int((etiquetas['completo'] != etiquetas['estado']).sum())
+    return {
+        "pacientes_completo": len(completo), "pacientes_estado": len(estado),
+        "solo_en_completo": int((c['_merge'] == 'left_only').sum()),
+        "solo_en_estado": int((c['_merge'] == 'right_only').sum()),
+        "primera_cita_distinta": int(distintas.sum()),
+        "citas_con_etiqueta_distinta": citas_distintas,
+        "ejemplos": c.loc[distintas, ['ID_Paciente', 'Fecha_Primera_Cita_Atendida_Real_completo',
+                                      'Fecha_Primera_Cita_Atendida_Real_estado']].head(10).astype(str).to_dict('records'),
+        "consistente": not distintas.any() and citas_distintas == 0 and not (c['_merge'] == 'left_only').any(),
+    }
+
+
+def _citas_de_base() -> pd.DataFrame:
+    import conexiones_db
+
+    database_url = os.environ.get("DATABASE_URL")
+    if not database_url:
+        raise SystemExit("Configure DATABASE_URL para leer hechos_citas de la base (o use --snapshot).")
+    engine = conexiones_db.crear_engine_carga(database_url)
+    columnas = ", ".join(f'"{col}"' for col in COLUMNAS_CITAS)
+    print("Leyendo hechos_citas de la base...")
+    try:
+        with engine.connect() as conn:
+            hechos_citas = pd.read_sql(text(f'SELECT {columnas} FROM "hechos_citas"'), conn)
+    finally:
+        engine.dispose()
+    hechos_citas['Fecha_Cita'] = pd.to_datetime(hechos_citas['Fecha_Cita'], errors='coerce').dt.normalize()
+    return hechos_citas
+
+
+def _citas_de_snapshot(id_snapshot: str) -> pd.DataFrame:
+    import snapshots_parquet
+    print(f"Leyendo hechos_citas del snapshot '{id_snapshot}'...")
+    return snapshots_parquet.leer_tabla(id_snapshot, 'hechos_citas')[COLUMNAS_CITAS]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    accion = parser.add_mutually_exclusive_group(required=True)
+    accion.add_argument('--reconstruir', action='store_true',
+                        help="Recalcula el estado completo desde hechos_citas de la base.")
+    accion.add_argument('--verificar', action='store_true',
+                        help="Compara el estado guardado con el cálculo completo (sale con 1 si difieren).")
+    parser.add_argument('--snapshot', default=None,
+                        help="Lee hechos_citas de este snapshot en vez de la base (debe tener toda la historia).")
+    parser.add_argument('--estado', default=None, help="Ruta del estado (por defecto, SHERLOCK_ESTADO_PACIENTES).")
+    args = parser.parse_args()
+
+    global RUTA_ESTADO
+    RUTA_ESTADO = args.estado or RUTA_ESTADO
+    if not RUTA_ESTADO:
+        raise SystemExit("Indique la ruta del estado con --estado o SHERLOCK_ESTADO_PACIENTES.")
+    hechos_citas = _citas_de_snapshot(args.snapshot) if args.snapshot else _citas_de_base()
+    if args.reconstruir:
+        estado = reconstruir(hechos_citas)
+        guardar(estado)
+        # Un pendiente de una corrida fallida se calculó sobre el estado anterior.
+        descartar_pendiente()
+        print(f"Estado reconstruido: {len(estado):,} pacientes en '{RUTA_ESTADO}'.")
+        return
+    resultado = verificar(hechos_citas, cargar(hechos_citas['ID_Paciente'].dtype))
+    for clave, valor in resultado.items():
+        print(f"  {clave}: {valor}")
+    sys.exit(0 if resultado["consistente"] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,85 @@
 import json
-from fastapi import FastAPI, Request, File, UploadFile, HTTPException, Form, BackgroundTasks, Body, Depends, Header
-from fastapi.responses import JSONResponse
-from typing import List, Dict, Any, Tuple, Literal, Annotated
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import partial
+from fastapi import FastAPI, Request, File, UploadFile, HTTPException, Form, Body, Depends, Header
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import List, Dict, Any, Optional, Tuple, Literal, Annotated
 import pandas as pd
 import numpy as np
 import os
 import io
 import requests
-from sqlalchemy import create_engine, text
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
 
 import procesador_datos
+import agregados_kpi
+import carga_incremental
+import conexiones_db
+import consultas_duckdb
+import consultas_sql
+import escritor_postgres
+import estado_pacientes
+import metricas
+import snapshots_parquet
+import staging_lotes
+import trabajos
+
+_ejecutor_trabajos: ProcessPoolExecutor | None = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Se hace al arrancar el servidor (no al importar el módulo, porque el
+    # proceso trabajador también importa main).
+    trabajos.inicializar()
+    interrumpidos = trabajos.marcar_interrumpidos()
+    if interrumpidos:
+        print(
+            f"--- Log Sherlock: {interrumpidos} trabajo(s) pendientes de una ejecución anterior marcados como interrumpidos.")
+    sellados = staging_lotes.eliminar_sellados_huerfanos(trabajos.proceso_vivo)
+    if sellados:
+        print(
+            f"--- Log Sherlock: Borrados los lotes sellados de {sellados} proceso(s) que ya no existen.")
+    yield
+    if _ejecutor_trabajos is not None:
+        _ejecutor_trabajos.shutdown(wait=False, cancel_futures=True)
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
-_saved_files: dict[str, bytes] = {}
-_indice_file_content: bytes | None = None
-_indice_file_name: str | None = None
 
 # --- CONFIGURACIÓN DE BASE DE DATOS Y API KEY ---
 DATABASE_URL = os.environ.get("DATABASE_URL")
+# Base para las queries de /execute_sql_query/ (ej. una réplica o un rol de solo lectura).
+DATABASE_URL_LECTURA = os.environ.get("DATABASE_URL_LECTURA") or DATABASE_URL
 SHERLOCK_API_KEY = os.environ.get("SHERLOCK_API_KEY")
+# 'completo' reescribe cada tabla; 'incremental' solo escribe filas nuevas/modificadas.
+MODO_CARGA = os.environ.get("SHERLOCK_MODO_CARGA", "completo").lower()
+# `engine` es el pool del ETL; `engine_lectura`, el de /execute_sql_query/.
 engine = None
+engine_lectura = None
+# Caché de resultados de /execute_sql_query/ (por proceso web).
+cache_consultas = consultas_sql.CacheConsultas()
+# Backend local (DuckDB sobre el último snapshot Parquet) de /execute_sql_query/.
+motor_duckdb = consultas_duckdb.MotorDuckDB()
 
 if not DATABASE_URL:
     print("ADVERTENCIA: La variable de entorno DATABASE_URL no está configurada.")
 else:
     try:
-        engine = create_engine(DATABASE_URL)
+        engine = conexiones_db.crear_engine_carga(DATABASE_URL)
         with engine.connect() as connection:
             print("Conexión a Supabase (PostgreSQL) establecida exitosamente.")
+        engine_lectura = conexiones_db.crear_engine_lectura(DATABASE_URL_LECTURA)
     except Exception as e:
         print(f"Error al crear el engine de SQLAlchemy o al conectar: {e}")
         engine = None
+        engine_lectura = None
 
 # Función de dependencia para verificar la API Key
 
@@ -71,8 +118,9 @@ def save_df_to_supabase(
     try:
         print(
             f"--- Log Sherlock (BG Task - save_df): Guardando tabla: {table_name}, Filas: {len(df)}")
-        df.to_sql(table_name, db_engine, if_exists=if_exists,
-                  index=False, chunksize=1000, method='multi')
+        with db_engine.begin() as connection:
+            escritor_postgres.escribir_df(
+                df, table_name, connection, if_exists=if_exists)
         print(
             f"--- Log Sherlock (BG Task - save_df): Tabla '{table_name}' guardada exitosamente.")
     except Exception as e:
@@ -84,156 +132,483 @@ def save_df_to_supabase(
 
 
 @app.post("/upload_single_file/")
-async def upload_single_file(file: UploadFile = File(...), filename: str = Form(...)):
+async def upload_single_file(file: UploadFile = File(...), filename: str = Form(...),
+                             batch_id: str = Form(staging_lotes.LOTE_DEFAULT)):
 
-    global _indice_file_content, _indice_file_name
     try:
-        content = await file.read()
-        if filename.lower() == "indice.xlsx":
-            _indice_file_content = content
-            _indice_file_name = filename
-            print(f"Archivo índice '{filename}' almacenado en memoria.")
-        else:
-            _saved_files[filename] = content
-            print(
-                f"Archivo de datos '{filename}' almacenado. Total datos: {len(_saved_files)}")
-        return {"filename": filename, "message": "Archivo almacenado temporalmente."}
+        # La copia a disco es por bloques y bloqueante: se hace fuera del event loop.
+        manifiesto = await run_in_threadpool(
+            staging_lotes.guardar_archivo, batch_id, filename, file.file)
+    except ValueError as e_nombre:
+        raise HTTPException(status_code=400, detail=str(e_nombre))
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error al procesar archivo {filename}: {str(e)}")
+    finally:
+        await file.close()
+    if filename.lower() == staging_lotes.NOMBRE_INDICE:
+        print(f"Archivo índice '{filename}' almacenado en el lote '{batch_id}'.")
+    else:
+        print(
+            f"Archivo de datos '{filename}' almacenado en el lote '{batch_id}'. Total datos: {len(manifiesto['archivos'])}")
+    return {"filename": filename, "batch_id": batch_id, "message": "Archivo almacenado temporalmente."}
 
-# --- Clase Helper para Simular UploadFile ---
-
-
-class InMemoryUploadFile:
-
-    def __init__(self, filename: str, content: bytes):
-        self.filename = filename
-        self.file = io.BytesIO(content)
+# --- Endpoint 1b: Recibir un Lote Completo en un Archivo Comprimido ---
 
-    async def read(self) -> bytes: self.file.seek(0); return self.file.read()
-    def seek(self, offset: int,
-             whence: int = 0) -> int: return self.file.seek(offset, whence)
 
-    def tell(self) -> int: return self.file.tell()
-    async def close(self): self.file.close()
+@app.post("/upload_archive/")
+async def upload_archive(file: UploadFile = File(...),
+                         batch_id: str = Form(staging_lotes.LOTE_DEFAULT),
+                         trigger: bool = Form(False), allow_missing: bool = Form(False)):
+    """
+    Recibe en una sola llamada un zip o tar (gz, zst) con indice.xlsx y todos
+    los libros de datos, lo extrae al lote `batch_id` y valida el conjunto
+    contra el índice. Con `trigger` además sella el lote y encola el trabajo,
+    como /trigger_processing_and_save/.
+    """
+    print(
+        f"--- Log Sherlock: RECIBIDA LLAMADA a /upload_archive/ ('{file.filename}', lote '{batch_id}') ---")
+    if trigger and engine is None:
+        raise HTTPException(
+            status_code=500, detail="Error: Conexión a DB no disponible.")
+    try:
+        # Starlette ya dejó el cuerpo en un archivo temporal; la extracción es
+        # por bloques y bloqueante: se hace fuera del event loop.
+        resultado = await run_in_threadpool(
+            staging_lotes.guardar_archivo_comprimido, batch_id, file.filename or "archivo",
+            file.file, allow_missing)
+    except ValueError as e_archivo:
+        raise HTTPException(status_code=400, detail=str(e_archivo))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error al extraer el archivo {file.filename}: {str(e)}")
+    finally:
+        await file.close()
+    manifiesto = resultado["manifiesto"]
+    print(
+        f"--- Log Sherlock: {len(resultado['extraidos'])} archivos extraídos al lote '{batch_id}'. "
+        f"Total datos: {len(manifiesto['archivos'])}")
+    contenido = {"batch_id": batch_id, "extraidos": resultado["extraidos"],
+                 "archivos_datos": len(manifiesto["archivos"]),
+                 "faltantes": resultado["faltantes"], "no_indexados": resultado["no_indexados"],
+                 "advertencias_indice": resultado["advertencias_indice"]}
+    if not trigger:
+        return {**contenido, "message": "Archivos almacenados temporalmente."}
 
-# --- Función de Tarea de Fondo ---
+    try:
+        id_trabajo = await _sellar_y_encolar(batch_id)
+    except ValueError as e_lote:
+        # Otro disparador selló el lote entre la extracción y este sellado.
+        raise HTTPException(status_code=409, detail=f"{e_lote} (el lote '{batch_id}' ya fue sellado)")
+    print(
+        f"--- Log Sherlock: Trabajo {id_trabajo} encolado. Devolviendo 202 a Make. ---")
+    return JSONResponse(status_code=202, content={
+        **contenido, "job_id": id_trabajo,
+        "message": "Archivos recibidos. El trabajo se realiza en segundo plano."})
 
+# --- Función del Trabajo de Procesamiento (corre en un proceso aparte) ---
 
-async def do_the_heavy_processing_and_saving():
-    global _saved_files, _indice_file_content, _indice_file_name, engine
-    print("--- Log Sherlock (BG Task): INICIO TAREA DE FONDO ---")
 
-    current_saved_files = _saved_files.copy()
-    current_indice_content = _indice_file_content
-    current_indice_name = _indice_file_name
+def ejecutar_trabajo_procesamiento(id_trabajo: str, directorio_lote: str):
+    """
+    Ejecuta el ETL completo para un lote sellado (archivos en disco) dentro
+    del proceso trabajador y deja el resultado (etapas con tiempo y memoria pico,
+    filas por tabla y advertencias) registrado en el almacén de trabajos y en un
+    reporte JSON en SHERLOCK_REPORTES_DIR.
+    Con varios workers web hay un proceso trabajador por worker: el trabajo
+    espera su turno para que en la máquina se procese un lote a la vez.
+    """
+    with trabajos.turno_de_ejecucion():
+        _procesar_lote(id_trabajo, directorio_lote)
 
-    _saved_files.clear()
-    _indice_file_content = None
-    _indice_file_name = None
-    print("--- Log Sherlock (BG Task): Variables globales de archivos limpiadas para próximo lote.")
 
-    if engine is None or not current_saved_files:
-        print("--- Log Sherlock (BG Task): ERROR - Faltan datos esenciales (engine o archivos) para iniciar la tarea.")
-        return
+def _procesar_lote(id_trabajo: str, directorio_lote: str):
+    print(f"--- Log Sherlock (BG Task): INICIO TRABAJO {id_trabajo} ---")
+    trabajos.marcar_en_proceso(id_trabajo)
+    metricas.iniciar_reporte(id_trabajo, al_cerrar_etapa=partial(_registrar_etapa_trabajo, id_trabajo))
+    carga_warnings: List[str] = []
 
     try:
-        if not current_indice_name or not current_indice_content:
-            print("--- Log Sherlock (BG Task): ERROR CRÍTICO - No se encontró el nombre o el contenido del archivo 'indice.xlsx'. Abortando tarea.")
-            return
+        with metricas.perfilar(id_trabajo):
+            if engine is None:
+                raise ConnectionError("Conexión a la base de datos no establecida.")
+
+            indice_file, data_files = staging_lotes.archivos_de_lote(directorio_lote)
+            if indice_file is None or not data_files:
+                raise ValueError("El lote no tiene 'indice.xlsx' o archivos de datos.")
+
+            print("--- Log Sherlock (BG Task): Llamando a load_dataframes_from_uploads...")
+            with metricas.etapa("carga_archivos") as medicion:
+                processed_dfs, _, _, carga_warnings = procesador_datos.load_dataframes_from_uploads(
+                    data_files=data_files, index_file=indice_file)
+                medicion["filas"] = sum(len(df) for df in processed_dfs.values())
+            if not processed_dfs:
+                raise ValueError("No se cargaron DataFrames.")
+
+            print("--- Log Sherlock (BG Task): Llamando a generar_insights_pacientes...")
+            with metricas.etapa("generar_insights") as medicion:
+                final_dataframes_to_save = procesador_datos.generar_insights_pacientes(
+                    processed_dfs, carga_warnings)
+                medicion["filas"] = sum(len(df) for df in final_dataframes_to_save.values())
+            # Las tablas crudas ya no se usan: se liberan antes de escribir.
+            del processed_dfs
+            if not final_dataframes_to_save:
+                raise ValueError("No se generaron DataFrames finales para guardar.")
+
+            # Con el estado por paciente, hechos_citas y sus KPI se guardan al
+            # final, en una sola transacción (ver _acumular_citas).
+            citas_acumuladas = estado_pacientes.activo() and 'hechos_citas' in final_dataframes_to_save
+            tablas_citas = {'hechos_citas', *procesador_datos.KPI_DE_CITAS} if citas_acumuladas else set()
+
+            if snapshots_parquet.SNAPSHOTS_ACTIVOS and not citas_acumuladas:
+                _guardar_snapshot(final_dataframes_to_save, id_trabajo, carga_warnings)
 
-        data_files_sim = [InMemoryUploadFile(
-            fn, fc) for fn, fc in current_saved_files.items()]
-
-        indice_file_sim = InMemoryUploadFile(
-            filename=current_indice_name, content=current_indice_content)
-
-        print("--- Log Sherlock (BG Task): Llamando a load_dataframes_from_uploads...")
-        processed_dfs, _, _, carga_warnings = procesador_datos.load_dataframes_from_uploads(
-            data_files=data_files_sim, index_file=indice_file_sim)
-        if not processed_dfs:
             print(
-                f"--- Log Sherlock (BG Task): ERROR - No se cargaron DataFrames. Advertencias: {carga_warnings}")
-            return
-
-        print("--- Log Sherlock (BG Task): Llamando a generar_insights_pacientes...")
-        final_dataframes_to_save = procesador_datos.generar_insights_pacientes(
-            processed_dfs, carga_warnings)
-        if not final_dataframes_to_save:
-            print(
-                f"--- Log Sherlock (BG Task): ERROR - No se generaron DataFrames finales para guardar. Advertencias: {carga_warnings}")
-            return
-
-        print(
-            f"--- Log Sherlock (BG Task): DataFrames para guardar en Supabase: {list(final_dataframes_to_save.keys())}")
-        for table_name, df_to_save in final_dataframes_to_save.items():
-            save_df_to_supabase(df_to_save, table_name,
-                                engine, if_exists='replace')
-
-        print("--- Log Sherlock (BG Task): PROCESO COMPLETO DE GUARDADO EN SUPABASE TERMINADO ---")
-        if carga_warnings:
-            print("--- Log Sherlock (BG Task): Resumen de Advertencias ---")
-            for warn in carga_warnings:
-                print(warn)
+                f"--- Log Sherlock (BG Task): DataFrames para guardar en Supabase: {list(final_dataframes_to_save.keys())}")
+            for table_name, df_to_save in final_dataframes_to_save.items():
+                if table_name in tablas_citas:
+                    continue
+                with metricas.etapa(f"guardar:{table_name}", filas=len(df_to_save), tabla=table_name):
+                    if MODO_CARGA == 'incremental':
+                        carga_incremental.guardar_df_incremental(
+                            df_to_save, table_name, engine, save_df_to_supabase)
+                    else:
+                        save_df_to_supabase(df_to_save, table_name,
+                                            engine, if_exists='replace')
+                # Invalida la caché de queries de los procesos web.
+                trabajos.incrementar_generacion_carga()
+
+            if citas_acumuladas:
+                meses_citas = _acumular_citas(final_dataframes_to_save, carga_warnings)
+                trabajos.incrementar_generacion_carga()
+                # El estado por paciente avanza solo con todas las tablas guardadas.
+                estado_pacientes.confirmar()
+                if snapshots_parquet.SNAPSHOTS_ACTIVOS:
+                    _guardar_snapshot(final_dataframes_to_save, id_trabajo, carga_warnings,
+                                      meses_parciales={'hechos_citas': meses_citas})
+
+            print("--- Log Sherlock (BG Task): PROCESO COMPLETO DE GUARDADO EN SUPABASE TERMINADO ---")
+            if carga_warnings:
+                print("--- Log Sherlock (BG Task): Resumen de Advertencias ---")
+                for warn in carga_warnings:
+                    print(warn)
+            metricas.terminar_reporte(trabajos.ESTADO_COMPLETADO, carga_warnings)
+            trabajos.finalizar_trabajo(
+                id_trabajo, trabajos.ESTADO_COMPLETADO, carga_warnings)
 
     except Exception as e:
         print(
-            f"--- Log Sherlock (BG Task): ERROR CRÍTICO en tarea de fondo: {str(e)} ---")
+            f"--- Log Sherlock (BG Task): ERROR CRÍTICO en trabajo {id_trabajo}: {str(e)} ---")
         import traceback
         traceback.print_exc()
+        metricas.terminar_reporte(trabajos.ESTADO_FALLIDO, carga_warnings, error=str(e))
+        trabajos.finalizar_trabajo(
+            id_trabajo, trabajos.ESTADO_FALLIDO, carga_warnings, error=str(e))
     finally:
-        print("--- Log Sherlock (BG Task): FIN TAREA DE FONDO ---")
+        staging_lotes.eliminar_directorio(directorio_lote)
+        print(f"--- Log Sherlock (BG Task): FIN TRABAJO {id_trabajo} ---")
+
+
+def _guardar_snapshot(dataframes: Dict[str, pd.DataFrame], id_trabajo: str, carga_warnings: List[str],
+                      meses_parciales: Optional[Dict[str, pd.Series]] = None):
+    # Copia local en Parquet de esta ejecución; si falla, la carga sigue.
+    try:
+        with metricas.etapa("snapshot_parquet") as medicion:
+            manifiesto = snapshots_parquet.guardar_snapshot(dataframes, id_trabajo, meses_parciales)
+            medicion["filas"] = sum(t["filas"] for t in manifiesto["tablas"].values())
+    except Exception as e_snapshot:
+        carga_warnings.append(
+            f"ADVERTENCIA (snapshot): No se pudo guardar el snapshot Parquet: {e_snapshot}")
 
 
-# --- Endpoint 2: Disparador de la Tarea de Fondo ---
+def _acumular_citas(final_dataframes_to_save: Dict[str, pd.DataFrame], carga_warnings: List[str]) -> pd.Series:
+    """
+    Con el estado por paciente (estado_pacientes.py) el lote puede traer solo
+    las citas recientes: hechos_citas se agrega a la base sin borrar las de
+    lotes anteriores (en cualquier SHERLOCK_MODO_CARGA). De la base se leen
+    solo las citas que el lote puede cambiar (las de sus pacientes y las que
+    estaban en agenda y ya pasaron); se les actualiza la primera cita y la
+    etiqueta, y las tablas KPI de citas se recalculan solo en los meses con
+    citas nuevas o cambiadas. Todo va en una transacción: si algo falla, la
+    base queda como antes y el estado no se confirma.
+
+    Deja en `final_dataframes_to_save` las citas de esos meses y las tablas
+    KPI completas (para el snapshot Parquet) y devuelve los meses.
+    """
+    lote = final_dataframes_to_save['hechos_citas']
+    col_fecha = 'Fecha_Cita'
+    columnas_fecha = [col for col in lote.columns if pd.api.types.is_datetime64_any_dtype(lote[col])]
+    hoy = pd.Timestamp('today').normalize()
+    with metricas.etapa("citas_acumuladas", filas=len(lote), tabla='hechos_citas') as medicion, \
+            engine.begin() as connection:
+        anteriores = lote.iloc[:0]
+        if inspect(connection).has_table('hechos_citas'):
+            en_agenda = ", ".join(f":agenda_{i}" for i in range(len(procesador_datos.ETIQUETAS_EN_AGENDA)))
+            anteriores = carga_incremental.leer_filas(
+                connection, 'hechos_citas',
+                condicion=f'"Etiqueta_Cita_Paciente" IN ({en_agenda}) AND "{col_fecha}" < :hoy',
+                parametros={"hoy": hoy.to_pydatetime(),
+                            **{f"agenda_{i}": etiqueta for i, etiqueta in enumerate(procesador_datos.ETIQUETAS_EN_AGENDA)}},
+                valores=lote[['ID_Paciente']].dropna().drop_duplicates(), columnas_fecha=columnas_fecha)
+        # Las citas que vuelven a venir en el lote se reemplazan (y su mes anterior también cambia).
+        reenviadas = anteriores['ID_Cita'].astype(str).isin(set(lote['ID_Cita'].astype(str)))
+        meses = [anteriores.loc[reenviadas, col_fecha], lote[col_fecha]]
+        anteriores = anteriores.loc[~reenviadas]
+        escribir = lote
+        estado = estado_pacientes.pendiente(lote['ID_Paciente'].dtype)
+        if estado is not None and not anteriores.empty:
+            anteriores, cambiadas = procesador_datos.refrescar_citas(
+                anteriores, estado_pacientes.primeras_citas(estado, anteriores['ID_Paciente']), hoy)
+            if cambiadas.any():
+                print(f"--- Log Sherlock (BG Task): {int(cambiadas.sum())} citas de lotes anteriores "
+                      "con primera cita o etiqueta actualizada.")
+                escribir = pd.concat([lote, anteriores.loc[cambiadas]], ignore_index=True)
+                meses.append(anteriores.loc[cambiadas, col_fecha])
+        carga_incremental.reemplazar_filas(escribir, 'hechos_citas', connection)
+
+        meses = agregados_kpi.mes_de(pd.concat(meses, ignore_index=True)).drop_duplicates(ignore_index=True)
+        condicion, parametros = carga_incremental.condicion_meses(col_fecha, meses)
+        citas_meses = carga_incremental.leer_filas(
+            connection, 'hechos_citas', condicion=condicion, parametros=parametros, columnas_fecha=columnas_fecha)
+        medicion["filas"] = len(citas_meses)
+        print(f"--- Log Sherlock (BG Task): KPI de citas recalculados en {len(meses)} meses "
+              f"({len(citas_meses)} citas).")
+        agregados = procesador_datos.kpi_de_citas(
+            {'hechos_citas': citas_meses, 'hechos_pacientes': final_dataframes_to_save.get('hechos_pacientes')},
+            carga_warnings)
+        for nombre, df_kpi in agregados.items():
+            carga_incremental.reemplazar_meses(df_kpi, nombre, connection, agregados_kpi.COLUMNA_MES, meses)
+        final_dataframes_to_save['hechos_citas'] = citas_meses
+        for nombre in procesador_datos.KPI_DE_CITAS:
+            final_dataframes_to_save.pop(nombre, None)
+            if nombre in agregados or inspect(connection).has_table(nombre):
+                final_dataframes_to_save[nombre] = pd.read_sql_table(nombre, connection)
+    return meses
+
+
+def _registrar_etapa_trabajo(id_trabajo: str, medicion: Dict[str, Any]):
+    trabajos.registrar_etapa(id_trabajo, medicion["etapa"], medicion["segundos"], filas=medicion["filas"],
+                             tabla=medicion["tabla"], rss_pico_mb=medicion["rss_pico_mb"])
+
+
+def _obtener_ejecutor() -> ProcessPoolExecutor:
+    """
+    Proceso trabajador único de este worker web (los trabajos se ejecutan de a
+    uno, en orden de llegada; entre workers los ordena trabajos.turno_de_ejecucion).
+    Se usa 'spawn' para no heredar el estado del servidor web, y un proceso
+    nuevo por trabajo (max_tasks_per_child=1) para que la memoria de pandas
+    de cada carga vuelva al sistema al terminar.
+    """
+    global _ejecutor_trabajos
+    if _ejecutor_trabajos is None:
+        _ejecutor_trabajos = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn"), max_tasks_per_child=1)
+    return _ejecutor_trabajos
+
+
+def _al_terminar_trabajo(id_trabajo: str, futuro: Future):
+    """Si el proceso trabajador muere, el trabajo queda como fallido."""
+    global _ejecutor_trabajos
+    error = futuro.exception()
+    if error is None:
+        return
+    print(
+        f"--- Log Sherlock: El proceso trabajador falló en el trabajo {id_trabajo}: {error}")
+    trabajos.finalizar_trabajo(
+        id_trabajo, trabajos.ESTADO_FALLIDO, error=f"Proceso trabajador caído: {error}")
+    if isinstance(error, BrokenProcessPool):
+        _ejecutor_trabajos = None
+
+
+# --- Endpoint 2: Disparador del Trabajo de Procesamiento ---
 @app.post("/trigger_processing_and_save/")
-async def trigger_processing_and_save(background_tasks: BackgroundTasks):
-    print("--- Log Sherlock: RECIBIDA LLAMADA a /trigger_processing_and_save/ ---")
+async def trigger_processing_and_save(batch_id: str = staging_lotes.LOTE_DEFAULT):
+    print(
+        f"--- Log Sherlock: RECIBIDA LLAMADA a /trigger_processing_and_save/ (lote '{batch_id}') ---")
     if engine is None:
         raise HTTPException(
             status_code=500, detail="Error: Conexión a DB no disponible.")
-    if not _indice_file_content:
-        raise HTTPException(
-            status_code=400, detail="Error: Falta 'indice.xlsx'.")
-    if not _saved_files:
+    try:
+        id_trabajo = await _sellar_y_encolar(batch_id)
+    except ValueError as e_lote:
+        raise HTTPException(status_code=400, detail=str(e_lote))
+    print(
+        f"--- Log Sherlock: Trabajo {id_trabajo} encolado. Devolviendo 202 a Make. ---")
+    return JSONResponse(status_code=202, content={
+        "message": "Solicitud de procesamiento recibida. El trabajo se realiza en segundo plano.",
+        "job_id": id_trabajo, "batch_id": batch_id})
+
+
+async def _sellar_y_encolar(batch_id: str) -> str:
+    """Sella el lote abierto y encola su procesamiento; devuelve el id del trabajo."""
+    # El sellado espera el bloqueo del lote (puede haber subidas en otros
+    # workers): se hace fuera del event loop.
+    directorio_sellado = await run_in_threadpool(staging_lotes.sellar_lote, batch_id, trabajos.ID_PROCESO)
+    print(
+        f"--- Log Sherlock: Lote '{batch_id}' sellado en '{directorio_sellado}'; las nuevas subidas arman otro lote.")
+
+    id_trabajo = trabajos.crear_trabajo()
+    futuro = _obtener_ejecutor().submit(
+        ejecutar_trabajo_procesamiento, id_trabajo, directorio_sellado)
+    futuro.add_done_callback(partial(_al_terminar_trabajo, id_trabajo))
+    return id_trabajo
+
+
+# --- Endpoint 2b: Estado de un Trabajo ---
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    trabajo = trabajos.obtener_trabajo(job_id)
+    if trabajo is None:
         raise HTTPException(
-            status_code=400, detail="Error: Faltan archivos de datos.")
+            status_code=404, detail=f"No existe el trabajo '{job_id}'.")
+    return trabajo
+
+# --- Endpoint 2c: Métricas del ETL (formato Prometheus) ---
+
 
-    background_tasks.add_task(do_the_heavy_processing_and_saving)
-    print("--- Log Sherlock: Tarea de procesamiento encolada. Devolviendo 202 a Make. ---")
-    return JSONResponse(status_code=202, content={"message": "Solicitud de procesamiento recibida. El trabajo se realiza en segundo plano."})
+@app.get("/metrics")
+def get_metrics():
+    contenido = metricas.metricas_etl(
+        trabajos.contar_por_estado(), trabajos.ultimo_trabajo_terminado(),
+        cache_consultas.estadisticas())
+    return Response(content=contenido, media_type="text/plain; version=0.0.4; charset=utf-8")
 
-# --- Endpoint 3: Ejecutor de SQL --- # MODIFICADO
+# --- Endpoint 3: Ejecutor de SQL ---
 
 
 @app.post("/execute_sql_query/")
-async def execute_sql(
+def execute_sql(
     sql_query: str = Body(..., embed=True),
+    formato: consultas_sql.FormatoRespuesta = Body('json', embed=True),
+    stream: bool = Body(False, embed=True),
+    limit: int | None = Body(None, embed=True, ge=1),
+    cursor: str | None = Body(None, embed=True),
+    backend: str | None = Body(None, embed=True),
     api_key: None = Depends(verify_api_key)
 ):
-    if engine is None:
+    """
+    Ejecuta una query y devuelve sus filas como arreglo JSON (por defecto) o
+    NDJSON. Con `stream` (o con formato 'ndjson') las filas se leen con un
+    cursor del servidor y se envían por bloques a medida que llegan.
+    Nunca se devuelven más de SHERLOCK_SQL_MAX_FILAS filas por petición: si
+    una página viene completa, la cabecera X-Next-Cursor trae el `cursor`
+    para pedir la siguiente (con `limit`/`cursor` la query debe ser un
+    SELECT, idealmente con ORDER BY). En streaming la cabecera solo llega
+    si `limit` cabe en el primer bloque (SHERLOCK_SQL_FILAS_POR_BLOQUE).
+    Es una función normal (no async): FastAPI la corre en su threadpool y
+    varias queries se atienden en paralelo sin bloquear el event loop.
+    Las respuestas JSON completas de queries de solo lectura se guardan en
+    una caché LRU que se invalida cada vez que el ETL escribe tablas.
+    Con `backend='duckdb'` (o SHERLOCK_SQL_BACKEND) la query corre en local
+    sobre el último snapshot Parquet; si PostgreSQL no responde y hay un
+    snapshot, también se usa DuckDB. La cabecera X-Sherlock-Backend indica cuál respondió.
+    """
+    try:
+        backend = consultas_duckdb.validar_backend(backend) if backend else consultas_duckdb.BACKEND_SQL
+    except ValueError as e_backend:
+        raise HTTPException(status_code=400, detail=str(e_backend))
+    if backend == 'postgres' and engine_lectura is None:
+        if not consultas_duckdb.respaldo_disponible():
+            raise HTTPException(
+                status_code=500, detail="Conexión a DB no disponible.")
+        backend = 'duckdb'
+    if limit is not None and limit > consultas_sql.MAX_FILAS_CONSULTA:
         raise HTTPException(
-            status_code=500, detail="Conexión a DB no disponible.")
+            status_code=400, detail=f"'limit' no puede superar {consultas_sql.MAX_FILAS_CONSULTA} filas.")
+    try:
+        desplazamiento = consultas_sql.decodificar_cursor(cursor)
+    except ValueError as e_cursor:
+        raise HTTPException(status_code=400, detail=str(e_cursor))
+    limite = limit or consultas_sql.MAX_FILAS_CONSULTA
+    paginada = limit is not None or desplazamiento > 0
+    en_streaming = stream or formato == 'ndjson'
     print(
         f"--- Log Sherlock (SQL): Recibida query SQL para ejecutar: {sql_query[:500]}...")
-    try:
-        with engine.connect() as connection:
-            result = connection.execute(text(sql_query))
-            if result.returns_rows:
 
-                df_result = pd.DataFrame(
-                    result.fetchall(), columns=list(result.keys()))
-                json_result = df_result.to_json(
-                    orient='records', date_format='iso')
+    clave_cache = generacion = None
+    if not en_streaming and cache_consultas.activa:
+        clave_cache = consultas_sql.clave_cache_consulta(
+            sql_query, limite, desplazamiento)
+        if clave_cache is not None and backend == 'duckdb':
+            clave_cache = f"duckdb|{snapshots_parquet.ultimo_snapshot()}|{clave_cache}"
+        generacion = trabajos.generacion_carga()
+        en_cache = cache_consultas.obtener(clave_cache, generacion)
+        if en_cache is not None:
+            print("--- Log Sherlock (SQL): Resultado tomado de la caché.")
+            contenido, cabeceras = en_cache
+            return Response(content=contenido, media_type="application/json", headers=cabeceras)
+
+    connection = None
+    try:
+        if backend == 'postgres':
+            try:
+                connection = engine_lectura.connect()
+            except OperationalError as e_conexion:
+                if not consultas_duckdb.respaldo_disponible():
+                    raise
                 print(
-                    f"--- Log Sherlock (SQL): Query ejecutada. Filas devueltas: {len(df_result)}")
-
-                return JSONResponse(content=json.loads(json_result))
+                    f"--- Log Sherlock (SQL): PostgreSQL no disponible ({e_conexion.orig}); se usa DuckDB local.")
+                backend = 'duckdb'
+                clave_cache = None
+        if backend == 'duckdb':
+            # ResultadoDuckDB hace de conexión y de resultado a la vez.
+            result = connection = motor_duckdb.ejecutar(
+                sql_query, limite if paginada else None, desplazamiento)
+        else:
+            if paginada or consultas_sql.admite_cursor_servidor(sql_query):
+                connection = connection.execution_options(
+                    stream_results=True, max_row_buffer=consultas_sql.FILAS_POR_BLOQUE_CONSULTA)
+            if paginada:
+                result = connection.execute(text(consultas_sql.sql_paginada(sql_query)),
+                                            {"limite": limite, "desplazamiento": desplazamiento})
             else:
-                msg = f"Query ejecutada (sin filas devueltas). Filas afectadas (aprox): {result.rowcount}"
-                print(f"--- Log Sherlock (SQL): {msg}")
-                return {"status": "success", "message": msg}
+                result = connection.execute(text(sql_query))
+        if not result.returns_rows:
+            msg = f"Query ejecutada (sin filas devueltas). Filas afectadas (aprox): {result.rowcount}"
+            print(f"--- Log Sherlock (SQL): {msg}")
+            return {"status": "success", "message": msg}
+
+        columnas = list(result.keys())
+        bloques = consultas_sql.bloques_limitados(
+            result, limite, consultas_sql.FILAS_POR_BLOQUE_CONSULTA)
+        # El primer bloque se lee antes de responder para que los errores de
+        # la query lleguen como 400 y no como un stream cortado.
+        primer_bloque = next(bloques, [])
+        cabeceras = {"X-Sherlock-Limite-Filas": str(limite), "X-Sherlock-Backend": backend}
+
+        if en_streaming:
+            # Las cabeceras salen antes que las filas: X-Next-Cursor solo se
+            # envía si el primer bloque ya completó la página (limit <=
+            # SHERLOCK_SQL_FILAS_POR_BLOQUE); si no, no se sabe si llega a `limite`.
+            if len(primer_bloque) >= limite:
+                cabeceras["X-Next-Cursor"] = consultas_sql.codificar_cursor(
+                    desplazamiento + limite)
+            print(
+                f"--- Log Sherlock (SQL): Query ejecutada. Enviando filas en streaming ({formato}).")
+            cuerpo = consultas_sql.generar_respuesta(
+                primer_bloque, bloques, columnas, formato)
+            respuesta = StreamingResponse(
+                consultas_sql.cerrar_al_terminar(cuerpo, connection),
+                media_type=consultas_sql.MEDIA_TYPES[formato], headers=cabeceras)
+            connection = None  # La cierra el generador al terminar el envío.
+            return respuesta
+
+        filas = list(primer_bloque)
+        for bloque in bloques:
+            filas.extend(bloque)
+        if len(filas) == limite:
+            cabeceras["X-Next-Cursor"] = consultas_sql.codificar_cursor(
+                desplazamiento + limite)
+        df_result = pd.DataFrame(filas, columns=columnas)
+        json_result = df_result.to_json(orient='records', date_format='iso')
+        print(
+            f"--- Log Sherlock (SQL): Query ejecutada. Filas devueltas: {len(df_result)}")
+        cache_consultas.guardar(clave_cache, generacion, json_result, cabeceras)
+        return Response(content=json_result, media_type="application/json", headers=cabeceras)
+    except consultas_duckdb.ErrorConsultaLocal as e_local:
+        print(f"--- Log Sherlock (SQL): ERROR DuckDB: {e_local}")
+        raise HTTPException(
+            status_code=400, detail=f"Error de DuckDB al ejecutar SQL: {str(e_local)}")
     except SQLAlchemyError as e_sql:
         print(f"--- Log Sherlock (SQL): ERROR SQLAlchemy: {e_sql}")
         raise HTTPException(
@@ -244,6 +619,34 @@ async def execute_sql(
         traceback.print_exc()
         raise HTTPException(
             status_code=500, detail="Error inesperado en el servidor al ejecutar SQL.")
+    finally:
+        if connection is not None:
+            connection.close()
+
+# --- Endpoint 3b: Estadísticas de la caché de queries ---
+
+
+@app.get("/execute_sql_query/cache_stats/")
+async def sql_cache_stats(api_key: None = Depends(verify_api_key)):
+    return cache_consultas.estadisticas()
+
+# --- Endpoint 3c: Snapshots Parquet de las ejecuciones ---
+
+
+@app.get("/snapshots/")
+async def list_snapshots(api_key: None = Depends(verify_api_key)):
+    return {"ultimo": snapshots_parquet.ultimo_snapshot(),
+            "snapshots": snapshots_parquet.listar_snapshots()}
+
+
+@app.get("/snapshots/compare/")
+async def compare_snapshots(anterior: str, nuevo: str | None = None,
+                            api_key: None = Depends(verify_api_key)):
+    nuevo = nuevo or snapshots_parquet.ultimo_snapshot()
+    try:
+        return snapshots_parquet.comparar_snapshots(anterior, nuevo)
+    except (ValueError, OSError) as e_snapshot:
+        raise HTTPException(status_code=404, detail=f"Snapshot no disponible: {e_snapshot}")
 
 # --- Endpoint 4: Para que Render no se queje ---
 
@@ -256,11 +659,12 @@ async def root():
 
 
 @app.get("/admin/reset_memory/")
-async def reset_memory_admin():
-    global _saved_files, _indice_file_content, _indice_file_name
-    _saved_files.clear()
-    _indice_file_content = None
-    _indice_file_name = None
-    msg = "--- Log Sherlock: Memoria temporal de archivos limpiada manualmente por admin ---"
+async def reset_memory_admin(batch_id: str | None = None):
+    try:
+        staging_lotes.eliminar_lotes_abiertos(batch_id)
+    except ValueError as e_lote:
+        raise HTTPException(status_code=400, detail=str(e_lote))
+    alcance = f"del lote '{batch_id}'" if batch_id else "de todos los lotes abiertos"
+    msg = f"--- Log Sherlock: Archivos temporales {alcance} limpiados manualmente por admin ---"
     print(msg)
     return {"message": msg}
@@ -0,0 +1,316 @@
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# --- Métricas por etapa del ETL (tiempo y memoria pico) ---
+# Reporte JSON por trabajo en SHERLOCK_REPORTES_DIR/<id_trabajo>.json.
+DIRECTORIO_REPORTES = os.environ.get("SHERLOCK_REPORTES_DIR", "sherlock_reportes")
+# Perfilador opcional del trabajo completo: '', 'cprofile' o 'pyinstrument' (muestreo).
+PERFILADOR = os.environ.get("SHERLOCK_PERFILADOR", "").strip().lower()
+# Intervalo de muestreo de pyinstrument, en segundos.
+INTERVALO_PERFILADOR = float(os.environ.get("SHERLOCK_PERFILADOR_INTERVALO", 0.01))
+MB = 1024 * 1024
+
+
+# --- Memoria del proceso (Linux: /proc; en otros sistemas, getrusage) ---
+def _leer_status_kb(campo: str) -> Optional[int]:
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for linea in f:
+                if linea.startswith(campo + ":"):
+                    return int(linea.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def rss_actual_bytes() -> int:
+    kb = _leer_status_kb("VmRSS")
+    return kb * 1024 if kb is not None else pico_rss_bytes()
+
+
+def pico_rss_bytes() -> int:
+    """Pico de RSS desde el último reinicio (o desde que arrancó el proceso)."""
+    kb = _leer_status_kb("VmHWM")
+    if kb is not None:
+        return kb * 1024
+    maximo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maximo if sys.platform == "darwin" else maximo * 1024
+
+
+def _reiniciar_pico_rss() -> bool:
+    """En Linux, escribir '5' en clear_refs reinicia VmHWM al RSS actual."""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# --- Reporte de la ejecución en curso (un trabajo a la vez por proceso) ---
+class ReporteEjecucion:
+    def __init__(self, id_trabajo: str, al_cerrar_etapa: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.id_trabajo = id_trabajo
+        self.iniciado = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self.etapas: List[Dict[str, Any]] = []
+        self.al_cerrar_etapa = al_cerrar_etapa
+        self._inicio = time.perf_counter()
+
+    def segundos(self) -> float:
+        return time.perf_counter() - self._inicio
+
+
+_reporte: Optional[ReporteEjecucion] = None
+# Etapas abiertas (la última es la más interna), con su pico de RSS acumulado.
+_abiertas: List[Dict[str, Any]] = []
+
+
+def iniciar_reporte(id_trabajo: str,
+                    al_cerrar_etapa: Optional[Callable[[Dict[str, Any]], None]] = None) -> ReporteEjecucion:
+    """
+    Empieza a registrar las etapas de un trabajo. `al_cerrar_etapa` recibe
+    cada etapa al terminar (ej. para guardarla en el almacén de trabajos).
+    """
+    global _reporte
+    _abiertas.clear()
+    _reporte = ReporteEjecucion(id_trabajo, al_cerrar_etapa)
+    return _reporte
+
+
+def _abrir(nombre: str, filas: Optional[int], tabla: Optional[str], vuelta: bool) -> Dict[str, Any]:
+    # Antes de reiniciar el pico se anota en las etapas que lo contienen.
+    pico = pico_rss_bytes()
+    for abierta in _abiertas:
+        abierta["_pico"] = max(abierta["_pico"], pico)
+    _reiniciar_pico_rss()
+    padre = next((a for a in reversed(_abiertas) if not a["_vuelta"]), None)
+    datos = {"etapa": f"{padre['etapa']}/{nombre}" if padre else nombre, "filas": filas, "tabla": tabla,
+             "_pico": rss_actual_bytes(), "_vuelta": vuelta, "_inicio": time.perf_counter()}
+    _abiertas.append(datos)
+    return datos
+
+
+def _cerrar(datos: Dict[str, Any]):
+    while _abiertas and _abiertas[-1] is not datos:
+        _cerrar(_abiertas[-1])  # Vueltas internas que quedaron abiertas.
+    _abiertas.pop()
+    pico = max(datos.pop("_pico"), pico_rss_bytes())
+    for abierta in _abiertas:
+        abierta["_pico"] = max(abierta["_pico"], pico)
+    datos["segundos"] = round(time.perf_counter() - datos.pop("_inicio"), 3)
+    datos["rss_pico_mb"] = round(pico / MB, 1)
+    datos["rss_final_mb"] = round(rss_actual_bytes() / MB, 1)
+    datos.pop("_vuelta")
+    _publicar(datos)
+
+
+def _publicar(datos: Dict[str, Any]):
+    if _reporte is not None:
+        _reporte.etapas.append(datos)
+        if _reporte.al_cerrar_etapa is not None:
+            try:
+                _reporte.al_cerrar_etapa(datos)
+            except Exception as e_registro:
+                print(f"--- Log Sherlock (Métricas): No se pudo registrar la etapa '{datos['etapa']}': {e_registro}")
+
+
+@contextmanager
+def etapa(nombre: str, filas: Optional[int] = None, tabla: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Mide el tiempo y el pico de RSS del bloque. Se puede asignar
+    `datos['filas']` dentro del bloque. Las etapas anidadas (y las vueltas de
+    `marcar_etapa`) llevan el nombre de la etapa que las contiene como prefijo.
+    """
+    datos = _abrir(nombre, filas, tabla, vuelta=False)
+    try:
+        yield datos
+    finally:
+        _cerrar(datos)
+
+
+def marcar_etapa(nombre: str):
+    """
+    Cierra la vuelta anterior (si hay) y empieza otra dentro de la etapa
+    actual. Sirve para medir los PASOS de una función larga sin reindentarla.
+    Fuera de una etapa no hace nada.
+    """
+    if not any(not abierta["_vuelta"] for abierta in _abiertas):
+        return
+    cerrar_vuelta()
+    _abrir(nombre, None, None, vuelta=True)
+
+
+def cerrar_vuelta():
+    if _abiertas and _abiertas[-1]["_vuelta"]:
+        _cerrar(_abiertas[-1])
+
+
+def registrar_medicion(nombre: str, segundos: float, filas: Optional[int] = None, **extra: Any):
+    """
+    Agrega una etapa ya medida (ej. un paso que corrió en otro hilo, donde el
+    pico de RSS no es atribuible) dentro de la etapa actual. Sin RSS.
+    """
+    padre = next((a for a in reversed(_abiertas) if not a["_vuelta"]), None)
+    _publicar({"etapa": f"{padre['etapa']}/{nombre}" if padre else nombre, "filas": filas, "tabla": None,
+               "segundos": round(segundos, 3), "rss_pico_mb": None, "rss_final_mb": None, **extra})
+
+
+def terminar_reporte(estado: str, advertencias: Optional[List[str]] = None,
+                     error: Optional[str] = None) -> Optional[str]:
+    """Escribe el reporte JSON del trabajo y devuelve su ruta."""
+    global _reporte
+    reporte, _reporte = _reporte, None
+    while _abiertas:
+        _cerrar(_abiertas[-1])
+    if reporte is None:
+        return None
+    contenido = {
+        "id_trabajo": reporte.id_trabajo, "estado": estado, "iniciado": reporte.iniciado,
+        "terminado": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "segundos": round(reporte.segundos(), 3),
+        "rss_pico_mb": max((e["rss_pico_mb"] for e in reporte.etapas if e["rss_pico_mb"] is not None),
+                           default=None),
+        "filas_por_tabla": {e["tabla"]: e["filas"] for e in reporte.etapas if e["tabla"]},
+        "etapas": reporte.etapas, "advertencias": len(advertencias or []), "error": error,
+    }
+    try:
+        os.makedirs(DIRECTORIO_REPORTES, exist_ok=True)
+        ruta = os.path.join(DIRECTORIO_REPORTES, f"{reporte.id_trabajo}.json")
+        with open(ruta, "w", encoding="utf-8") as f:
+            json.dump(contenido, f, ensure_ascii=False, indent=1)
+    except OSError as e_reporte:
+        print(f"--- Log Sherlock (Métricas): No se pudo escribir el reporte: {e_reporte}")
+        return None
+    print(f"--- Log Sherlock (Métricas): Reporte del trabajo en '{ruta}'.")
+    return ruta
+
+
+# --- Perfilador opcional ---
+@contextmanager
+def perfilar(id_trabajo: str, perfilador: str = PERFILADOR) -> Iterator[None]:
+    """
+    Con SHERLOCK_PERFILADOR=cprofile guarda <id>.prof (y un resumen en texto);
+    con 'pyinstrument' (muestreo, si está instalado) guarda <id>.html.
+    """
+    if perfilador == "cprofile":
+        import cProfile
+        perfil = cProfile.Profile()
+        perfil.enable()
+        try:
+            yield
+        finally:
+            perfil.disable()
+            os.makedirs(DIRECTORIO_REPORTES, exist_ok=True)
+            base = os.path.join(DIRECTORIO_REPORTES, id_trabajo)
+            perfil.dump_stats(base + ".prof")
+            resumen = io.StringIO()
+            pstats.Stats(perfil, stream=resumen).sort_stats("cumulative").print_stats(40)
+            with open(base + ".perfil.txt", "w", encoding="utf-8") as f:
+                f.write(resumen.getvalue())
+            print(f"--- Log Sherlock (Métricas): Perfil cProfile en '{base}.prof'.")
+    elif perfilador == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("--- Log Sherlock (Métricas): pyinstrument no está instalado; se ejecuta sin perfilar.")
+            yield
+            return
+        perfil = Profiler(interval=INTERVALO_PERFILADOR)
+        perfil.start()
+        try:
+            yield
+        finally:
+            perfil.stop()
+            os.makedirs(DIRECTORIO_REPORTES, exist_ok=True)
+            ruta = os.path.join(DIRECTORIO_REPORTES, f"{id_trabajo}.html")
+            with open(ruta, "w", encoding="utf-8") as f:
+                f.write(perfil.output_html())
+            print(f"--- Log Sherlock (Métricas): Perfil pyinstrument en '{ruta}'.")
+    else:
+        yield
+
+
+# --- Exportación en formato de texto de Prometheus ---
+def _etiquetas(**valores: Any) -> str:
+    if not valores:
+        return ""
+    partes = []
+    for clave, valor in valores.items():
+        texto = str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        partes.append(f'{clave}="{texto}"')
+    return "{" + ",".join(partes) + "}"
+
+
+def formato_prometheus(metricas: List[Dict[str, Any]]) -> str:
+    """
+    `metricas`: [{"nombre", "tipo", "ayuda", "muestras": [(etiquetas, valor)]}].
+    Las muestras con valor None se omiten.
+    """
+    lineas = []
+    for metrica in metricas:
+        muestras = [(e, v) for e, v in metrica["muestras"] if v is not None]
+        if not muestras:
+            continue
+        lineas.append(f"# HELP {metrica['nombre']} {metrica['ayuda']}")
+        lineas.append(f"# TYPE {metrica['nombre']} {metrica['tipo']}")
+        for etiquetas, valor in muestras:
+            valor = float(valor)
+            texto = str(int(valor)) if valor.is_integer() else repr(valor)
+            lineas.append(f"{metrica['nombre']}{_etiquetas(**etiquetas)} {texto}")
+    return "\n".join(lineas) + "\n"
+
+
+def metricas_etl(conteo_por_estado: Dict[str, int], ultimo: Optional[Dict[str, Any]],
+                 cache_sql: Optional[Dict[str, Any]] = None) -> str:
+    """Métricas del ETL (a partir del almacén de trabajos) y de la caché de queries."""
+    metricas: List[Dict[str, Any]] = [{
+        "nombre": "sherlock_trabajos", "tipo": "gauge", "ayuda": "Trabajos registrados por estado.",
+        "muestras": [({"estado": estado}, n) for estado, n in sorted(conteo_por_estado.items())]}]
+    if ultimo is not None:
+        etapas = ultimo.get("etapas", [])
+        metricas += [
+            {"nombre": "sherlock_ultimo_trabajo_exitoso", "tipo": "gauge",
+             "ayuda": "1 si el último trabajo terminado se completó.",
+             "muestras": [({}, 1 if ultimo["estado"] == "completado" else 0)]},
+            {"nombre": "sherlock_ultimo_trabajo_terminado_timestamp_segundos", "tipo": "gauge",
+             "ayuda": "Momento en que terminó el último trabajo (epoch).",
+             "muestras": [({}, datetime.fromisoformat(ultimo["terminado"]).timestamp()
+                           if ultimo.get("terminado") else None)]},
+            {"nombre": "sherlock_etapa_segundos", "tipo": "gauge",
+             "ayuda": "Duración de cada etapa del último trabajo terminado.",
+             "muestras": [({"etapa": e["etapa"]}, e.get("segundos")) for e in etapas]},
+            {"nombre": "sherlock_etapa_rss_pico_bytes", "tipo": "gauge",
+             "ayuda": "Pico de memoria residente durante cada etapa del último trabajo terminado.",
+             "muestras": [({"etapa": e["etapa"]}, e["rss_pico_mb"] * MB if e.get("rss_pico_mb") is not None else None)
+                          for e in etapas]},
+            {"nombre": "sherlock_etapa_filas", "tipo": "gauge",
+             "ayuda": "Filas procesadas o escritas en cada etapa del último trabajo terminado.",
+             "muestras": [({"etapa": e["etapa"]}, e.get("filas")) for e in etapas]},
+            {"nombre": "sherlock_tabla_filas", "tipo": "gauge",
+             "ayuda": "Filas por tabla guardada en el último trabajo terminado.",
+             "muestras": [({"tabla": t}, n) for t, n in sorted(ultimo.get("filas", {}).items())]},
+            {"nombre": "sherlock_ultimo_trabajo_advertencias", "tipo": "gauge",
+             "ayuda": "Advertencias de carga del último trabajo terminado.",
+             "muestras": [({}, len(ultimo.get("advertencias", [])))]},
+        ]
+    if cache_sql is not None:
+        metricas += [
+            {"nombre": f"sherlock_cache_sql_{clave}_total", "tipo": "counter",
+             "ayuda": f"Caché de /execute_sql_query/: {clave.replace('_', ' ')}.",
+             "muestras": [({}, cache_sql[clave])]}
+            for clave in ("aciertos", "fallos", "no_cacheables", "invalidadas", "desalojadas")]
+        metricas += [
+            {"nombre": "sherlock_cache_sql_entradas", "tipo": "gauge", "ayuda": "Entradas en la caché de queries.",
+             "muestras": [({}, cache_sql["entradas"])]},
+            {"nombre": "sherlock_cache_sql_bytes", "tipo": "gauge", "ayuda": "Bytes en la caché de queries.",
+             "muestras": [({}, cache_sql["bytes"])]},
+        ]
+    return formato_prometheus(metricas)
@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, Literal
+
+# --- Esquema de tipos por columna (nombres con guiones bajos) ---
+# 'id': ID numérico como entero nullable (Int64 -> BIGINT); el texto no cambia.
+# 'bandera': 0/1 como int16 (SMALLINT).
+# 'categoria': texto repetitivo como categórica (TEXT en la base).
+# 'texto': se deja como está aunque tenga pocos valores distintos.
+TipoColumna = Literal['id', 'bandera', 'categoria', 'texto']
+ESQUEMA_COLUMNAS: Dict[str, TipoColumna] = {
+    'Cita_asistida': 'bandera', 'Cita_duplicada': 'bandera',
+    'Sucursal': 'categoria', 'Sexo': 'categoria', 'Medio_de_pago': 'categoria',
+    'Motivo_Cita': 'categoria', 'Estado_Cita': 'categoria', 'Tipo_Dentalink': 'categoria',
+    'Paciente_Origen': 'categoria', 'Pago_tipo': 'categoria', 'Gasto_medio_de_pago': 'categoria',
+    'Categoria_procedimiento': 'categoria', 'Subcategoria_procedimiento': 'categoria',
+    'Subcategoria_gasto': 'categoria', 'Ciudad': 'categoria', 'Hora_Inicio_Cita': 'categoria',
+    'Hora_Fin_Cita': 'categoria',
+    'Paciente_Nombre': 'texto', 'Paciente_Apellidos': 'texto', 'Celular': 'texto',
+}
+# Las columnas que empiezan así se tratan como 'id'.
+PREFIJO_ID = 'ID_'
+# Columnas de texto fuera del esquema: se vuelven categóricas si la tabla
+# tiene al menos MIN_FILAS_CATEGORIA filas y los valores distintos no pasan
+# de PROPORCION_MAX_UNICOS del total.
+MIN_FILAS_CATEGORIA = 1000
+PROPORCION_MAX_UNICOS = 0.5
+# Los enteros sin esquema se reducen a int32 solo en memoria: el escritor
+# (escritor_postgres) los guarda como BIGINT, y los IDs quedan en Int64.
+ENTERO_MINIMO = np.int32
+
+
+def _tipo_de_columna(nombre: object) -> TipoColumna | None:
+    nombre = str(nombre).replace(' ', '_').replace('-', '_')
+    if nombre in ESQUEMA_COLUMNAS:
+        return ESQUEMA_COLUMNAS[nombre]
+    if nombre.startswith(PREFIJO_ID):
+        return 'id'
+    return None
+
+
+def es_bandera(nombre: object) -> bool:
+    """True si la columna es una bandera 0/1 del esquema (SMALLINT en la base)."""
+    return _tipo_de_columna(nombre) == 'bandera'
+
+
+def _a_id_nullable(serie: pd.Series) -> pd.Series:
+    """
+    IDs numéricos sin decimales -> Int64 (los flotantes por culpa de los NaN
+    vuelven a ser enteros). Los IDs de texto se dejan como texto para que las
+    columnas que se cruzan entre tablas conserven el mismo tipo en la base.
+    """
+    dtype = serie.dtype
+    if not pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_bool_dtype(dtype) \
+            or pd.api.types.is_extension_array_dtype(dtype):
+        return serie
+    valores = serie.dropna()
+    if not valores.empty and not (np.isfinite(valores) & (valores == np.trunc(valores))).all():
+        return serie
+    return serie.astype('Int64')
+
+
+def _a_bandera(serie: pd.Series) -> pd.Series:
+    if pd.api.types.is_integer_dtype(serie.dtype) and not pd.api.types.is_extension_array_dtype(serie.dtype):
+        if serie.empty or (serie.min() >= np.iinfo(np.int16).min and serie.max() <= np.iinfo(np.int16).max):
+            return serie.astype(np.int16)
+    return serie
+
+
+def _es_texto(serie: pd.Series) -> bool:
+    return serie.dtype == object and pd.api.types.infer_dtype(serie, skipna=True) == 'string'
+
+
+def _a_categoria(serie: pd.Series, forzar: bool) -> pd.Series:
+    if isinstance(serie.dtype, pd.CategoricalDtype) or not _es_texto(serie):
+        return serie
+    if not forzar:
+        if len(serie) < MIN_FILAS_CATEGORIA or serie.nunique() > PROPORCION_MAX_UNICOS * len(serie):
+            return serie
+    return serie.astype('category')
+
+
+def _reducir_entero(serie: pd.Series) -> pd.Series:
+    dtype = serie.dtype
+    if pd.api.types.is_extension_array_dtype(dtype) or pd.api.types.is_bool_dtype(dtype) \
+            or not pd.api.types.is_integer_dtype(dtype) or dtype.itemsize <= np.dtype(ENTERO_MINIMO).itemsize:
+        return serie
+    info = np.iinfo(ENTERO_MINIMO)
+    if serie.empty or (serie.min() >= info.min and serie.max() <= info.max):
+        return serie.astype(ENTERO_MINIMO)
+    return serie
+
+
+def optimizar_tipos(df: pd.DataFrame, reducir_numericos: bool = True) -> pd.DataFrame:
+    """
+    Devuelve `df` con tipos compactos según ESQUEMA_COLUMNAS y las reglas
+    automáticas: IDs como Int64, banderas como int16, texto repetitivo como
+    categórica y (con `reducir_numericos`) enteros de 64 bits a int32 cuando
+    caben. Los valores no cambian; los flotantes se dejan como están.
+    """
+    columnas = {}
+    for col in df.columns.unique():
+        serie = df[col]
+        if not isinstance(serie, pd.Series):
+            continue  # Nombre de columna repetido: se deja igual.
+        tipo = _tipo_de_columna(col)
+        if tipo == 'id':
+            nueva = _a_id_nullable(serie)
+        elif tipo == 'bandera':
+            nueva = _a_bandera(serie)
+        elif tipo == 'texto':
+            nueva = serie
+        else:
+            nueva = _a_categoria(serie, forzar=(tipo == 'categoria'))
+            if reducir_numericos:
+                nueva = _reducir_entero(nueva)
+        if nueva is not serie:
+            columnas[col] = nueva
+    if not columnas:
+        return df
+    df = df.copy(deep=False)
+    for col, serie in columnas.items():
+        df[col] = serie
+    return df
@@ -0,0 +1,129 @@
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# --- Procesamiento por particiones en disco (exportaciones muy grandes) ---
+# Las tablas se reparten por hash de una clave en N archivos, cada partición
+# se procesa por separado (en este proceso o en un pool de procesos) y los
+# resultados se vuelven a unir en el orden original de las filas. Así las
+# tablas intermedias (merges, groupby) nunca ocupan más que una partición.
+
+# Número de particiones (0 o 1 = todo en memoria, como siempre).
+PARTICIONES = int(os.environ.get("SHERLOCK_PARTICIONES", 0))
+# Procesos que procesan particiones a la vez (1 = en este proceso, una a una).
+PROCESOS_PARTICIONES = int(os.environ.get("SHERLOCK_PARTICIONES_PROCESOS", 1))
+# Directorio de los archivos temporales (por defecto, el temporal del sistema).
+DIRECTORIO_PARTICIONES = os.environ.get("SHERLOCK_PARTICIONES_DIR") or None
+# Filas por bloque al calcular el hash de la clave (acota la memoria del texto).
+FILAS_POR_BLOQUE_HASH = 1_000_000
+# Columna auxiliar con la posición original de cada fila.
+COLUMNA_FILA = "__fila_particion"
+
+
+def activo() -> bool:
+    return PARTICIONES > 1
+
+
+def particion_de(claves: pd.Series, particiones: int, como_texto: bool = False) -> np.ndarray:
+    """
+    Número de partición (0..particiones-1) de cada fila según el hash de su
+    clave: filas con la misma clave caen siempre en la misma partición. Con
+    `como_texto` se usa el hash de str(clave), para que dos tablas que se
+    unen por la clave convertida a texto se repartan igual.
+    """
+    salida = np.empty(len(claves), dtype=np.int64)
+    for inicio in range(0, len(claves), FILAS_POR_BLOQUE_HASH):
+        bloque = claves.iloc[inicio:inicio + FILAS_POR_BLOQUE_HASH]
+        if como_texto:
+            bloque = bloque.astype(str)
+        salida[inicio:inicio + len(bloque)] = (
+            pd.util.hash_pandas_object(bloque, index=False).to_numpy() % particiones)
+    return salida
+
+
+def leer(ruta: str) -> pd.DataFrame:
+    with open(ruta, "rb") as f:
+        return pickle.load(f)
+
+
+def guardar(df: pd.DataFrame, ruta: str):
+    # pickle conserva exactamente los tipos (categóricas, Int64), así las
+    # particiones se vuelven a unir sin cambiar ningún dtype.
+    with open(ruta, "wb") as f:
+        pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class DirectorioParticiones:
+    """Directorio temporal de una ejecución particionada; se borra al salir del `with`."""
+
+    def __init__(self, prefijo: str):
+        self.prefijo = prefijo
+        self.ruta = ""
+
+    def __enter__(self) -> "DirectorioParticiones":
+        self.ruta = tempfile.mkdtemp(prefix=f"sherlock_{self.prefijo}_", dir=DIRECTORIO_PARTICIONES)
+        return self
+
+    def __exit__(self, *_):
+        shutil.rmtree(self.ruta, ignore_errors=True)
+
+    def archivo(self, nombre: str, particion: int) -> str:
+        return os.path.join(self.ruta, f"{nombre}-{particion:04d}.pkl")
+
+    def escribir(self, nombre: str, df: pd.DataFrame, particion_por_fila: np.ndarray,
+                 particiones: int, con_posicion: bool = False,
+                 incluir_vacias: bool = False) -> Dict[int, str]:
+        """
+        Escribe cada partición de `df` (filas en su orden original) y devuelve
+        {partición: ruta}. Con `con_posicion` agrega COLUMNA_FILA con la
+        posición de la fila en `df`, para restaurar el orden con `unir`.
+        """
+        rutas = {}
+        for particion in range(particiones):
+            posiciones = np.flatnonzero(particion_por_fila == particion)
+            if len(posiciones) == 0 and not incluir_vacias:
+                continue
+            parte = df.iloc[posiciones]
+            if con_posicion:
+                parte = parte.assign(**{COLUMNA_FILA: posiciones})
+            rutas[particion] = self.archivo(nombre, particion)
+            guardar(parte, rutas[particion])
+            del parte
+        return rutas
+
+
+def mapear(funcion: Callable[..., Any], tareas: List[Dict[str, Any]],
+           procesos: int = PROCESOS_PARTICIONES) -> List[Any]:
+    """
+    Ejecuta `funcion(**tarea)` por cada tarea y devuelve los resultados en
+    orden. Con más de un proceso usa un pool 'spawn' (la función debe ser de
+    nivel de módulo y lo que devuelve, chico: las tablas van por disco).
+    """
+    if procesos <= 1 or len(tareas) <= 1:
+        return [funcion(**tarea) for tarea in tareas]
+    with ProcessPoolExecutor(max_workers=min(procesos, len(tareas)),
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        futuros = [pool.submit(funcion, **tarea) for tarea in tareas]
+        return [futuro.result() for futuro in futuros]
+
+
+def unir(rutas: List[str], ordenar_por: Optional[str] = COLUMNA_FILA) -> pd.DataFrame:
+    """
+    Une las particiones procesadas. Por defecto restaura el orden original
+    (COLUMNA_FILA, que se quita); `ordenar_por` puede ser otra columna (ej.
+    la clave de un groupby, que en memoria sale ordenado por ella).
+    """
+    df = pd.concat([leer(ruta) for ruta in rutas], ignore_index=True)
+    if ordenar_por is None:
+        return df
+    df = df.sort_values(ordenar_por, kind="stable", ignore_index=True)
+    if ordenar_por == COLUMNA_FILA:
+        df = df.drop(columns=COLUMNA_FILA)
+    return df
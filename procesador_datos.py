@@ -2,7 +2,47 @@ import pandas as pd
 import numpy as np
 import io
 import os
-from typing import Dict, Any, List, Optional, Tuple, Set
+import hashlib
+import mmap
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, FrozenSet, List, Optional, Tuple, Set, Union
+
+import agregados_kpi
+import ejecutor_pasos
+import estado_pacientes
+import metricas
+import optimizacion_tipos
+import particiones
+import reglas_indice
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # La caché en Parquet es opcional.
+    pa = None
+    pq = None
+
+# --- Configuración de la lectura de libros Excel ---
+# Procesos usados para parsear libros en paralelo (1 = lectura secuencial).
+MAX_WORKERS_LECTURA = int(os.environ.get(
+    "SHERLOCK_WORKERS_LECTURA", min(4, os.cpu_count() or 1)))
+# Directorio de la caché de hojas ya parseadas ('' la desactiva).
+DIRECTORIO_CACHE = os.environ.get(
+    "SHERLOCK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "sherlock_cache"))
+
+# --- Copy-on-Write de pandas ---
+# Con CoW, las copias que se hacen al tomar un DataFrame (get_df_by_type) son
+# perezosas: los datos solo se duplican si luego se modifican. Sin CoW se
+# hacen copias completas, como antes.
+COPY_ON_WRITE = os.environ.get(
+    "SHERLOCK_COPY_ON_WRITE", "1").strip().lower() not in ("0", "false", "no")
+if COPY_ON_WRITE:
+    pd.set_option("mode.copy_on_write", True)
+
+# Tipos compactos (IDs Int64, categóricas, enteros reducidos) al cargar y al final.
+OPTIMIZAR_TIPOS = os.environ.get(
+    "SHERLOCK_OPTIMIZAR_TIPOS", "1").strip().lower() not in ("0", "false", "no")
 
 
 # --- Función de Ayuda: Reemplazar espacios con guiones bajos ---
@@ -18,6 +58,195 @@ def replace_spaces_with_underscores(name: str) -> str:
     return name.replace(' ', '_').replace('-', '_')
 
 
+# --- Lectura de libros Excel: una hoja por archivo, en paralelo y con caché ---
+# Un libro llega como ruta en disco (staging) o como bytes ya en memoria.
+OrigenLibro = Union[str, bytes]
+
+
+def _leer_hoja_excel(
+    origen: OrigenLibro, hojas_candidatas: List[str], omitibles_por_hoja: Dict[str, FrozenSet[str]]
+) -> Tuple[str, pd.DataFrame]:
+    """
+    Parsea solo la hoja que indica el índice para este archivo. Si ninguna
+    de las hojas candidatas existe en el libro, usa la primera hoja.
+    Las columnas DROP de esa hoja no se cargan (`usecols`).
+    Se ejecuta en los procesos del pool, por eso vive a nivel de módulo.
+    """
+    with pd.ExcelFile(origen if isinstance(origen, str) else io.BytesIO(origen)) as libro:
+        hoja = next(
+            (h for h in hojas_candidatas if h in libro.sheet_names), libro.sheet_names[0])
+        omitidas = omitibles_por_hoja.get(
+            hoja, omitibles_por_hoja.get(reglas_indice.HOJA_DEFAULT, frozenset()))
+        if omitidas:
+            return hoja, libro.parse(hoja, usecols=lambda col: col not in omitidas)
+        return hoja, libro.parse(hoja)
+
+
+def _huella_libro(origen: OrigenLibro) -> "hashlib._Hash":
+    """SHA-256 del libro; si está en disco se lee mapeado en memoria o por bloques."""
+    if not isinstance(origen, str):
+        return hashlib.sha256(origen)
+    huella = hashlib.sha256()
+    with open(origen, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapeado:
+                huella.update(mapeado)
+        except (ValueError, OSError):
+            # Archivos vacíos o sistemas sin mmap: lectura por bloques.
+            for bloque in iter(lambda: f.read(1024 * 1024), b""):
+                huella.update(bloque)
+    return huella
+
+
+def _clave_cache(
+    origen: OrigenLibro, hojas_candidatas: List[str], omitibles_por_hoja: Dict[str, FrozenSet[str]]
+) -> str:
+    """
+    Clave de la caché de una hoja: el libro, las hojas candidatas, las
+    columnas omitidas y la versión del código y de pandas/pyarrow (un cambio
+    en el parseo o la limpieza no debe servir hojas viejas).
+    """
+    huella = _huella_libro(origen)
+    huella.update(ejecutor_pasos.huella_codigo().encode("utf-8"))
+    huella.update(f"{pd.__version__}|{pa.__version__ if pa is not None else ''}".encode("utf-8"))
+    huella.update("|".join(hojas_candidatas).encode("utf-8"))
+    huella.update(repr(sorted((h, sorted(map(str, cols)))
+                  for h, cols in omitibles_por_hoja.items())).encode("utf-8"))
+    return huella.hexdigest()
+
+
+def _leer_cache(clave: str) -> Optional[Tuple[str, pd.DataFrame]]:
+    if not DIRECTORIO_CACHE or pq is None:
+        return None
+    ruta = os.path.join(DIRECTORIO_CACHE, f"{clave}.parquet")
+    if not os.path.exists(ruta):
+        return None
+    try:
+        tabla = pq.read_table(ruta)
+        hoja = tabla.schema.metadata[b"sherlock_hoja"].decode("utf-8")
+        df = tabla.to_pandas()
+        # read_excel deja NaN en las celdas vacías de columnas object; Parquet devuelve None.
+        cols_object = df.columns[df.dtypes == object]
+        if len(cols_object):
+            df[cols_object] = df[cols_object].where(df[cols_object].notna(), np.nan)
+        return hoja, df
+    except Exception as e_cache:
+        print(f"ADVERTENCIA: No se pudo leer la caché '{ruta}': {e_cache}")
+        return None
+
+
+def _guardar_cache(clave: str, hoja: str, df: pd.DataFrame):
+    if not DIRECTORIO_CACHE or pa is None:
+        return
+    try:
+        os.makedirs(DIRECTORIO_CACHE, exist_ok=True)
+        tabla = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(tabla.schema.metadata or {})
+        metadata[b"sherlock_hoja"] = hoja.encode("utf-8")
+        ruta = os.path.join(DIRECTORIO_CACHE, f"{clave}.parquet")
+        # Se escribe a un temporal y se renombra para no dejar archivos a medias.
+        pq.write_table(tabla.replace_schema_metadata(metadata), ruta + ".tmp")
+        os.replace(ruta + ".tmp", ruta)
+    except Exception as e_cache:
+        # Columnas con tipos mezclados no se pueden guardar en Parquet: solo se omite la caché.
+        print(f"ADVERTENCIA: No se guardó en caché la hoja '{hoja}': {e_cache}")
+
+
+def leer_libros_excel(
+    archivos: List[Tuple[str, OrigenLibro, List[str], Dict[str, FrozenSet[str]]]], advertencias_carga: List[str]
+) -> List[Optional[Tuple[str, pd.DataFrame]]]:
+    """
+    Recibe tuplas (nombre de archivo, ruta o contenido, hojas candidatas, columnas
+    omitibles por hoja) y devuelve,
+    en el mismo orden, (hoja leída, DataFrame) o None si el archivo falló.
+    Los libros sin cambios se toman de la caché; el resto se parsea en un pool de procesos.
+    """
+    resultados: List[Optional[Tuple[str, pd.DataFrame]]] = [None] * len(archivos)
+    pendientes: List[Tuple[int, str]] = []
+    for i, (nombre_archivo, origen, hojas_candidatas, omitibles) in enumerate(archivos):
+        try:
+            clave = _clave_cache(origen, hojas_candidatas, omitibles)
+        except OSError as e_file:
+            msg = f"ERROR procesando archivo de datos '{nombre_archivo}': {e_file}"
+            advertencias_carga.append(msg)
+            print(msg)
+            continue
+        en_cache = _leer_cache(clave)
+        if en_cache is not None:
+            print(f"    - '{nombre_archivo}' tomado de la caché (hoja '{en_cache[0]}').")
+            resultados[i] = en_cache
+        else:
+            pendientes.append((i, clave))
+
+    def _registrar_error(i: int, e_file: Exception):
+        msg = f"ERROR procesando archivo de datos '{archivos[i][0]}': {e_file}"
+        advertencias_carga.append(msg)
+        print(msg)
+
+    workers = min(MAX_WORKERS_LECTURA, len(pendientes))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futuros = [(i, clave, pool.submit(_leer_hoja_excel, *archivos[i][1:]))
+                       for i, clave in pendientes]
+            for i, clave, futuro in futuros:
+                try:
+                    resultados[i] = futuro.result()
+                except Exception as e_file:
+                    _registrar_error(i, e_file)
+    else:
+        for i, clave in pendientes:
+            try:
+                resultados[i] = _leer_hoja_excel(*archivos[i][1:])
+            except Exception as e_file:
+                _registrar_error(i, e_file)
+
+    for i, clave in pendientes:
+        if resultados[i] is not None:
+            _guardar_cache(clave, *resultados[i])
+    return resultados
+
+
+def _origen_libro(archivo: Any) -> OrigenLibro:
+    """Los archivos en staging se leen por ruta; los demás, desde `archivo.file`."""
+    ruta = getattr(archivo, "ruta", None)
+    if ruta:
+        return ruta
+    archivo.file.seek(0)
+    return archivo.file.read()
+
+
+def _contenido_indice(index_file: Any) -> bytes:
+    origen = _origen_libro(index_file)
+    if isinstance(origen, bytes):
+        return origen
+    with open(origen, "rb") as f:
+        return f.read()
+
+
+def limpiar_hoja(df: pd.DataFrame, regla: reglas_indice.ReglaHoja) -> pd.DataFrame:
+    """
+    Aplica a una hoja recién leída los renombres y DROP del índice (sobre el
+    mismo DataFrame, sin copiarlo) y compacta sus tipos.
+    """
+    if regla.renombres:
+        df.rename(columns=regla.renombres, inplace=True)
+
+    # Columnas que realmente existen en el DataFrame para evitar errores
+    actual_cols_to_drop = [
+        col for col in regla.columnas_drop_final if col in df.columns]
+
+    if actual_cols_to_drop:
+        df.drop(columns=actual_cols_to_drop,
+                inplace=True, errors='ignore')
+
+    # Al cargar solo se compactan IDs y texto; los enteros se reducen
+    # al final para no arriesgar desbordes en cálculos intermedios.
+    if OPTIMIZAR_TIPOS:
+        df = optimizacion_tipos.optimizar_tipos(
+            df, reducir_numericos=False)
+    return df
+
+
 # --- Función 1: Carga y Limpieza Inicial ---
 
 def load_dataframes_from_uploads(
@@ -25,38 +254,11 @@ def load_dataframes_from_uploads(
 ) -> Tuple[Dict[str, pd.DataFrame], Dict[tuple[str, str], dict[str, str]], set[tuple[str, str, str]], List[str]]:
     processed_dfs: Dict[str, pd.DataFrame] = {}
     advertencias_carga: List[str] = []
-    rename_map_details: Dict[tuple[str, str], dict[str, str]] = {}
-    drop_columns_set: set[tuple[str, str, str]] = set()
 
+    metricas.marcar_etapa("indice")
     try:
-        index_file.file.seek(0)
-        indice_df = pd.read_excel(io.BytesIO(
-            index_file.file.read()), sheet_name=0)
-        col_map = {'Archivo_Idx': 'Archivo', 'Hoja_Idx': 'Sheet', 'Original_Idx': 'Columna',
-                   'Nuevo_Idx': 'Nombre unificado', 'Accion_Idx': 'Acción'}
-        if not all(col in indice_df.columns for col in col_map.values()):
-            raise ValueError(
-                f"Faltan columnas en índice: {[c for c in col_map.values() if c not in indice_df.columns]}")
-
-        for _, row in indice_df.iterrows():
-            nombre_archivo_indice_con_ext = str(
-                row[col_map['Archivo_Idx']]).strip()
-            archivo_base_idx, _ = os.path.splitext(
-                nombre_archivo_indice_con_ext)
-            hoja_idx = str(row[col_map['Hoja_Idx']]).strip() if pd.notna(
-                row[col_map['Hoja_Idx']]) else 'default'
-            original_col_idx = str(row[col_map['Original_Idx']]).strip()
-            nuevo_col_idx = str(row[col_map['Nuevo_Idx']]).strip()
-            accion_val_idx = str(row[col_map['Accion_Idx']]).strip().upper()
-
-            if accion_val_idx == 'DROP':
-                drop_columns_set.add(
-                    (archivo_base_idx, hoja_idx, original_col_idx))
-            elif accion_val_idx == 'KEEP' and pd.notna(nuevo_col_idx) and nuevo_col_idx != original_col_idx:
-                if (archivo_base_idx, hoja_idx) not in rename_map_details:
-                    rename_map_details[(archivo_base_idx, hoja_idx)] = {}
-                rename_map_details[(archivo_base_idx, hoja_idx)
-                                   ][original_col_idx] = nuevo_col_idx
+        reglas = reglas_indice.cargar_reglas_indice(_contenido_indice(index_file))
+        advertencias_carga.extend(reglas.advertencias)
     except Exception as e:
         msg = f"ERROR CRÍTICO al leer índice: {e}"
         advertencias_carga.append(msg)
@@ -65,43 +267,33 @@ def load_dataframes_from_uploads(
         traceback.print_exc()
         return {}, {}, set(), advertencias_carga
 
+    archivos_a_leer = []
     for uploaded_file_obj in data_files:
+        base_name, _ = os.path.splitext(uploaded_file_obj.filename)
+        archivos_a_leer.append((uploaded_file_obj.filename, _origen_libro(uploaded_file_obj),
+                                reglas.hojas_de(base_name), reglas.omitibles_por_hoja(base_name)))
+    metricas.marcar_etapa("leer_excel")
+    hojas_leidas = leer_libros_excel(archivos_a_leer, advertencias_carga)
+
+    metricas.marcar_etapa("limpiar_hojas")
+
+    for uploaded_file_obj, hoja_leida in zip(data_files, hojas_leidas):
+        if hoja_leida is None:
+            continue
         original_filename = uploaded_file_obj.filename
         try:
             base_name, _ = os.path.splitext(original_filename)
-            df_sheets = pd.read_excel(io.BytesIO(
-                uploaded_file_obj.file.read()), sheet_name=None)
-            for sheet_name, df_original in df_sheets.items():
-                # Esta lógica busca la primera hoja que coincida, asumiendo una por archivo.
-                df_cleaned = df_original.copy()
-                rename_dict = rename_map_details.get(
-                    (base_name, sheet_name), rename_map_details.get((base_name, 'default'), {}))
-                if rename_dict:
-                    df_cleaned.rename(columns=rename_dict, inplace=True)
-
-                drop_cols_originals = {col for (ab, h, col) in drop_columns_set if ab == base_name and (
-                    h == sheet_name or h == 'default')}
-
-                # Nombres de columnas a eliminar después de un posible renombrado
-                cols_to_drop_final = {rename_dict.get(
-                    col, col) for col in drop_cols_originals}
-
-                # Columnas que realmente existen en el DataFrame para evitar errores
-                actual_cols_to_drop = [
-                    col for col in cols_to_drop_final if col in df_cleaned.columns]
-
-                if actual_cols_to_drop:
-                    df_cleaned.drop(columns=actual_cols_to_drop,
-                                    inplace=True, errors='ignore')
-
-                # La clave del DF se crea a partir del nombre del archivo base, CON espacios si los tiene.
-                df_key_name = f"{base_name}_df"
-                if df_key_name in processed_dfs:
-                    advertencias_carga.append(
-                        f"ADVERTENCIA: DF '{df_key_name}' ya existe. Se SOBREESCRIBIRÁ.")
-                processed_dfs[df_key_name] = df_cleaned
-                # Solo procesamos la primera hoja que encontramos por archivo para simplificar
-                break
+            sheet_name, df_original = hoja_leida
+            # df_original acaba de leerse y no lo usa nadie más: se limpia sin copiarlo.
+            df_cleaned = limpiar_hoja(
+                df_original, reglas.regla_para(base_name, sheet_name))
+
+            # La clave del DF se crea a partir del nombre del archivo base, CON espacios si los tiene.
+            df_key_name = f"{base_name}_df"
+            if df_key_name in processed_dfs:
+                advertencias_carga.append(
+                    f"ADVERTENCIA: DF '{df_key_name}' ya existe. Se SOBREESCRIBIRÁ.")
+            processed_dfs[df_key_name] = df_cleaned
         except Exception as e_file:
             msg = f"ERROR procesando archivo de datos '{original_filename}': {e_file}"
             advertencias_carga.append(msg)
@@ -109,315 +301,710 @@ def load_dataframes_from_uploads(
             import traceback
             traceback.print_exc()
 
-    return processed_dfs, rename_map_details, drop_columns_set, advertencias_carga
+    return processed_dfs, reglas.rename_map_details(), reglas.drop_columns_set(), advertencias_carga
 
 # --- Función 2: Utilidad para Obtener DF ---
 
 
 def get_df_by_type(processed_dfs: Dict[str, pd.DataFrame], df_key_buscado: str, advertencias_list: List[str]) -> Optional[pd.DataFrame]:
+    """
+    Devuelve un DataFrame propio del que llama: puede modificarlo sin tocar
+    `processed_dfs`. Con Copy-on-Write la copia es perezosa.
+    """
     if df_key_buscado in processed_dfs:
-        return processed_dfs[df_key_buscado].copy()
+        return processed_dfs[df_key_buscado].copy(deep=not COPY_ON_WRITE)
     else:
         msg = f"ADVERTENCIA: No se encontró DataFrame '{df_key_buscado}'. Disponibles: {list(processed_dfs.keys())}"
         advertencias_list.append(msg)
         print(msg)
         return None
 
-# --- Función 3: El Cerebro del Procesamiento y Enriquecimiento ---
+# --- Funciones de Ayuda: Edad y Rango de Edad de los pacientes ---
+# Bordes (inclusivos por la derecha) y etiquetas de Rango_de_Edad.
+BORDES_RANGO_EDAD = [-np.inf, 17, 25, 35, 50, 65, np.inf]
+ETIQUETAS_RANGO_EDAD = ['Menor a 18', '18 a 25',
+                        '26 a 35', '36 a 50', '51 a 65', 'Mayor de 65']
+RANGO_EDAD_DESCONOCIDO = 'Desconocido'
 
 
-def generar_insights_pacientes(
-    processed_dfs: Dict[str, pd.DataFrame], all_advertencias: List[str]
-) -> Dict[str, pd.DataFrame]:
+def calcular_edades(fechas_nacimiento: pd.Series, fecha_referencia: pd.Timestamp) -> pd.Series:
+    """
+    Edad en años cumplidos a `fecha_referencia` (días / 365.25, truncado).
+    Fechas inválidas o edades fuera de 0-120 quedan como NA.
+    """
+    fechas = pd.to_datetime(fechas_nacimiento, errors='coerce').dt.normalize()
+    dias = (fecha_referencia.normalize() - fechas).dt.days
+    edades = np.trunc(dias / 365.25)
+    return edades.where((edades >= 0) & (edades <= 120)).astype('Int64')
 
-    resultados_dfs: Dict[str, pd.DataFrame] = {}
-    print(f"--- Log Sherlock (BG Task): Inicio de generar_insights_pacientes...")
 
-    try:
-        # --- PASO 1: Preparar Tablas de Dimensiones ---
-        print("--- PASO 1: Preparando tablas de dimensiones...")
-        dimension_mapping = {
-            "Tipos de pacientes_df": "dimension_tipos_pacientes",
-            "Tabla_Procedimientos_df": "dimension_procedimientos",
-            "Sucursal_df": "dimension_sucursales",
-            "Lada_df": "dimension_lada",
-            "Tratamiento Generado Mex_df": "dimension_tratamientos_generados",
-            "Medios_de_pago_df": "dimension_medios_de_pago"
-        }
-        for df_key, table_name in dimension_mapping.items():
-            df_dim = get_df_by_type(processed_dfs, df_key, all_advertencias)
-            if df_dim is not None:
-                df_dim.columns = [replace_spaces_with_underscores(
-                    col) for col in df_dim.columns]
-                resultados_dfs[table_name] = df_dim.copy()
-
-        # --- PASO 1.5: Añadir 'Sucursal' a dimension_tratamientos_generados ---
+def categorizar_rangos_edad(edades: pd.Series) -> pd.Series:
+    """
+    Asigna el Rango_de_Edad como columna categórica; las edades nulas
+    o no numéricas quedan como 'Desconocido'.
+    """
+    edades_num = np.trunc(pd.to_numeric(
+        edades, errors='coerce').astype('float64'))
+    rangos = pd.cut(edades_num, bins=BORDES_RANGO_EDAD,
+                    labels=ETIQUETAS_RANGO_EDAD, right=True)
+    return rangos.cat.add_categories([RANGO_EDAD_DESCONOCIDO]).fillna(RANGO_EDAD_DESCONOCIDO)
+
+
+# --- Funciones de Ayuda: Etiqueta_Cita_Paciente ---
+ETIQUETA_CITA_INDETERMINADA = 'Indeterminada'
+# Tabla de reglas (etiqueta, situación del paciente, momento de la cita).
+# Situación: 'nuevo' (aún no tenía una cita atendida antes de esta),
+# 'mismo_mes' (recurrente en el mes en que debutó) o 'mes_posterior'.
+# Momento: 'agenda' (cita de hoy en adelante), 'pasada_asistida',
+# 'pasada_no_asistida', o 'asistida'/'no_asistida' sin mirar la fecha.
+# Gana la primera regla que se cumple; hoy son excluyentes entre sí, así
+# que el orden solo importa si se agregan reglas que se solapen.
+REGLAS_ETIQUETA_CITA = [
+    ("Paciente Nuevo en Agenda", 'nuevo', 'agenda'),
+    ("Paciente Nuevo Atendido", 'nuevo', 'pasada_asistida'),
+    ("Paciente Nuevo No Atendido", 'nuevo', 'pasada_no_asistida'),
+    ("Paciente Atendido Mismo Mes que Debutó", 'mismo_mes', 'asistida'),
+    ("Paciente No Atendido Mismo Mes que Debutó", 'mismo_mes', 'no_asistida'),
+    ("Paciente Recurrente en Agenda", 'mes_posterior', 'agenda'),
+    ("Paciente Recurrente Atendido", 'mes_posterior', 'pasada_asistida'),
+    ("Paciente Recurrente No Atendido", 'mes_posterior', 'pasada_no_asistida'),
+]
+
+
+# Etiquetas que dependen de la fecha de referencia: al pasar la cita dejan de valer.
+ETIQUETAS_EN_AGENDA = [etiqueta for etiqueta, _, momento in REGLAS_ETIQUETA_CITA if momento == 'agenda']
+
+
+def _clave_mes(fechas: np.ndarray) -> np.ndarray:
+    """Año * 12 + mes como entero (NaT queda con un valor que nunca coincide)."""
+    return fechas.astype('datetime64[M]').astype(np.int64)
+
+
+def etiquetar_citas(
+    fecha_cita: pd.Series, primera_atendida: pd.Series, asistio: pd.Series,
+    fecha_referencia: pd.Timestamp
+) -> pd.Categorical:
+    """
+    Clasifica cada cita según REGLAS_ETIQUETA_CITA en una sola pasada
+    (`np.select`) y devuelve la etiqueta como categórica; las citas que no
+    cumplen ninguna regla quedan como 'Indeterminada'.
+    """
+    fecha = fecha_cita.to_numpy(dtype='datetime64[ns]')
+    primera = primera_atendida.to_numpy(dtype='datetime64[ns]')
+    hoy = np.datetime64(pd.Timestamp(fecha_referencia).to_datetime64(), 'ns')
+    fecha_valida = ~np.isnat(fecha)
+    primera_existe = ~np.isnat(primera)
+    asistida = (asistio == 1).to_numpy()
+    mismo_mes_debut = _clave_mes(fecha) == _clave_mes(primera)
+
+    # Las comparaciones con NaT dan False, igual que en pandas.
+    recurrente = primera_existe & (fecha > primera)
+    situaciones = {
+        'nuevo': fecha_valida & (~primera_existe | (fecha <= primera)),
+        'mismo_mes': recurrente & mismo_mes_debut,
+        'mes_posterior': recurrente & ~mismo_mes_debut,
+    }
+    en_agenda = fecha >= hoy
+    pasada = fecha < hoy
+    momentos = {
+        'agenda': en_agenda,
+        'pasada_asistida': pasada & asistida,
+        'pasada_no_asistida': pasada & ~asistida,
+        'asistida': asistida,
+        'no_asistida': ~asistida,
+    }
+    condiciones = [situaciones[situacion] & momentos[momento]
+                   for _, situacion, momento in REGLAS_ETIQUETA_CITA]
+    etiquetas = [etiqueta for etiqueta, _, _ in REGLAS_ETIQUETA_CITA]
+    codigos = np.select(condiciones, np.arange(len(etiquetas)), default=len(etiquetas))
+    return pd.Categorical.from_codes(
+        codigos, categories=etiquetas + [ETIQUETA_CITA_INDETERMINADA])
+
+
+# --- Funciones de Ayuda: Timestamps y duración de las citas ---
+def horas_a_timedelta(horas: pd.Series) -> pd.Series:
+    """
+    Convierte horas 'HH:MM:SS[.f]' (texto o `datetime.time` de Excel) a la
+    duración desde la medianoche. Lo que no tenga ese formato queda como NaT.
+    Las horas distintas son pocas, así que se parsea cada valor único una vez.
+    """
+    codigos, unicos = pd.factorize(horas)
+    texto = pd.Series(unicos, dtype=object).astype(str).str.strip()
+    deltas = pd.to_timedelta(
+        texto.where(texto.str.contains(':', regex=False)), errors='coerce')
+    deltas = deltas.where((deltas >= pd.Timedelta(0)) & (deltas < pd.Timedelta(days=1)))
+    # El código -1 (hora nula) apunta al NaT agregado al final.
+    valores = np.append(deltas.to_numpy(dtype='timedelta64[ns]'), np.timedelta64('NaT', 'ns'))
+    return pd.Series(valores[codigos], index=horas.index)
+
+
+def combinar_fecha_hora(fechas: pd.Series, horas: pd.Series) -> Tuple[pd.Series, int]:
+    """
+    Timestamp de la cita = fecha (ya normalizada) + hora como timedelta.
+    Las filas que el camino vectorizado no entiende (ej. '9:15' o '9:15 AM')
+    se reintentan con el parseo de texto de antes, fila por fila. Devuelve
+    también cuántas filas con fecha y hora no se pudieron interpretar.
+    """
+    timestamps = fechas + horas_a_timedelta(horas)
+    residuales = timestamps.isna() & fechas.notna() & horas.notna()
+    if not residuales.any():
+        return timestamps, 0
+    fecha_texto = fechas[residuales].dt.strftime('%Y-%m-%d')
+    hora_texto = horas[residuales].astype(str).str.strip()
+    timestamps[residuales] = [pd.to_datetime(f"{f} {h}", errors='coerce') if h else pd.NaT
+                              for f, h in zip(fecha_texto, hora_texto)]
+    no_interpretables = int((timestamps[residuales].isna() & (hora_texto != '')).sum())
+    return timestamps, no_interpretables
+
+
+# --- Función 3: Pasos de generar_insights_pacientes (grafo en pasos_insights) ---
+# Tablas de dimensión: DataFrame de origen -> tabla final.
+# (Sus claves e índices se declaran en diseno_tablas.DISENO_TABLAS.)
+DIMENSION_MAPPING = {
+    "Tipos de pacientes_df": "dimension_tipos_pacientes",
+    "Tabla_Procedimientos_df": "dimension_procedimientos",
+    "Sucursal_df": "dimension_sucursales",
+    "Lada_df": "dimension_lada",
+    "Tratamiento Generado Mex_df": "dimension_tratamientos_generados",
+    "Medios_de_pago_df": "dimension_medios_de_pago"
+}
+# Columnas que se convierten a fecha en cualquier tabla de resultados.
+COLUMNAS_DE_FECHA = {
+    'Procedimiento_Fecha_Realizacion', 'Fecha_Cita', 'Cita_Creacion',
+    'Fecha_Primera_Cita_Atendida_Real', 'Fecha_del_Gasto', 'Fecha_de_nacimiento',
+    'pago_fecha_recepcion', 'Pago_fecha_recepcion', 'Tratamiento_fecha_de_generacion'
+}
+
+
+def _paso_dimension(entradas: Dict[str, pd.DataFrame], advertencias: List[str],
+                    df_key: str, table_name: str) -> Dict[str, pd.DataFrame]:
+    # --- PASO 1: Preparar Tablas de Dimensiones ---
+    print(f"--- PASO 1: Preparando la tabla de dimensión '{table_name}'...")
+    df_dim = get_df_by_type(entradas, df_key, advertencias)
+    if df_dim is None:
+        return {}
+    df_dim.columns = [replace_spaces_with_underscores(
+        col) for col in df_dim.columns]
+    return {table_name: df_dim}
+
+
+def _paso_presupuestos(entradas: Dict[str, pd.DataFrame], advertencias: List[str]) -> Dict[str, pd.DataFrame]:
+    df_presupuesto_base = get_df_by_type(
+        entradas, "Presupuesto por Accion_df", advertencias)
+    if df_presupuesto_base is None:
+        return {}
+    df_presupuesto_base.columns = [replace_spaces_with_underscores(
+        col) for col in df_presupuesto_base.columns]
+    return {'hechos_presupuesto_detalle': df_presupuesto_base}
+
+
+def _paso_tratamientos_generados(entradas: Dict[str, pd.DataFrame], advertencias: List[str]) -> Dict[str, pd.DataFrame]:
+    # --- PASO 1.5: Añadir 'Sucursal' a dimension_tratamientos_generados ---
+    print(
+        "--- PASO 1.5: Enriqueciendo dimension_tratamientos_generados con Sucursal...")
+    df_tratamientos_generados = get_df_by_type(
+        entradas, "Tratamiento Generado Mex_df", advertencias)
+    if df_tratamientos_generados is None:
+        advertencias.append(
+            "ADVERTENCIA: No se pudo añadir 'Sucursal' a dimension_tratamientos_generados.")
+        return {}
+    df_tratamientos_generados.columns = [replace_spaces_with_underscores(
+        col) for col in df_tratamientos_generados.columns]
+    df_presupuesto_base = entradas.get('hechos_presupuesto_detalle')
+    if df_presupuesto_base is not None and 'ID_Tratamiento' in df_presupuesto_base and 'Sucursal' in df_presupuesto_base:
+        mapa_sucursales = df_presupuesto_base[[
+            'ID_Tratamiento', 'Sucursal']].drop_duplicates(subset=['ID_Tratamiento'])
+        df_tratamientos_generados = pd.merge(
+            df_tratamientos_generados, mapa_sucursales, on='ID_Tratamiento', how='left')
         print(
-            "--- PASO 1.5: Enriqueciendo dimension_tratamientos_generados con Sucursal...")
-        df_presupuesto_base = get_df_by_type(
-            processed_dfs, "Presupuesto por Accion_df", all_advertencias)
-
-        if df_presupuesto_base is not None:
-            df_presupuesto_base.columns = [replace_spaces_with_underscores(
-                col) for col in df_presupuesto_base.columns]
-
-        df_tratamientos_generados = resultados_dfs.get(
-            "dimension_tratamientos_generados")
-        if df_presupuesto_base is not None and df_tratamientos_generados is not None and 'ID_Tratamiento' in df_presupuesto_base and 'Sucursal' in df_presupuesto_base:
-            mapa_sucursales = df_presupuesto_base[[
-                'ID_Tratamiento', 'Sucursal']].drop_duplicates(subset=['ID_Tratamiento'])
-            df_tratamientos_actualizado = pd.merge(
-                df_tratamientos_generados, mapa_sucursales, on='ID_Tratamiento', how='left')
-            resultados_dfs['dimension_tratamientos_generados'] = df_tratamientos_actualizado
+            "    - ¡Éxito! La columna 'Sucursal' ha sido agregada a dimension_tratamientos_generados.")
+    else:
+        advertencias.append(
+            "ADVERTENCIA: No se pudo añadir 'Sucursal' a dimension_tratamientos_generados.")
+    return {'dimension_tratamientos_generados': df_tratamientos_generados}
+
+
+def _paso_pacientes(entradas: Dict[str, pd.DataFrame], advertencias: List[str],
+                    fecha_referencia: pd.Timestamp) -> Dict[str, pd.DataFrame]:
+    # --- PASO 2: Procesar y Enriquecer `hechos_pacientes` ---
+    print("--- PASO 2: Procesando y enriqueciendo pacientes...")
+    df_pacientes_base = get_df_by_type(
+        entradas, "Pacientes_Nuevos_df", advertencias)
+    if df_pacientes_base is None:
+        return {}
+    df_pacientes_enriquecido = df_pacientes_base
+    df_pacientes_enriquecido.columns = [replace_spaces_with_underscores(
+        col) for col in df_pacientes_enriquecido.columns]
+
+    if 'Fecha_de_nacimiento' in df_pacientes_enriquecido.columns:
+        df_pacientes_enriquecido['Edad'] = calcular_edades(
+            df_pacientes_enriquecido['Fecha_de_nacimiento'], fecha_referencia)
+
+    if 'Edad' in df_pacientes_enriquecido.columns:
+        df_pacientes_enriquecido['Rango_de_Edad'] = categorizar_rangos_edad(
+            df_pacientes_enriquecido['Edad'])
+
+    if 'dimension_tipos_pacientes' in entradas and 'Tipo_Dentalink' in df_pacientes_enriquecido.columns:
+        df_dim_tipos_pac = entradas['dimension_tipos_pacientes']
+        if 'Tipo_Dentalink' in df_dim_tipos_pac.columns and 'Paciente_Origen' in df_dim_tipos_pac.columns:
+            df_origen_merge = df_dim_tipos_pac[[
+                'Tipo_Dentalink', 'Paciente_Origen']].drop_duplicates(subset=['Tipo_Dentalink'])
+            df_pacientes_enriquecido = pd.merge(
+                df_pacientes_enriquecido, df_origen_merge, on='Tipo_Dentalink', how='left')
+
+    return {'hechos_pacientes': df_pacientes_enriquecido}
+
+
+COLUMNAS_CITAS_MOTIVO = ['ID_Cita', 'Cita_Creacion', 'Hora_Inicio_Cita',
+                         'Hora_Fin_Cita', 'Motivo_Cita', 'Sucursal', 'ID_Tratamiento']
+
+
+def _unir_citas_motivo(df_citas_filtrado: pd.DataFrame, df_citas_mot: pd.DataFrame,
+                       cols_exist: List[str]) -> pd.DataFrame:
+    col_id_cita = 'ID_Cita'
+    df_citas_filtrado[col_id_cita] = df_citas_filtrado[col_id_cita].astype(
+        str)
+    df_citas_mot[col_id_cita] = df_citas_mot[col_id_cita].astype(
+        str)
+    return pd.merge(df_citas_filtrado, df_citas_mot[cols_exist].drop_duplicates(
+        subset=[col_id_cita]), on=col_id_cita, how='left')
+
+
+def _primeras_citas_atendidas(hechos_citas_df: pd.DataFrame) -> Optional[pd.DataFrame]:
+    """Fecha de la primera cita atendida por paciente (None si no hay citas atendidas)."""
+    col_asistida, col_id_paciente, col_fecha_cita = 'Cita_asistida', 'ID_Paciente', 'Fecha_Cita'
+    df_atendidas = hechos_citas_df[(hechos_citas_df[col_asistida] == 1) & (
+        hechos_citas_df[col_fecha_cita].notna())]
+    if df_atendidas.empty:
+        return None
+    return df_atendidas.groupby(col_id_paciente)[col_fecha_cita].min(
+    ).reset_index().rename(columns={col_fecha_cita: 'Fecha_Primera_Cita_Atendida_Real'})
+
+
+def _enriquecer_citas(hechos_citas_df: pd.DataFrame, primera_cita: Optional[pd.DataFrame],
+                      fecha_referencia: pd.Timestamp) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    """
+    Primera cita atendida, etiqueta, timestamps y duración de cada cita. Todo
+    es fila a fila (salvo `primera_cita`, que ya viene calculada), así que
+    sirve igual para la tabla completa o para una partición. Devuelve también
+    las filas con hora no interpretable por columna de hora.
+    """
+    col_asistida, col_id_paciente, col_fecha_cita = 'Cita_asistida', 'ID_Paciente', 'Fecha_Cita'
+    if primera_cita is not None:
+        hechos_citas_df = pd.merge(
+            hechos_citas_df, primera_cita, on=col_id_paciente, how='left')
+    if 'Fecha_Primera_Cita_Atendida_Real' not in hechos_citas_df.columns:
+        hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'] = pd.NaT
+
+    hechos_citas_df['Etiqueta_Cita_Paciente'] = etiquetar_citas(
+        hechos_citas_df[col_fecha_cita], hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'],
+        hechos_citas_df[col_asistida], fecha_referencia)
+
+    no_interpretables_por_hora: Dict[str, int] = {}
+    col_hora_inicio, col_hora_fin = 'Hora_Inicio_Cita', 'Hora_Fin_Cita'
+    if col_hora_inicio in hechos_citas_df.columns and col_hora_fin in hechos_citas_df.columns:
+        for col_hora, col_timestamp in ((col_hora_inicio, 'Inicio_Cita_Timestamp'),
+                                        (col_hora_fin, 'Fin_Cita_Timestamp')):
+            hechos_citas_df[col_timestamp], no_interpretables_por_hora[col_hora] = combinar_fecha_hora(
+                hechos_citas_df[col_fecha_cita], hechos_citas_df[col_hora])
+            hechos_citas_df[col_hora] = hechos_citas_df[col_hora].astype(
+                str)
+        duracion = (hechos_citas_df['Fin_Cita_Timestamp'] -
+                    hechos_citas_df['Inicio_Cita_Timestamp']).dt.total_seconds()
+        hechos_citas_df['Duracion_Cita_Minutos'] = duracion / 60
+    return hechos_citas_df, no_interpretables_por_hora
+
+
+def _primera_cita_del_lote(hechos_citas_df: pd.DataFrame, advertencias: List[str]) -> Optional[pd.DataFrame]:
+    """
+    Primera cita atendida de los pacientes del lote: con el estado por
+    paciente activo (estado_pacientes.py), combinando el lote con lo guardado
+    de corridas anteriores; si no, con las citas del lote.
+    """
+    if not estado_pacientes.activo():
+        return _primeras_citas_atendidas(hechos_citas_df)
+    estado = estado_pacientes.cargar(hechos_citas_df['ID_Paciente'].dtype, advertencias)
+    reenviadas = estado_pacientes.primeras_reenviadas(
+        hechos_citas_df['ID_Cita'], set(estado['ID_Cita_Primera'].dropna()))
+    return estado_pacientes.actualizar(
+        estado_pacientes.resumen_lote(hechos_citas_df), reenviadas, estado, advertencias)
+
+
+# Trabajo de cada partición (nivel de módulo para poder usarse en el pool de procesos).
+def _citas_particion_unir(ruta_citas: str, ruta_motivo: str, ruta_salida: str, cols_exist: List[str],
+                          ids_primera_estado: Optional[Set[str]] = None) -> Any:
+    """Sin estado por paciente devuelve la primera cita parcial; con estado, (resumen parcial, reenviadas)."""
+    hechos_citas_df = _unir_citas_motivo(
+        particiones.leer(ruta_citas), particiones.leer(ruta_motivo), cols_exist)
+    particiones.guardar(hechos_citas_df, ruta_salida)
+    if ids_primera_estado is None:
+        return _primeras_citas_atendidas(hechos_citas_df)
+    return (estado_pacientes.resumen_lote(hechos_citas_df),
+            estado_pacientes.primeras_reenviadas(hechos_citas_df['ID_Cita'], ids_primera_estado))
+
+
+def _citas_particion_enriquecer(ruta_entrada: str, ruta_salida: str, primera_cita: Optional[pd.DataFrame],
+                                fecha_referencia: pd.Timestamp) -> Dict[str, int]:
+    hechos_citas_df, no_interpretables_por_hora = _enriquecer_citas(
+        particiones.leer(ruta_entrada), primera_cita, fecha_referencia)
+    particiones.guardar(hechos_citas_df, ruta_salida)
+    return no_interpretables_por_hora
+
+
+def _citas_por_particiones(df_citas_pac: pd.DataFrame, df_citas_mot: pd.DataFrame, cols_exist: List[str],
+                           fecha_referencia: pd.Timestamp,
+                           advertencias: List[str]) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    """
+    Igual que el camino en memoria de _paso_citas, pero por particiones de
+    ID_Cita (la clave del merge con motivos): cada partición se une y
+    enriquece por separado. La primera cita atendida por paciente cruza
+    particiones, así que se combinan los mínimos parciales antes de enriquecer.
+    """
+    n = particiones.PARTICIONES
+    col_fecha_cita = 'Fecha_Cita'
+    mascara = (df_citas_pac['Cita_duplicada'] == 0).to_numpy()
+    filas = np.flatnonzero(mascara)
+    # La fecha se interpreta sobre las citas no duplicadas, como en memoria
+    # (pd.to_datetime deduce el formato de la primera fila), y solo después se reparte.
+    fechas = pd.to_datetime(
+        df_citas_pac[col_fecha_cita].iloc[filas], errors='coerce').dt.normalize()
+    fechas_completas = pd.Series(pd.NaT, index=df_citas_pac.index, dtype=fechas.dtype)
+    fechas_completas.iloc[filas] = fechas.array
+    df_citas_pac[col_fecha_cita] = fechas_completas
+    del fechas, fechas_completas
+    # Las duplicadas quedan en la partición -1, que no se escribe.
+    particion_por_fila = particiones.particion_de(df_citas_pac['ID_Cita'], n, como_texto=True)
+    particion_por_fila[~mascara] = -1
+    print(f"    - Citas en {n} particiones ({len(filas):,} filas, "
+          f"{particiones.PROCESOS_PARTICIONES} proceso(s)).")
+
+    with particiones.DirectorioParticiones("citas") as directorio:
+        rutas_citas = directorio.escribir("citas", df_citas_pac, particion_por_fila, n, con_posicion=True)
+        rutas_motivo = directorio.escribir(
+            "motivo", df_citas_mot[cols_exist], particiones.particion_de(df_citas_mot['ID_Cita'], n, como_texto=True),
+            n, incluir_vacias=True)
+
+        estado = ids_primera_estado = None
+        if estado_pacientes.activo():
+            estado = estado_pacientes.cargar(df_citas_pac['ID_Paciente'].dtype, advertencias)
+            ids_primera_estado = set(estado['ID_Cita_Primera'].dropna())
+        parciales = particiones.mapear(_citas_particion_unir, [
+            {'ruta_citas': ruta, 'ruta_motivo': rutas_motivo[p], 'ruta_salida': directorio.archivo("unidas", p),
+             'cols_exist': cols_exist, 'ids_primera_estado': ids_primera_estado}
+            for p, ruta in rutas_citas.items()])
+        primera_cita = None
+        if estado is not None:
+            primera_cita = estado_pacientes.actualizar(
+                estado_pacientes.combinar_resumenes(resumen for resumen, _ in parciales),
+                set().union(*(reenviadas for _, reenviadas in parciales)), estado, advertencias)
+        else:
+            primeras = [primera for primera in parciales if primera is not None]
+            if primeras:
+                primera_cita = pd.concat(primeras, ignore_index=True).groupby('ID_Paciente')[
+                    'Fecha_Primera_Cita_Atendida_Real'].min().reset_index()
+
+        no_interpretables_por_particion = particiones.mapear(_citas_particion_enriquecer, [
+            {'ruta_entrada': directorio.archivo("unidas", p), 'ruta_salida': directorio.archivo("enriquecidas", p),
+             'primera_cita': primera_cita, 'fecha_referencia': fecha_referencia}
+            for p in rutas_citas])
+        hechos_citas_df = particiones.unir(
+            [directorio.archivo("enriquecidas", p) for p in rutas_citas])
+
+    no_interpretables_por_hora: Dict[str, int] = {}
+    for parcial in no_interpretables_por_particion:
+        for col_hora, cantidad in parcial.items():
+            no_interpretables_por_hora[col_hora] = no_interpretables_por_hora.get(col_hora, 0) + cantidad
+    return hechos_citas_df, no_interpretables_por_hora
+
+
+def _paso_citas(entradas: Dict[str, pd.DataFrame], advertencias: List[str],
+                fecha_referencia: pd.Timestamp, huella_estado: Optional[str] = None) -> Dict[str, pd.DataFrame]:
+    # `huella_estado` no se usa aquí: solo hace que la caché de pasos note
+    # cuando cambió el estado por paciente (estado_pacientes.py).
+    # --- PASO 3: Procesar y Enriquecer `hechos_citas` ---
+    print("--- PASO 3: Procesando y enriqueciendo citas...")
+    hechos_citas_df = None
+    df_citas_pac = get_df_by_type(
+        entradas, "Citas_Pacientes_df", advertencias)
+    df_citas_mot = get_df_by_type(
+        entradas, "Citas_Motivo_df", advertencias)
+
+    if df_citas_pac is not None and df_citas_mot is not None:
+        df_citas_pac.columns = [replace_spaces_with_underscores(
+            col) for col in df_citas_pac.columns]
+        df_citas_mot.columns = [replace_spaces_with_underscores(
+            col) for col in df_citas_mot.columns]
+
+        if 'ID_Paciente' in df_citas_pac.columns and 'Fecha_Cita' in df_citas_pac.columns:
+            col_asistida, col_duplicada, col_fecha_cita = 'Cita_asistida', 'Cita_duplicada', 'Fecha_Cita'
+            df_citas_pac[col_asistida] = pd.to_numeric(
+                df_citas_pac[col_asistida], errors='coerce').fillna(0).astype(int)
+            df_citas_pac[col_duplicada] = pd.to_numeric(
+                df_citas_pac[col_duplicada], errors='coerce').fillna(0).astype(int)
+            cols_exist = [
+                c for c in COLUMNAS_CITAS_MOTIVO if c in df_citas_mot.columns]
+
+            if particiones.activo():
+                hechos_citas_df, no_interpretables_por_hora = _citas_por_particiones(
+                    df_citas_pac, df_citas_mot, cols_exist, fecha_referencia, advertencias)
+            else:
+                df_citas_filtrado = df_citas_pac[df_citas_pac[col_duplicada] == 0].copy(
+                )
+                hechos_citas_df = _unir_citas_motivo(
+                    df_citas_filtrado, df_citas_mot, cols_exist)
+                hechos_citas_df[col_fecha_cita] = pd.to_datetime(
+                    hechos_citas_df[col_fecha_cita], errors='coerce').dt.normalize()
+                hechos_citas_df, no_interpretables_por_hora = _enriquecer_citas(
+                    hechos_citas_df, _primera_cita_del_lote(hechos_citas_df, advertencias), fecha_referencia)
+
+            for col_hora, col_timestamp in (('Hora_Inicio_Cita', 'Inicio_Cita_Timestamp'),
+                                            ('Hora_Fin_Cita', 'Fin_Cita_Timestamp')):
+                if no_interpretables_por_hora.get(col_hora):
+                    advertencias.append(
+                        f"ADVERTENCIA (citas): {no_interpretables_por_hora[col_hora]} filas con '{col_hora}' no interpretable; "
+                        f"'{col_timestamp}' queda vacío.")
+
+    if hechos_citas_df is None:
+        return {}
+    return {'hechos_citas': hechos_citas_df}
+
+
+def _paso_acciones(entradas: Dict[str, pd.DataFrame], advertencias: List[str]) -> Dict[str, pd.DataFrame]:
+    # --- PASO 4 (acciones) ---
+    df_acciones = get_df_by_type(
+        entradas, "Acciones_df", advertencias)
+    if df_acciones is None:
+        return {}
+    df_acciones.columns = [replace_spaces_with_underscores(
+        col) for col in df_acciones.columns]
+    df_acciones.reset_index(inplace=True)
+    df_acciones.rename(
+        columns={'index': 'ID_Accion_Unico'}, inplace=True)
+    return {'hechos_acciones_realizadas': df_acciones}
+
+
+def _transacciones_pagos(df_movimiento: pd.DataFrame, agg_cols: Dict[str, str]) -> pd.DataFrame:
+    return df_movimiento.groupby('ID_Pago', as_index=False).agg(agg_cols).rename(columns={
+        'Abono_Libre': 'Monto_Abono_Libre_Original_En_Tx', 'Total_Pago': 'Total_Pago_Transaccion'})
+
+
+def _transacciones_particion(ruta_entrada: str, ruta_salida: str, agg_cols: Dict[str, str]):
+    particiones.guardar(_transacciones_pagos(particiones.leer(ruta_entrada), agg_cols), ruta_salida)
+
+
+def _transacciones_por_particiones(df_movimiento: pd.DataFrame, agg_cols: Dict[str, str]) -> pd.DataFrame:
+    """
+    hechos_pagos_transacciones por particiones de ID_Pago: cada pago queda
+    entero en una partición, así que basta ordenar por ID_Pago al unir para
+    obtener lo mismo que el groupby en memoria.
+    """
+    n = particiones.PARTICIONES
+    print(f"    - Pagos en {n} particiones ({len(df_movimiento):,} filas, "
+          f"{particiones.PROCESOS_PARTICIONES} proceso(s)).")
+    with particiones.DirectorioParticiones("pagos") as directorio:
+        rutas = directorio.escribir(
+            "movimiento", df_movimiento[['ID_Pago', *agg_cols]],
+            particiones.particion_de(df_movimiento['ID_Pago'], n), n)
+        particiones.mapear(_transacciones_particion, [
+            {'ruta_entrada': ruta, 'ruta_salida': directorio.archivo("transacciones", p), 'agg_cols': agg_cols}
+            for p, ruta in rutas.items()])
+        return particiones.unir([directorio.archivo("transacciones", p) for p in rutas], ordenar_por='ID_Pago')
+
+
+def _paso_pagos(entradas: Dict[str, pd.DataFrame], advertencias: List[str]) -> Dict[str, pd.DataFrame]:
+    # --- PASO 4 (pagos) ---
+    print("--- PASO 4: Procesando pagos...")
+    resultados_dfs = {}
+    df_movimiento = get_df_by_type(
+        entradas, "Movimiento_df", advertencias)
+    if df_movimiento is not None:
+        df_movimiento.columns = [replace_spaces_with_underscores(
+            col) for col in df_movimiento.columns]
+        if 'ID_Pago' in df_movimiento.columns:
+            if 'Total_Pago' in df_movimiento.columns:
+                df_movimiento['Total_Pago'] = pd.to_numeric(
+                    df_movimiento['Total_Pago'], errors='coerce').fillna(0)
+            if 'Abono_Libre' in df_movimiento.columns:
+                df_movimiento['Abono_Libre'] = pd.to_numeric(
+                    df_movimiento['Abono_Libre'], errors='coerce').fillna(0)
+
+            agg_cols = {col: 'first' for col in ['ID_Paciente', 'Pago_fecha_recepcion', 'Total_Pago',
+                                                 'Abono_Libre', 'Medio_de_pago', 'Sucursal'] if col in df_movimiento.columns}
+            if agg_cols:
+                # Con una clave categórica el groupby emite todas las categorías en cada partición.
+                if particiones.activo() and not isinstance(df_movimiento['ID_Pago'].dtype, pd.CategoricalDtype):
+                    tx_pagos = _transacciones_por_particiones(df_movimiento, agg_cols)
+                else:
+                    tx_pagos = _transacciones_pagos(df_movimiento, agg_cols)
+                resultados_dfs['hechos_pagos_transacciones'] = tx_pagos
+
+            app_cols_map = {'ID_Pago': 'ID_Pago', 'ID_Detalle_Presupuesto': 'ID_Detalle_Presupuesto',
+                            'Pagado_ID_Detalle_Presupuesto': 'Monto_Aplicado_Al_Detalle', 'pago_fecha_recepcion': 'pago_fecha_recepcion', 'Sucursal': 'Sucursal'}
+            app_cols_exist = [
+                k for k in app_cols_map.keys() if k in df_movimiento.columns]
+            if app_cols_exist:
+                app_df = df_movimiento[app_cols_exist].rename(
+                    columns=app_cols_map)
+                resultados_dfs['hechos_pagos_aplicaciones_detalle'] = app_df
+    return resultados_dfs
+
+
+def _paso_gastos(entradas: Dict[str, pd.DataFrame], advertencias: List[str]) -> Dict[str, pd.DataFrame]:
+    # --- PASO 4 (gastos) ---
+    df_gastos = get_df_by_type(
+        entradas, "Tabla Gastos Aliadas Mexico_df", advertencias)
+    if df_gastos is None:
+        return {}
+    df_gastos.columns = [replace_spaces_with_underscores(
+        col) for col in df_gastos.columns]
+    df_gastos.reset_index(inplace=True)
+    df_gastos.rename(columns={'index': 'ID_Gasto_Unico'}, inplace=True)
+    return {'hechos_gastos': df_gastos}
+
+
+def _paso_perfiles(entradas: Dict[str, pd.DataFrame], advertencias: List[str]) -> Dict[str, pd.DataFrame]:
+    # --- PASO 5: Generar Perfiles Agregados ---
+    print("--- PASO 5: Generando perfiles de pacientes...")
+    if 'hechos_pacientes' in entradas:
+        df_pac_para_perfil = entradas['hechos_pacientes']
+        groupby_cols = [c for c in [
+            'Edad', 'Sexo', 'Paciente_Origen'] if c in df_pac_para_perfil.columns]
+        if 'ID_Paciente' in df_pac_para_perfil.columns and len(groupby_cols) > 1:
+            perfil = df_pac_para_perfil.groupby(groupby_cols, dropna=False, observed=True)[
+                'ID_Paciente'].nunique().reset_index(name='Numero_Pacientes')
+            if not perfil.empty:
+                return {'perfil_edad_sexo_origen_paciente': perfil}
+    return {}
+
+
+def _paso_kpi(entradas: Dict[str, pd.DataFrame], advertencias: List[str], nombre: str) -> Dict[str, pd.DataFrame]:
+    # --- PASO 6: Tablas KPI pre-agregadas (definidas en agregados_kpi.py) ---
+    return agregados_kpi.generar_agregados_kpi(entradas, advertencias, nombres=[nombre])
+
+
+def refrescar_citas(hechos_citas: pd.DataFrame, primera_cita: Optional[pd.DataFrame],
+                    fecha_referencia: Optional[pd.Timestamp] = None) -> Tuple[pd.DataFrame, np.ndarray]:
+    """
+    Recalcula la primera cita atendida y la etiqueta de las citas de lotes
+    anteriores leídas de la base (las de los pacientes del lote y las que
+    estaban en agenda) con la primera cita del estado por paciente. Devuelve
+    la tabla y las filas que cambiaron: pacientes cuya primera visita cambió
+    con el lote y citas en agenda que ya pasaron.
+    """
+    fecha_referencia = pd.Timestamp(
+        fecha_referencia if fecha_referencia is not None else 'today').normalize()
+    col_primera = 'Fecha_Primera_Cita_Atendida_Real'
+    if primera_cita is None:
+        primera = pd.Series(pd.NaT, index=hechos_citas.index, dtype='datetime64[ns]')
+    else:
+        primera = hechos_citas[['ID_Paciente']].merge(
+            primera_cita, on='ID_Paciente', how='left')[col_primera].set_axis(hechos_citas.index)
+    fecha_cita = pd.to_datetime(hechos_citas['Fecha_Cita'], errors='coerce')
+    etiqueta = pd.Series(etiquetar_citas(fecha_cita, primera, hechos_citas['Cita_asistida'], fecha_referencia),
+                         index=hechos_citas.index)
+    anterior = pd.to_datetime(hechos_citas[col_primera], errors='coerce')
+    cambiadas = ~((anterior == primera) | (anterior.isna() & primera.isna())) | (
+        hechos_citas['Etiqueta_Cita_Paciente'].astype(str) != etiqueta.astype(str))
+    return hechos_citas.assign(**{col_primera: primera, 'Etiqueta_Cita_Paciente': etiqueta}), cambiadas.to_numpy()
+
+
+# Tablas KPI que salen de hechos_citas (con el estado por paciente se recalculan por mes).
+KPI_DE_CITAS = [nombre for nombre, definicion in agregados_kpi.AGREGADOS_KPI.items()
+                if definicion['origen'] == 'hechos_citas']
+
+
+def kpi_de_citas(tablas: Dict[str, pd.DataFrame], advertencias: List[str]) -> Dict[str, pd.DataFrame]:
+    """
+    Recalcula las tablas KPI que salen de hechos_citas con `tablas` (con el
+    estado por paciente, las citas de los meses que cambió el lote, leídas
+    de la base después de agregarlo).
+    """
+    agregados = agregados_kpi.generar_agregados_kpi(tablas, advertencias, nombres=KPI_DE_CITAS)
+    if OPTIMIZAR_TIPOS:
+        agregados = {nombre: optimizacion_tipos.optimizar_tipos(df) for nombre, df in agregados.items()}
+    return agregados
+
+
+def _convertir_fechas(table_name: str, df: pd.DataFrame) -> pd.DataFrame:
+    """Asegura el tipo fecha de COLUMNAS_DE_FECHA en cada tabla que produce un paso."""
+    for col in df.columns:
+        if col in COLUMNAS_DE_FECHA:
             print(
-                "    - ¡Éxito! La columna 'Sucursal' ha sido agregada a dimension_tratamientos_generados.")
+                f"    - Convirtiendo columna de fecha '{col}' en tabla '{table_name}'.")
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+    return df
+
+
+def pasos_insights(fecha_referencia: pd.Timestamp) -> List[ejecutor_pasos.Paso]:
+    """
+    El grafo de generar_insights_pacientes: un paso por dimensión, por tabla
+    de hechos y por tabla KPI. Los que no dependen entre sí (ej. citas, pagos
+    y gastos) corren a la vez; las tablas salen en el orden de esta lista.
+    """
+    Paso = ejecutor_pasos.Paso
+    pasos = []
+    for df_key, table_name in DIMENSION_MAPPING.items():
+        if table_name == 'dimension_tratamientos_generados':
+            pasos.append(Paso('tratamientos_generados', (df_key, 'hechos_presupuesto_detalle'), (table_name,),
+                              _paso_tratamientos_generados))
         else:
-            all_advertencias.append(
-                "ADVERTENCIA: No se pudo añadir 'Sucursal' a dimension_tratamientos_generados.")
-
-        # --- PASO 2: Procesar y Enriquecer `hechos_pacientes` ---
-        print("--- PASO 2: Procesando y enriqueciendo pacientes...")
-        df_pacientes_base = get_df_by_type(
-            processed_dfs, "Pacientes_Nuevos_df", all_advertencias)
-        if df_pacientes_base is not None:
-            df_pacientes_enriquecido = df_pacientes_base.copy()
-            df_pacientes_enriquecido.columns = [replace_spaces_with_underscores(
-                col) for col in df_pacientes_enriquecido.columns]
-
-            if 'Fecha_de_nacimiento' in df_pacientes_enriquecido.columns:
-                def calcular_edad(fecha_nac):
-                    if pd.isnull(fecha_nac):
-                        return pd.NA
-                    try:
-                        edad_dias = (pd.to_datetime('today').normalize(
-                        ) - pd.Timestamp(fecha_nac).normalize()).days
-                        edad = int(edad_dias / 365.25)
-                        return edad if 0 <= edad <= 120 else pd.NA
-                    except (ValueError, TypeError):
-                        return pd.NA
-                df_pacientes_enriquecido['Edad'] = pd.to_datetime(
-                    df_pacientes_enriquecido['Fecha_de_nacimiento'], errors='coerce').apply(calcular_edad).astype('Int64')
-
-            if 'Edad' in df_pacientes_enriquecido.columns:
-                def categorize_age(edad):
-                    if pd.isnull(edad):
-                        return 'Desconocido'
-                    try:
-                        edad = int(edad)
-                    except (ValueError, TypeError):
-                        return 'Desconocido'
-                    if edad < 18:
-                        return 'Menor a 18'
-                    elif 18 <= edad <= 25:
-                        return '18 a 25'
-                    elif 26 <= edad <= 35:
-                        return '26 a 35'
-                    elif 36 <= edad <= 50:
-                        return '36 a 50'
-                    elif 51 <= edad <= 65:
-                        return '51 a 65'
-                    else:
-                        return 'Mayor de 65'
-                df_pacientes_enriquecido['Rango_de_Edad'] = df_pacientes_enriquecido['Edad'].apply(
-                    categorize_age)
-
-            if 'dimension_tipos_pacientes' in resultados_dfs and 'Tipo_Dentalink' in df_pacientes_enriquecido.columns:
-                df_dim_tipos_pac = resultados_dfs['dimension_tipos_pacientes']
-                if 'Tipo_Dentalink' in df_dim_tipos_pac.columns and 'Paciente_Origen' in df_dim_tipos_pac.columns:
-                    df_origen_merge = df_dim_tipos_pac[[
-                        'Tipo_Dentalink', 'Paciente_Origen']].drop_duplicates(subset=['Tipo_Dentalink'])
-                    df_pacientes_enriquecido = pd.merge(
-                        df_pacientes_enriquecido, df_origen_merge, on='Tipo_Dentalink', how='left')
-
-            resultados_dfs['hechos_pacientes'] = df_pacientes_enriquecido.copy()
-
-        # --- PASO 3: Procesar y Enriquecer `hechos_citas` ---
-        print("--- PASO 3: Procesando y enriqueciendo citas...")
-        hechos_citas_df = None
-        df_citas_pac = get_df_by_type(
-            processed_dfs, "Citas_Pacientes_df", all_advertencias)
-        df_citas_mot = get_df_by_type(
-            processed_dfs, "Citas_Motivo_df", all_advertencias)
-
-        if df_citas_pac is not None and df_citas_mot is not None:
-            df_citas_pac.columns = [replace_spaces_with_underscores(
-                col) for col in df_citas_pac.columns]
-            df_citas_mot.columns = [replace_spaces_with_underscores(
-                col) for col in df_citas_mot.columns]
-
-            if 'ID_Paciente' in df_citas_pac.columns and 'Fecha_Cita' in df_citas_pac.columns:
-                try:
-                    col_id_cita, col_asistida, col_duplicada, col_id_paciente, col_fecha_cita = 'ID_Cita', 'Cita_asistida', 'Cita_duplicada', 'ID_Paciente', 'Fecha_Cita'
-                    df_citas_pac[col_asistida] = pd.to_numeric(
-                        df_citas_pac[col_asistida], errors='coerce').fillna(0).astype(int)
-                    df_citas_pac[col_duplicada] = pd.to_numeric(
-                        df_citas_pac[col_duplicada], errors='coerce').fillna(0).astype(int)
-                    df_citas_filtrado = df_citas_pac[df_citas_pac[col_duplicada] == 0].copy(
-                    )
-
-                    df_citas_filtrado[col_id_cita] = df_citas_filtrado[col_id_cita].astype(
-                        str)
-                    df_citas_mot[col_id_cita] = df_citas_mot[col_id_cita].astype(
-                        str)
-
-                    cols_from_motivo = ['ID_Cita', 'Cita_Creacion', 'Hora_Inicio_Cita',
-                                        'Hora_Fin_Cita', 'Motivo_Cita', 'Sucursal', 'ID_Tratamiento']
-                    cols_exist = [
-                        c for c in cols_from_motivo if c in df_citas_mot.columns]
-                    hechos_citas_df = pd.merge(df_citas_filtrado, df_citas_mot[cols_exist].drop_duplicates(
-                        subset=[col_id_cita]), on=col_id_cita, how='left')
-
-                    hechos_citas_df[col_fecha_cita] = pd.to_datetime(
-                        hechos_citas_df[col_fecha_cita], errors='coerce').dt.normalize()
-
-                    df_atendidas = hechos_citas_df[(hechos_citas_df[col_asistida] == 1) & (
-                        hechos_citas_df[col_fecha_cita].notna())]
-                    if not df_atendidas.empty:
-                        primera_cita = df_atendidas.groupby(col_id_paciente)[col_fecha_cita].min(
-                        ).reset_index().rename(columns={col_fecha_cita: 'Fecha_Primera_Cita_Atendida_Real'})
-                        hechos_citas_df = pd.merge(
-                            hechos_citas_df, primera_cita, on=col_id_paciente, how='left')
-                    if 'Fecha_Primera_Cita_Atendida_Real' not in hechos_citas_df.columns:
-                        hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'] = pd.NaT
-
-                    today = pd.to_datetime('today').normalize()
-                    hechos_citas_df['Etiqueta_Cita_Paciente'] = 'Indeterminada'
-                    cond_fecha_cita_valida = hechos_citas_df[col_fecha_cita].notna(
-                    )
-                    cond_primera_atendida_existe = hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'].notna(
-                    )
-                    cond_asistio = hechos_citas_df[col_asistida] == 1
-                    cond_es_nuevo = ~cond_primera_atendida_existe | (
-                        hechos_citas_df[col_fecha_cita] <= hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'])
-                    hechos_citas_df.loc[cond_es_nuevo & cond_fecha_cita_valida & (
-                        hechos_citas_df[col_fecha_cita] >= today), 'Etiqueta_Cita_Paciente'] = "Paciente Nuevo en Agenda"
-                    hechos_citas_df.loc[cond_es_nuevo & cond_fecha_cita_valida & (
-                        hechos_citas_df[col_fecha_cita] < today) & cond_asistio, 'Etiqueta_Cita_Paciente'] = "Paciente Nuevo Atendido"
-                    hechos_citas_df.loc[cond_es_nuevo & cond_fecha_cita_valida & (
-                        hechos_citas_df[col_fecha_cita] < today) & ~cond_asistio, 'Etiqueta_Cita_Paciente'] = "Paciente Nuevo No Atendido"
-                    cond_es_recurrente = cond_primera_atendida_existe & (
-                        hechos_citas_df[col_fecha_cita] > hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'])
-                    cond_mismo_mes_debut = cond_es_recurrente & (hechos_citas_df[col_fecha_cita].dt.to_period(
-                        'M') == hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'].dt.to_period('M'))
-                    cond_mes_posterior_debut = cond_es_recurrente & (hechos_citas_df[col_fecha_cita].dt.to_period(
-                        'M') > hechos_citas_df['Fecha_Primera_Cita_Atendida_Real'].dt.to_period('M'))
-                    hechos_citas_df.loc[cond_mismo_mes_debut & cond_asistio,
-                                        'Etiqueta_Cita_Paciente'] = "Paciente Atendido Mismo Mes que Debutó"
-                    hechos_citas_df.loc[cond_mismo_mes_debut & ~cond_asistio,
-                                        'Etiqueta_Cita_Paciente'] = "Paciente No Atendido Mismo Mes que Debutó"
-                    hechos_citas_df.loc[cond_mes_posterior_debut & (
-                        hechos_citas_df[col_fecha_cita] >= today), 'Etiqueta_Cita_Paciente'] = "Paciente Recurrente en Agenda"
-                    hechos_citas_df.loc[cond_mes_posterior_debut & (
-                        hechos_citas_df[col_fecha_cita] < today) & cond_asistio, 'Etiqueta_Cita_Paciente'] = "Paciente Recurrente Atendido"
-                    hechos_citas_df.loc[cond_mes_posterior_debut & (
-                        hechos_citas_df[col_fecha_cita] < today) & ~cond_asistio, 'Etiqueta_Cita_Paciente'] = "Paciente Recurrente No Atendido"
-
-                    col_hora_inicio, col_hora_fin = 'Hora_Inicio_Cita', 'Hora_Fin_Cita'
-                    if col_hora_inicio in hechos_citas_df.columns and col_hora_fin in hechos_citas_df.columns:
-                        hechos_citas_df[col_hora_inicio] = hechos_citas_df[col_hora_inicio].astype(
-                            str)
-                        hechos_citas_df[col_hora_fin] = hechos_citas_df[col_hora_fin].astype(
-                            str)
-                        inicio_str = hechos_citas_df[col_fecha_cita].dt.strftime(
-                            '%Y-%m-%d') + ' ' + hechos_citas_df[col_hora_inicio]
-                        fin_str = hechos_citas_df[col_fecha_cita].dt.strftime(
-                            '%Y-%m-%d') + ' ' + hechos_citas_df[col_hora_fin]
-                        hechos_citas_df['Inicio_Cita_Timestamp'] = pd.to_datetime(
-                            inicio_str, errors='coerce')
-                        hechos_citas_df['Fin_Cita_Timestamp'] = pd.to_datetime(
-                            fin_str, errors='coerce')
-                        duracion = (hechos_citas_df['Fin_Cita_Timestamp'] -
-                                    hechos_citas_df['Inicio_Cita_Timestamp']).dt.total_seconds()
-                        hechos_citas_df['Duracion_Cita_Minutos'] = duracion / 60
-
-                except Exception as e_citas:
-                    all_advertencias.append(
-                        f"ERROR general procesando citas: {e_citas}")
-
-        if hechos_citas_df is not None:
-            resultados_dfs['hechos_citas'] = hechos_citas_df.copy()
-
-        # --- PASO 4: Procesar Otros Hechos de Negocio ---
-        print("--- PASO 4: Procesando presupuestos, acciones, pagos y gastos...")
-        if df_presupuesto_base is not None:
-            resultados_dfs['hechos_presupuesto_detalle'] = df_presupuesto_base.copy()
-
-        df_acciones = get_df_by_type(
-            processed_dfs, "Acciones_df", all_advertencias)
-        if df_acciones is not None:
-            df_acciones.columns = [replace_spaces_with_underscores(
-                col) for col in df_acciones.columns]
-            df_acciones.reset_index(inplace=True)
-            df_acciones.rename(
-                columns={'index': 'ID_Accion_Unico'}, inplace=True)
-            resultados_dfs['hechos_acciones_realizadas'] = df_acciones.copy()
-
-        df_movimiento = get_df_by_type(
-            processed_dfs, "Movimiento_df", all_advertencias)
-        if df_movimiento is not None:
-            df_movimiento.columns = [replace_spaces_with_underscores(
-                col) for col in df_movimiento.columns]
-            if 'ID_Pago' in df_movimiento.columns:
-                if 'Total_Pago' in df_movimiento.columns:
-                    df_movimiento['Total_Pago'] = pd.to_numeric(
-                        df_movimiento['Total_Pago'], errors='coerce').fillna(0)
-                if 'Abono_Libre' in df_movimiento.columns:
-                    df_movimiento['Abono_Libre'] = pd.to_numeric(
-                        df_movimiento['Abono_Libre'], errors='coerce').fillna(0)
-
-                agg_cols = {col: 'first' for col in ['ID_Paciente', 'Pago_fecha_recepcion', 'Total_Pago',
-                                                     'Abono_Libre', 'Medio_de_pago', 'Sucursal'] if col in df_movimiento.columns}
-                if agg_cols:
-                    tx_pagos = df_movimiento.groupby('ID_Pago', as_index=False).agg(agg_cols).rename(columns={
-                        'Abono_Libre': 'Monto_Abono_Libre_Original_En_Tx', 'Total_Pago': 'Total_Pago_Transaccion'})
-                    resultados_dfs['hechos_pagos_transacciones'] = tx_pagos
-
-                app_cols_map = {'ID_Pago': 'ID_Pago', 'ID_Detalle_Presupuesto': 'ID_Detalle_Presupuesto',
-                                'Pagado_ID_Detalle_Presupuesto': 'Monto_Aplicado_Al_Detalle', 'pago_fecha_recepcion': 'pago_fecha_recepcion', 'Sucursal': 'Sucursal'}
-                app_cols_exist = [
-                    k for k in app_cols_map.keys() if k in df_movimiento.columns]
-                if app_cols_exist:
-                    app_df = df_movimiento[app_cols_exist].copy().rename(
-                        columns=app_cols_map)
-                    resultados_dfs['hechos_pagos_aplicaciones_detalle'] = app_df
-
-        df_gastos = get_df_by_type(
-            processed_dfs, "Tabla Gastos Aliadas Mexico_df", all_advertencias)
-        if df_gastos is not None:
-            df_gastos.columns = [replace_spaces_with_underscores(
-                col) for col in df_gastos.columns]
-            df_gastos.reset_index(inplace=True)
-            df_gastos.rename(columns={'index': 'ID_Gasto_Unico'}, inplace=True)
-            resultados_dfs['hechos_gastos'] = df_gastos.copy()
-
-        # --- PASO 5: Generar Perfiles Agregados ---
-        print("--- PASO 5: Generando perfiles de pacientes...")
-        if 'hechos_pacientes' in resultados_dfs:
-            df_pac_para_perfil = resultados_dfs['hechos_pacientes']
-            groupby_cols = [c for c in [
-                'Edad', 'Sexo', 'Paciente_Origen'] if c in df_pac_para_perfil.columns]
-            if 'ID_Paciente' in df_pac_para_perfil.columns and len(groupby_cols) > 1:
-                perfil = df_pac_para_perfil.groupby(groupby_cols, dropna=False)[
-                    'ID_Paciente'].nunique().reset_index(name='Numero_Pacientes')
-                if not perfil.empty:
-                    resultados_dfs['perfil_edad_sexo_origen_paciente'] = perfil
-
-        # --- PASO FINAL: Asegurar tipos de datos de fecha correctos ---
-        print("--- PASO FINAL: Convirtiendo columnas de fecha al formato correcto...")
-        columnas_de_fecha = {
-            'Procedimiento_Fecha_Realizacion', 'Fecha_Cita', 'Cita_Creacion',
-            'Fecha_Primera_Cita_Atendida_Real', 'Fecha_del_Gasto', 'Fecha_de_nacimiento',
-            'pago_fecha_recepcion', 'Pago_fecha_recepcion', 'Tratamiento_fecha_de_generacion'
-        }
-        for table_name, df in resultados_dfs.items():
-            if df is None:
-                continue
-            for col in df.columns:
-                if col in columnas_de_fecha:
-                    print(
-                        f"    - Convirtiendo columna de fecha '{col}' en tabla '{table_name}'.")
-                    df[col] = pd.to_datetime(df[col], errors='coerce')
+            pasos.append(Paso(f'dimension:{table_name}', (df_key,), (table_name,), _paso_dimension,
+                              {'df_key': df_key, 'table_name': table_name}))
+    pasos += [
+        Paso('pacientes', ("Pacientes_Nuevos_df", 'dimension_tipos_pacientes'), ('hechos_pacientes',),
+             _paso_pacientes, {'fecha_referencia': fecha_referencia}),
+        Paso('citas', ("Citas_Pacientes_df", "Citas_Motivo_df"), ('hechos_citas',),
+             _paso_citas, {'fecha_referencia': fecha_referencia,
+                           'huella_estado': estado_pacientes.huella() if estado_pacientes.activo() else None}),
+        Paso('presupuestos', ("Presupuesto por Accion_df",), ('hechos_presupuesto_detalle',), _paso_presupuestos),
+        Paso('acciones', ("Acciones_df",), ('hechos_acciones_realizadas',), _paso_acciones),
+        Paso('pagos', ("Movimiento_df",), ('hechos_pagos_transacciones', 'hechos_pagos_aplicaciones_detalle'),
+             _paso_pagos),
+        Paso('gastos', ("Tabla Gastos Aliadas Mexico_df",), ('hechos_gastos',), _paso_gastos),
+        Paso('perfiles', ('hechos_pacientes',), ('perfil_edad_sexo_origen_paciente',), _paso_perfiles),
+    ]
+    for nombre, definicion in agregados_kpi.AGREGADOS_KPI.items():
+        pasos.append(Paso(f'kpi:{nombre}', tuple(agregados_kpi.tablas_de_origen(definicion)), (nombre,),
+                          _paso_kpi, {'nombre': nombre},
+                          opcionales=tuple(agregados_kpi.tablas_opcionales(definicion))))
+    return pasos
 
+
+def generar_insights_pacientes(
+    processed_dfs: Dict[str, pd.DataFrame], all_advertencias: List[str],
+    fecha_referencia: Optional[pd.Timestamp] = None
+) -> Dict[str, pd.DataFrame]:
+    """
+    Construye las tablas finales ejecutando el grafo de `pasos_insights`. Si
+    un paso falla, se omiten solo los que dependen de él (con advertencias)
+    y el resto de las tablas se entrega igual.
+    """
+    # Cada DataFrame de resultados_dfs es propio (viene de get_df_by_type o de
+    # un merge/groupby), así que se guarda sin copiarlo otra vez.
+    resultados_dfs: Dict[str, pd.DataFrame] = {}
+    # Fecha "de hoy" usada en toda la corrida (edades y etiquetas de citas).
+    fecha_referencia = pd.Timestamp(
+        fecha_referencia if fecha_referencia is not None else 'today').normalize()
+    print(f"--- Log Sherlock (BG Task): Inicio de generar_insights_pacientes...")
+
+    try:
+        metricas.marcar_etapa("pasos")
+        resultados_dfs, pasos = ejecutor_pasos.ejecutar_pasos(
+            pasos_insights(fecha_referencia), processed_dfs, all_advertencias,
+            directorio_cache=DIRECTORIO_CACHE or None, al_producir=_convertir_fechas)
+        for paso in pasos:
+            metricas.registrar_medicion(
+                f"paso:{paso.nombre}", paso.segundos, filas=sum(len(df) for df in paso.tablas.values()),
+                estado=paso.estado)
+
+        if OPTIMIZAR_TIPOS:
+            metricas.marcar_etapa("paso_final_tipos")
+            print("--- PASO FINAL: Compactando tipos de datos antes de guardar...")
+            for table_name, df in resultados_dfs.items():
+                if df is not None:
+                    resultados_dfs[table_name] = optimizacion_tipos.optimizar_tipos(df)
+
+        metricas.cerrar_vuelta()
         print(
             f"--- Log Sherlock (BG Task): Fin de generar_insights_pacientes. DataFrames finales listos ({len(resultados_dfs)}): {list(resultados_dfs.keys())}")
         return resultados_dfs
@@ -0,0 +1,159 @@
+import hashlib
+import io
+import os
+import pandas as pd
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Tuple
+
+# Columnas que debe tener indice.xlsx.
+COL_MAP = {'Archivo_Idx': 'Archivo', 'Hoja_Idx': 'Sheet', 'Original_Idx': 'Columna',
+           'Nuevo_Idx': 'Nombre unificado', 'Accion_Idx': 'Acción'}
+HOJA_DEFAULT = 'default'
+
+# Reglas ya compiladas en este proceso, por hash del contenido del índice.
+_CACHE_REGLAS: Dict[str, "ReglasIndice"] = {}
+
+
+@dataclass(frozen=True)
+class ReglaHoja:
+    """Reglas del índice ya resueltas para una hoja de un archivo."""
+    archivo_base: str
+    hoja: str
+    # Columna original -> Nombre unificado (solo KEEP con nombre distinto).
+    renombres: Dict[str, str] = field(default_factory=dict)
+    # Columnas originales marcadas como DROP.
+    columnas_drop: FrozenSet[str] = frozenset()
+
+    @property
+    def columnas_drop_final(self) -> FrozenSet[str]:
+        """Nombres a eliminar después del renombrado (igual que la lógica original)."""
+        return frozenset(self.renombres.get(col, col) for col in self.columnas_drop)
+
+    @property
+    def columnas_omitibles_en_lectura(self) -> FrozenSet[str]:
+        """
+        Columnas DROP que se pueden dejar de leer del Excel (`usecols`).
+        Se excluyen las que coinciden con el nombre final de otra columna,
+        porque en ese caso el DROP aplica sobre la columna renombrada.
+        """
+        return self.columnas_drop - set(self.renombres.values()) - set(self.renombres.keys())
+
+
+class ReglasIndice:
+    """
+    Índice compilado: reglas por (archivo base, hoja), más las advertencias
+    de validación encontradas al compilarlo.
+    """
+
+    def __init__(self, reglas: Dict[Tuple[str, str], ReglaHoja], advertencias: List[str], huella: str):
+        self.reglas = reglas
+        self.advertencias = advertencias
+        self.huella = huella
+        self.hojas_por_archivo: Dict[str, List[str]] = {}
+        for (archivo_base, hoja) in reglas:
+            if hoja != HOJA_DEFAULT:
+                self.hojas_por_archivo.setdefault(archivo_base, []).append(hoja)
+
+    def archivos(self) -> List[str]:
+        return list(dict.fromkeys(archivo_base for (archivo_base, _) in self.reglas))
+
+    def hojas_de(self, archivo_base: str) -> List[str]:
+        return self.hojas_por_archivo.get(archivo_base, [])
+
+    def regla_para(self, archivo_base: str, hoja: str) -> ReglaHoja:
+        """
+        Combina las reglas de la hoja exacta y las de 'default': los renombres
+        se toman de la hoja exacta si existen (si no, de 'default') y los DROP
+        se suman de ambas.
+        """
+        exacta = self.reglas.get((archivo_base, hoja))
+        default = self.reglas.get((archivo_base, HOJA_DEFAULT))
+        if default is None or exacta is default:
+            return exacta or ReglaHoja(archivo_base, hoja)
+        if exacta is None:
+            return ReglaHoja(archivo_base, hoja, default.renombres, default.columnas_drop)
+        return ReglaHoja(archivo_base, hoja, exacta.renombres or default.renombres,
+                         exacta.columnas_drop | default.columnas_drop)
+
+    def omitibles_por_hoja(self, archivo_base: str) -> Dict[str, FrozenSet[str]]:
+        """Columnas omitibles en lectura para cada hoja candidata (y 'default')."""
+        omitibles = {hoja: self.regla_para(archivo_base, hoja).columnas_omitibles_en_lectura
+                     for hoja in self.hojas_de(archivo_base)}
+        omitibles[HOJA_DEFAULT] = self.regla_para(
+            archivo_base, HOJA_DEFAULT).columnas_omitibles_en_lectura
+        return omitibles
+
+    # --- Estructuras con el formato que devolvía load_dataframes_from_uploads ---
+    def rename_map_details(self) -> Dict[Tuple[str, str], Dict[str, str]]:
+        return {clave: dict(regla.renombres) for clave, regla in self.reglas.items() if regla.renombres}
+
+    def drop_columns_set(self) -> set:
+        return {(archivo_base, hoja, col) for (archivo_base, hoja), regla in self.reglas.items()
+                for col in regla.columnas_drop}
+
+
+def compilar_indice(indice_df: pd.DataFrame, huella: str = "") -> ReglasIndice:
+    """
+    Compila el DataFrame de indice.xlsx a un ReglasIndice. Normaliza las
+    columnas de forma vectorizada y valida acciones desconocidas, columnas
+    marcadas como KEEP y DROP a la vez, y nombres finales repetidos.
+    """
+    faltantes = [c for c in COL_MAP.values() if c not in indice_df.columns]
+    if faltantes:
+        raise ValueError(f"Faltan columnas en índice: {faltantes}")
+
+    archivo = indice_df[COL_MAP['Archivo_Idx']].astype(str).str.strip()
+    hoja = indice_df[COL_MAP['Hoja_Idx']]
+    nuevo = indice_df[COL_MAP['Nuevo_Idx']]
+    idx = pd.DataFrame({
+        'archivo_base': archivo.map(lambda nombre: os.path.splitext(nombre)[0]),
+        'hoja': hoja.astype(str).str.strip().where(hoja.notna(), HOJA_DEFAULT),
+        'original': indice_df[COL_MAP['Original_Idx']].astype(str).str.strip(),
+        'nuevo': nuevo.astype(str).str.strip().where(nuevo.notna(), None),
+        'accion': indice_df[COL_MAP['Accion_Idx']].astype(str).str.strip().str.upper(),
+    })
+
+    advertencias: List[str] = []
+    desconocidas = idx.loc[~idx['accion'].isin(['KEEP', 'DROP']), 'accion']
+    if not desconocidas.empty:
+        advertencias.append(
+            f"ADVERTENCIA (índice): {len(desconocidas)} filas con Acción desconocida "
+            f"{sorted(desconocidas.unique())[:10]}; se ignoran.")
+
+    es_drop = idx['accion'] == 'DROP'
+    es_keep = idx['accion'] == 'KEEP'
+    claves_col = ['archivo_base', 'hoja', 'original']
+    conflicto = idx[es_keep].merge(idx[es_drop], on=claves_col)[claves_col].drop_duplicates()
+    for fila in conflicto.head(10).itertuples(index=False):
+        advertencias.append(
+            f"ADVERTENCIA (índice): '{fila.original}' en {fila.archivo_base}/{fila.hoja} está como KEEP y DROP.")
+
+    keep = idx[es_keep].assign(final=lambda d: d['nuevo'].fillna(d['original']))
+    repetidas = keep[keep.duplicated(subset=['archivo_base', 'hoja', 'final'], keep=False)]
+    for (archivo_base, hoja_rep, final), _ in list(repetidas.groupby(['archivo_base', 'hoja', 'final'], sort=False))[:10]:
+        advertencias.append(
+            f"ADVERTENCIA (índice): varias columnas KEEP terminan como '{final}' en {archivo_base}/{hoja_rep}.")
+
+    renombra = keep[keep['nuevo'].notna() & (keep['nuevo'] != keep['original'])]
+    renombres = {clave: dict(zip(g['original'], g['nuevo']))
+                 for clave, g in renombra.groupby(['archivo_base', 'hoja'], sort=False)}
+    drops = {clave: frozenset(g['original'])
+             for clave, g in idx[es_drop].groupby(['archivo_base', 'hoja'], sort=False)}
+
+    reglas: Dict[Tuple[str, str], ReglaHoja] = {}
+    for clave in idx[['archivo_base', 'hoja']].drop_duplicates().itertuples(index=False, name=None):
+        reglas[clave] = ReglaHoja(clave[0], clave[1], renombres.get(clave, {}),
+                                  drops.get(clave, frozenset()))
+    return ReglasIndice(reglas, advertencias, huella)
+
+
+def cargar_reglas_indice(contenido: bytes) -> ReglasIndice:
+    """
+    Devuelve las reglas compiladas de un indice.xlsx. Si el mismo contenido ya
+    se compiló en este proceso, no se vuelve a leer el Excel.
+    """
+    huella = hashlib.sha256(contenido).hexdigest()
+    if huella not in _CACHE_REGLAS:
+        indice_df = pd.read_excel(io.BytesIO(contenido), sheet_name=0)
+        _CACHE_REGLAS[huella] = compilar_indice(indice_df, huella)
+    return _CACHE_REGLAS[huella]
@@ -0,0 +1,246 @@
+import json
+import os
+import shutil
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# --- Snapshots en Parquet de las tablas finales de cada ejecución ---
+# <DIRECTORIO_SNAPSHOTS>/<id_snapshot>/<tabla>/mes=AAAA-MM/part-0.parquet
+# <DIRECTORIO_SNAPSHOTS>/<id_snapshot>/manifest.json
+# <DIRECTORIO_SNAPSHOTS>/ULTIMO  (id del último snapshot completo)
+SNAPSHOTS_ACTIVOS = os.environ.get(
+    "SHERLOCK_SNAPSHOTS", "1").strip().lower() not in ("0", "false", "no")
+DIRECTORIO_SNAPSHOTS = os.environ.get("SHERLOCK_SNAPSHOTS_DIR", "sherlock_snapshots")
+# Cuántos snapshots completos se conservan (los más viejos se borran).
+RETENCION_SNAPSHOTS = int(os.environ.get("SHERLOCK_SNAPSHOTS_RETENCION", 7))
+COMPRESION_PARQUET = os.environ.get("SHERLOCK_SNAPSHOTS_COMPRESION", "zstd")
+NOMBRE_MANIFIESTO = "manifest.json"
+NOMBRE_ULTIMO = "ULTIMO"
+# Partición '<columna>=...' para las filas sin fecha.
+PARTICION_SIN_FECHA = "sin_fecha"
+
+# Tablas de hechos particionadas por mes de su fecha principal; el resto va en un solo archivo.
+COLUMNA_PARTICION: Dict[str, str] = {
+    'hechos_citas': 'Fecha_Cita',
+    'hechos_presupuesto_detalle': 'Tratamiento_fecha_de_generacion',
+    'hechos_acciones_realizadas': 'Procedimiento_Fecha_Realizacion',
+    'hechos_pagos_transacciones': 'Pago_fecha_recepcion',
+    'hechos_gastos': 'Fecha_del_Gasto',
+}
+
+
+def _nuevo_id_snapshot(id_trabajo: Optional[str]) -> str:
+    marca = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    return f"{marca}-{(id_trabajo or uuid.uuid4().hex)[:12]}"
+
+
+def _meses(fechas: pd.Series) -> pd.Series:
+    fechas = pd.to_datetime(fechas, errors='coerce')
+    return fechas.dt.strftime("%Y-%m").fillna(PARTICION_SIN_FECHA)
+
+
+def _escribir_tabla(df: pd.DataFrame, directorio: str, columna_particion: Optional[str]) -> Dict[str, int]:
+    """
+    Escribe `df` en `directorio` (un archivo por mes si hay columna de
+    partición) y devuelve las filas de cada mes.
+    """
+    tabla = pa.Table.from_pandas(df, preserve_index=False)
+    if columna_particion is None or columna_particion not in df.columns or df.empty:
+        os.makedirs(directorio, exist_ok=True)
+        pq.write_table(tabla, os.path.join(directorio, "part-0.parquet"), compression=COMPRESION_PARQUET)
+        return {}
+    meses = _meses(df[columna_particion]).reset_index(drop=True)
+    particiones = {}
+    for mes, posiciones in meses.groupby(meses, sort=True).indices.items():
+        directorio_mes = os.path.join(directorio, f"mes={mes}")
+        os.makedirs(directorio_mes, exist_ok=True)
+        pq.write_table(tabla.take(pa.array(posiciones)), os.path.join(directorio_mes, "part-0.parquet"),
+                       compression=COMPRESION_PARQUET)
+        particiones[mes] = len(posiciones)
+    return particiones
+
+
+def _reutilizar_particiones(nombre_tabla: str, directorio: str, columnas: List[str],
+                            meses_nuevos: Set[str]) -> Optional[Dict[str, int]]:
+    """
+    Enlaza (o copia, si no se puede) en `directorio` las particiones de la
+    tabla en el último snapshot que no están en `meses_nuevos`. Devuelve las
+    filas de cada mes reutilizado, o None si el último snapshot no tiene la
+    tabla particionada con las mismas columnas.
+    """
+    anterior = ultimo_snapshot()
+    if anterior is None:
+        return None
+    info = leer_manifiesto(anterior)["tablas"].get(nombre_tabla)
+    if not info or info["columnas"] != columnas or not info.get("columna_particion"):
+        return None
+    particiones = {}
+    for mes, filas in info["particiones"].items():
+        if mes in meses_nuevos:
+            continue
+        origen = os.path.join(directorio_snapshot(anterior), nombre_tabla, f"mes={mes}")
+        destino = os.path.join(directorio, f"mes={mes}")
+        os.makedirs(destino, exist_ok=True)
+        for archivo in os.listdir(origen):
+            # Los Parquet de un snapshot no se modifican: un enlace basta.
+            try:
+                os.link(os.path.join(origen, archivo), os.path.join(destino, archivo))
+            except OSError:
+                shutil.copy2(os.path.join(origen, archivo), os.path.join(destino, archivo))
+        particiones[mes] = filas
+    return particiones
+
+
+def guardar_snapshot(dataframes: Dict[str, pd.DataFrame], id_trabajo: Optional[str] = None,
+                     meses_parciales: Optional[Dict[str, pd.Series]] = None) -> Dict[str, Any]:
+    """
+    Escribe todas las tablas en un directorio nuevo (primero con sufijo .tmp
+    y luego renombrado, así un snapshot a medias nunca se ve como completo),
+    actualiza ULTIMO y aplica la retención. Devuelve el manifiesto.
+
+    `meses_parciales` indica tablas de las que `dataframes` trae solo algunos
+    meses (fechas de esos meses; NaT = sin fecha): el resto de sus
+    particiones se toma del último snapshot.
+    """
+    os.makedirs(DIRECTORIO_SNAPSHOTS, exist_ok=True)
+    id_snapshot = _nuevo_id_snapshot(id_trabajo)
+    destino = os.path.join(DIRECTORIO_SNAPSHOTS, id_snapshot)
+    temporal = destino + ".tmp"
+    manifiesto: Dict[str, Any] = {
+        "id": id_snapshot, "id_trabajo": id_trabajo,
+        "creado": datetime.now(timezone.utc).isoformat(), "tablas": {}}
+    try:
+        for nombre_tabla, df in dataframes.items():
+            if df is None:
+                continue
+            columna = COLUMNA_PARTICION.get(nombre_tabla)
+            directorio = os.path.join(temporal, nombre_tabla)
+            columnas = [str(c) for c in df.columns]
+            particiones = _escribir_tabla(df, directorio, columna)
+            filas = len(df)
+            meses = (meses_parciales or {}).get(nombre_tabla)
+            if meses is not None:
+                previas = _reutilizar_particiones(nombre_tabla, directorio, columnas, set(_meses(pd.Series(meses))))
+                if previas is None:
+                    print(f"ADVERTENCIA (Snapshots): '{nombre_tabla}' queda solo con los meses de esta carga: "
+                          "el último snapshot no la tiene completa.")
+                else:
+                    particiones = dict(sorted({**previas, **particiones}.items()))
+                    filas = sum(particiones.values())
+            manifiesto["tablas"][nombre_tabla] = {
+                "filas": filas, "columnas": columnas,
+                "columna_particion": columna if particiones else None, "particiones": particiones}
+        with open(os.path.join(temporal, NOMBRE_MANIFIESTO), "w", encoding="utf-8") as f:
+            json.dump(manifiesto, f, ensure_ascii=False, indent=1)
+        os.rename(temporal, destino)
+    except Exception:
+        shutil.rmtree(temporal, ignore_errors=True)
+        raise
+    ruta_ultimo = os.path.join(DIRECTORIO_SNAPSHOTS, NOMBRE_ULTIMO)
+    with open(ruta_ultimo + ".tmp", "w", encoding="utf-8") as f:
+        f.write(id_snapshot)
+    os.replace(ruta_ultimo + ".tmp", ruta_ultimo)
+    print(f"--- Log Sherlock (Snapshots): Snapshot '{id_snapshot}' guardado con "
+          f"{len(manifiesto['tablas'])} tablas en '{destino}'.")
+    aplicar_retencion()
+    return manifiesto
+
+
+def listar_snapshots() -> List[str]:
+    """IDs de los snapshots completos, del más viejo al más nuevo."""
+    if not os.path.isdir(DIRECTORIO_SNAPSHOTS):
+        return []
+    return sorted(nombre for nombre in os.listdir(DIRECTORIO_SNAPSHOTS)
+                  if not nombre.endswith(".tmp")
+                  and os.path.isfile(os.path.join(DIRECTORIO_SNAPSHOTS, nombre, NOMBRE_MANIFIESTO)))
+
+
+def ultimo_snapshot() -> Optional[str]:
+    ruta_ultimo = os.path.join(DIRECTORIO_SNAPSHOTS, NOMBRE_ULTIMO)
+    if os.path.exists(ruta_ultimo):
+        with open(ruta_ultimo, encoding="utf-8") as f:
+            id_snapshot = f.read().strip()
+        if os.path.isdir(directorio_snapshot(id_snapshot)):
+            return id_snapshot
+    snapshots = listar_snapshots()
+    return snapshots[-1] if snapshots else None
+
+
+def directorio_snapshot(id_snapshot: str) -> str:
+    if not id_snapshot or os.path.basename(id_snapshot) != id_snapshot or id_snapshot in (".", ".."):
+        raise ValueError(f"Snapshot inválido: '{id_snapshot}'.")
+    return os.path.join(DIRECTORIO_SNAPSHOTS, id_snapshot)
+
+
+def leer_manifiesto(id_snapshot: str) -> Dict[str, Any]:
+    with open(os.path.join(directorio_snapshot(id_snapshot), NOMBRE_MANIFIESTO), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def archivos_tabla(id_snapshot: str, nombre_tabla: str, meses: Optional[List[str]] = None) -> List[str]:
+    """Rutas de los archivos Parquet de una tabla (solo los meses pedidos, si se indican)."""
+    directorio = os.path.join(directorio_snapshot(id_snapshot), nombre_tabla)
+    if not os.path.isdir(directorio):
+        raise KeyError(f"La tabla '{nombre_tabla}' no está en el snapshot '{id_snapshot}'.")
+    rutas = []
+    for raiz, _, archivos in os.walk(directorio):
+        carpeta = os.path.basename(raiz)
+        if meses is not None and carpeta.startswith("mes=") and carpeta[4:] not in meses:
+            continue
+        rutas.extend(os.path.join(raiz, a) for a in archivos if a.endswith(".parquet"))
+    return sorted(rutas)
+
+
+def leer_tabla(id_snapshot: str, nombre_tabla: str, meses: Optional[List[str]] = None) -> pd.DataFrame:
+    """Lee una tabla de un snapshot (sin agregar la partición como columna)."""
+    rutas = archivos_tabla(id_snapshot, nombre_tabla, meses)
+    if not rutas:
+        return pd.DataFrame(columns=leer_manifiesto(id_snapshot)["tablas"][nombre_tabla]["columnas"])
+    return pa.concat_tables([pq.read_table(r, partitioning=None) for r in rutas]).to_pandas()
+
+
+def comparar_snapshots(id_anterior: str, id_nuevo: str) -> Dict[str, Any]:
+    """
+    Diferencias entre dos snapshots según sus manifiestos: tablas agregadas o
+    quitadas, filas por tabla, columnas nuevas o quitadas y filas por mes.
+    """
+    anterior = leer_manifiesto(id_anterior)["tablas"]
+    nuevo = leer_manifiesto(id_nuevo)["tablas"]
+    tablas = {}
+    for nombre_tabla in sorted(set(anterior) & set(nuevo)):
+        a, n = anterior[nombre_tabla], nuevo[nombre_tabla]
+        meses = sorted(set(a["particiones"]) | set(n["particiones"]))
+        tablas[nombre_tabla] = {
+            "filas": n["filas"] - a["filas"],
+            "columnas_nuevas": [c for c in n["columnas"] if c not in a["columnas"]],
+            "columnas_quitadas": [c for c in a["columnas"] if c not in n["columnas"]],
+            "meses": {mes: n["particiones"].get(mes, 0) - a["particiones"].get(mes, 0)
+                      for mes in meses
+                      if n["particiones"].get(mes, 0) != a["particiones"].get(mes, 0)},
+        }
+    return {"anterior": id_anterior, "nuevo": id_nuevo,
+            "tablas_nuevas": sorted(set(nuevo) - set(anterior)),
+            "tablas_quitadas": sorted(set(anterior) - set(nuevo)), "tablas": tablas}
+
+
+def aplicar_retencion(conservar: int = RETENCION_SNAPSHOTS) -> List[str]:
+    """Borra los snapshots más viejos (y los .tmp huérfanos) dejando `conservar`."""
+    if conservar <= 0 or not os.path.isdir(DIRECTORIO_SNAPSHOTS):
+        return []
+    actual = ultimo_snapshot()
+    borrados = []
+    for id_snapshot in listar_snapshots()[:-conservar]:
+        if id_snapshot != actual:
+            shutil.rmtree(directorio_snapshot(id_snapshot), ignore_errors=True)
+            borrados.append(id_snapshot)
+    for nombre in os.listdir(DIRECTORIO_SNAPSHOTS):
+        if nombre.endswith(".tmp") and os.path.isdir(os.path.join(DIRECTORIO_SNAPSHOTS, nombre)):
+            shutil.rmtree(os.path.join(DIRECTORIO_SNAPSHOTS, nombre), ignore_errors=True)
+    if borrados:
+        print(f"--- Log Sherlock (Snapshots): Retención: borrados {borrados}.")
+    return borrados
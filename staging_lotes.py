@@ -0,0 +1,345 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import uuid
+import zipfile
+from datetime import datetime, timezone
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+import bloqueos
+import reglas_indice
+
+try:
+    import zstandard
+except ImportError:  # Solo hace falta para archivos .tar.zst.
+    zstandard = None
+
+# --- Staging en disco de los archivos subidos, separados por lote ---
+# Con varios workers web, DIRECTORIO_STAGING debe ser el mismo para todos:
+# cada lote se modifica y se sella con su bloqueo (bloqueos.py), así una
+# subida y el disparador pueden caer en procesos distintos.
+DIRECTORIO_STAGING = os.environ.get(
+    "SHERLOCK_STAGING_DIR", os.path.join(tempfile.gettempdir(), "sherlock_staging"))
+# Tamaño de cada bloque al copiar un archivo subido al disco.
+TAM_BLOQUE_COPIA = 1024 * 1024
+LOTE_DEFAULT = "default"
+NOMBRE_INDICE = "indice.xlsx"
+NOMBRE_MANIFIESTO = "manifest.json"
+# Máximo de bytes que se extraen de un archivo comprimido (protege el disco de un zip bomb).
+MAX_BYTES_EXTRAIDOS = int(os.environ.get("SHERLOCK_MAX_BYTES_EXTRAIDOS", 4 * 1024 ** 3))
+
+_MAGIA_ZIP = b"PK\x03\x04"
+_MAGIA_ZSTD = b"\x28\xb5\x2f\xfd"
+
+_PATRON_ID_LOTE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class ArchivoEnStaging:
+    """
+    Archivo ya guardado en disco. El procesador lo abre por ruta en lugar de
+    recibir su contenido en memoria.
+    """
+
+    def __init__(self, filename: str, ruta: str):
+        self.filename = filename
+        self.ruta = ruta
+
+
+def validar_id_lote(id_lote: str) -> str:
+    if not _PATRON_ID_LOTE.match(id_lote or ""):
+        raise ValueError(
+            f"batch_id inválido '{id_lote}': solo letras, números, '_' y '-' (máx. 64).")
+    return id_lote
+
+
+def _nombre_seguro(filename: str) -> str:
+    nombre = os.path.basename(filename.replace("\\", "/")).strip()
+    if not nombre or nombre in (".", "..") or nombre == NOMBRE_MANIFIESTO:
+        raise ValueError(f"Nombre de archivo inválido: '{filename}'.")
+    return nombre
+
+
+def _directorio_lotes_abiertos() -> str:
+    return os.path.join(DIRECTORIO_STAGING, "lotes")
+
+
+def _directorio_sellados() -> str:
+    return os.path.join(DIRECTORIO_STAGING, "sellados")
+
+
+def directorio_lote(id_lote: str) -> str:
+    return os.path.join(_directorio_lotes_abiertos(), validar_id_lote(id_lote))
+
+
+def _bloqueo_lote(id_lote: str):
+    # Fuera del directorio del lote, que se renombra al sellarlo.
+    return bloqueos.bloqueo(os.path.join(DIRECTORIO_STAGING, "bloqueos", f"{validar_id_lote(id_lote)}.lock"))
+
+
+def _directorio_entrantes(id_lote: str) -> str:
+    """Directorio propio de una subida en curso (en el mismo disco que los lotes)."""
+    directorio = os.path.join(DIRECTORIO_STAGING, "entrantes", f"{id_lote}-{uuid.uuid4().hex[:12]}")
+    os.makedirs(directorio)
+    return directorio
+
+
+def _leer_manifiesto(directorio: str) -> Dict[str, Any]:
+    ruta = os.path.join(directorio, NOMBRE_MANIFIESTO)
+    if not os.path.exists(ruta):
+        return {"indice": None, "archivos": {}}
+    with open(ruta, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _escribir_manifiesto(directorio: str, manifiesto: Dict[str, Any]):
+    ruta = os.path.join(directorio, NOMBRE_MANIFIESTO)
+    with open(ruta + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifiesto, f, ensure_ascii=False, indent=1)
+    os.replace(ruta + ".tmp", ruta)
+
+
+def _copiar_a_disco(origen: BinaryIO, ruta: str, max_bytes: Optional[int] = None,
+                    bytes_previos: int = 0) -> Dict[str, Any]:
+    """
+    Copia `origen` a `ruta` en bloques de TAM_BLOQUE_COPIA (calculando su
+    SHA-256 en el camino) y devuelve la entrada del manifiesto. Falla si
+    `bytes_previos` (lo ya extraído del mismo archivo comprimido) más lo
+    copiado supera `max_bytes`.
+    """
+    huella = hashlib.sha256()
+    total_bytes = 0
+    with open(ruta + ".part", "wb") as destino:
+        while True:
+            bloque = origen.read(TAM_BLOQUE_COPIA)
+            if not bloque:
+                break
+            total_bytes += len(bloque)
+            if max_bytes is not None and bytes_previos + total_bytes > max_bytes:
+                destino.close()
+                os.remove(ruta + ".part")
+                raise ValueError(
+                    f"El contenido extraído supera el máximo de {max_bytes:,} bytes.")
+            huella.update(bloque)
+            destino.write(bloque)
+    os.replace(ruta + ".part", ruta)
+    return {"archivo": os.path.basename(ruta), "bytes": total_bytes, "sha256": huella.hexdigest(),
+            "recibido": datetime.now(timezone.utc).isoformat(timespec="seconds")}
+
+
+def _registrar_en_manifiesto(manifiesto: Dict[str, Any], entrada: Dict[str, Any]):
+    # El índice se reconoce por su nombre, igual que antes.
+    if entrada["archivo"].lower() == NOMBRE_INDICE:
+        manifiesto["indice"] = entrada
+    else:
+        manifiesto["archivos"][entrada["archivo"]] = entrada
+
+
+def guardar_archivo(id_lote: str, filename: str, origen: BinaryIO) -> Dict[str, Any]:
+    """
+    Copia `origen` a disco fuera del lote y después, con el lote bloqueado,
+    lo mueve al lote y lo registra en el manifiesto. La copia (lo lento) no
+    frena a las otras subidas del mismo lote.
+    """
+    directorio = directorio_lote(id_lote)
+    nombre = _nombre_seguro(filename)
+    entrantes = _directorio_entrantes(id_lote)
+    try:
+        entrada = _copiar_a_disco(origen, os.path.join(entrantes, nombre))
+        with _bloqueo_lote(id_lote):
+            os.makedirs(directorio, exist_ok=True)
+            os.replace(os.path.join(entrantes, nombre), os.path.join(directorio, nombre))
+            manifiesto = _leer_manifiesto(directorio)
+            _registrar_en_manifiesto(manifiesto, entrada)
+            _escribir_manifiesto(directorio, manifiesto)
+    finally:
+        eliminar_directorio(entrantes)
+    return manifiesto
+
+
+# --- Lote completo en un archivo comprimido (zip, tar, tar.gz, tar.zst) ---
+def _ignorar_miembro(nombre: str) -> bool:
+    """Carpetas de metadatos de macOS y archivos ocultos que agregan los compresores."""
+    partes = nombre.replace("\\", "/").split("/")
+    return "__MACOSX" in partes or partes[-1].startswith(".")
+
+
+def _miembros_archivo(filename: str, origen: BinaryIO) -> Iterator[Tuple[str, BinaryIO]]:
+    """
+    Recorre los archivos regulares de un zip o un tar (sin comprimir, gz, bz2,
+    xz o zst) y entrega (nombre, contenido) de a uno, sin extraer nada a
+    memoria. El formato se reconoce por los primeros bytes, no por la extensión.
+    """
+    cabecera = origen.read(4)
+    origen.seek(0)
+    if not cabecera:
+        raise ValueError(f"El archivo '{filename}' está vacío.")
+    if cabecera == _MAGIA_ZIP:
+        try:
+            zip_lote = zipfile.ZipFile(origen)
+        except zipfile.BadZipFile as e_zip:
+            raise ValueError(f"'{filename}' no es un zip válido: {e_zip}")
+        with zip_lote:
+            for info in zip_lote.infolist():
+                if info.is_dir() or _ignorar_miembro(info.filename):
+                    continue
+                with zip_lote.open(info) as contenido:
+                    yield info.filename, contenido
+        return
+
+    if cabecera == _MAGIA_ZSTD:
+        if zstandard is None:
+            raise ValueError("Para subir archivos .tar.zst hay que instalar el paquete 'zstandard'.")
+        flujo, modo = zstandard.ZstdDecompressor().stream_reader(origen), "r|"
+    else:
+        flujo, modo = origen, "r|*"
+    try:
+        # Modo flujo ('r|'): el tar se lee una sola vez, de principio a fin.
+        with tarfile.open(fileobj=flujo, mode=modo) as tar_lote:
+            for miembro in tar_lote:
+                if not miembro.isfile() or _ignorar_miembro(miembro.name):
+                    continue
+                yield miembro.name, tar_lote.extractfile(miembro)
+    except tarfile.TarError as e_tar:
+        raise ValueError(f"'{filename}' no es un zip ni un tar válido: {e_tar}")
+
+
+def validar_contra_indice(ruta_indice: str, nombres_datos: List[str]) -> Dict[str, Any]:
+    """
+    Compara los archivos de datos de un lote con los que nombra el índice.
+    Devuelve los que el índice nombra y faltan, los que sobran (se leen sin
+    reglas) y las advertencias del índice.
+    """
+    with open(ruta_indice, "rb") as f:
+        contenido = f.read()
+    try:
+        reglas = reglas_indice.cargar_reglas_indice(contenido)
+    except Exception as e_indice:
+        raise ValueError(f"No se pudo leer '{NOMBRE_INDICE}': {e_indice}")
+    esperados = set(reglas.archivos())
+    presentes = {os.path.splitext(nombre)[0]: nombre for nombre in nombres_datos}
+    return {"faltantes": sorted(esperados - presentes.keys()),
+            "no_indexados": sorted(nombre for base, nombre in presentes.items() if base not in esperados),
+            "advertencias_indice": list(reglas.advertencias)}
+
+
+def guardar_archivo_comprimido(id_lote: str, filename: str, origen: BinaryIO,
+                               permitir_faltantes: bool = False) -> Dict[str, Any]:
+    """
+    Extrae un archivo comprimido con el índice y los libros de datos al lote
+    abierto `id_lote`. Los archivos se extraen primero a un directorio aparte
+    y solo pasan al lote si el conjunto es válido: tiene índice, tiene datos
+    y (salvo `permitir_faltantes`) trae todos los archivos que nombra el
+    índice. Si algo falla, el lote abierto queda como estaba.
+    Devuelve el manifiesto del lote y el resultado de la validación.
+    """
+    directorio = directorio_lote(id_lote)
+    entrantes = _directorio_entrantes(id_lote)
+    try:
+        extraidos: Dict[str, Dict[str, Any]] = {}
+        bytes_extraidos = 0
+        for nombre_miembro, contenido in _miembros_archivo(filename, origen):
+            nombre = _nombre_seguro(nombre_miembro)
+            if nombre in extraidos:
+                raise ValueError(f"El archivo '{nombre}' aparece más de una vez en '{filename}'.")
+            entrada = _copiar_a_disco(contenido, os.path.join(entrantes, nombre), MAX_BYTES_EXTRAIDOS,
+                                      bytes_extraidos)
+            bytes_extraidos += entrada["bytes"]
+            extraidos[nombre] = dict(entrada, archivo_comprimido=filename)
+        if not extraidos:
+            raise ValueError(f"El archivo '{filename}' no contiene archivos.")
+
+        with _bloqueo_lote(id_lote):
+            manifiesto = _leer_manifiesto(directorio)
+            for entrada in extraidos.values():
+                _registrar_en_manifiesto(manifiesto, entrada)
+            if not manifiesto["indice"]:
+                raise ValueError(f"Falta '{NOMBRE_INDICE}' en el archivo y en el lote '{id_lote}'.")
+            if not manifiesto["archivos"]:
+                raise ValueError("Faltan archivos de datos.")
+            indice = manifiesto["indice"]["archivo"]
+            validacion = validar_contra_indice(
+                os.path.join(entrantes if indice in extraidos else directorio, indice),
+                list(manifiesto["archivos"]))
+            if validacion["faltantes"] and not permitir_faltantes:
+                raise ValueError(f"Faltan archivos que nombra el índice: {validacion['faltantes']}")
+
+            os.makedirs(directorio, exist_ok=True)
+            for nombre in extraidos:
+                os.replace(os.path.join(entrantes, nombre), os.path.join(directorio, nombre))
+            _escribir_manifiesto(directorio, manifiesto)
+    finally:
+        eliminar_directorio(entrantes)
+    return {"manifiesto": manifiesto, "extraidos": list(extraidos), **validacion}
+
+
+def estado_lote(id_lote: str) -> Dict[str, Any]:
+    return _leer_manifiesto(directorio_lote(id_lote))
+
+
+def sellar_lote(id_lote: str, id_proceso: str) -> str:
+    """
+    Mueve el lote abierto a un directorio propio del procesamiento (un rename
+    atómico): las subidas siguientes con el mismo batch_id arman un lote nuevo.
+    Se hace con el lote bloqueado, así ninguna subida queda a medio registrar
+    y dos disparadores del mismo lote no lo sellan dos veces (el segundo ve el
+    lote vacío). El lote queda en sellados/<id_proceso>/, el proceso web que
+    encola su trabajo. Devuelve la ruta del lote sellado.
+    """
+    origen = directorio_lote(id_lote)
+    destino = os.path.join(_directorio_sellados(), id_proceso, f"{id_lote}-{uuid.uuid4().hex[:12]}")
+    with _bloqueo_lote(id_lote):
+        manifiesto = _leer_manifiesto(origen)
+        if not manifiesto["indice"]:
+            raise ValueError("Error: Falta 'indice.xlsx'.")
+        if not manifiesto["archivos"]:
+            raise ValueError("Error: Faltan archivos de datos.")
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.rename(origen, destino)
+    return destino
+
+
+def archivos_de_lote(directorio: str) -> Tuple[Optional[ArchivoEnStaging], List[ArchivoEnStaging]]:
+    """Devuelve (índice, archivos de datos) de un lote según su manifiesto."""
+    manifiesto = _leer_manifiesto(directorio)
+    indice = manifiesto.get("indice")
+    archivo_indice = (ArchivoEnStaging(indice["archivo"], os.path.join(directorio, indice["archivo"]))
+                      if indice else None)
+    archivos_datos = [ArchivoEnStaging(nombre, os.path.join(directorio, nombre))
+                      for nombre in manifiesto["archivos"]]
+    return archivo_indice, archivos_datos
+
+
+def eliminar_directorio(directorio: str):
+    shutil.rmtree(directorio, ignore_errors=True)
+
+
+def eliminar_sellados_huerfanos(proceso_vivo: Callable[[str], bool]) -> int:
+    """
+    Borra los lotes sellados de procesos web que ya no existen: sus trabajos
+    se cortaron (caída o reinicio) y nadie va a borrarlos al terminar.
+    Devuelve cuántos directorios de proceso se borraron.
+    """
+    if not os.path.isdir(_directorio_sellados()):
+        return 0
+    huerfanos = [id_proceso for id_proceso in os.listdir(_directorio_sellados())
+                 if not proceso_vivo(id_proceso)]
+    for id_proceso in huerfanos:
+        eliminar_directorio(os.path.join(_directorio_sellados(), id_proceso))
+    return len(huerfanos)
+
+
+def eliminar_lotes_abiertos(id_lote: Optional[str] = None):
+    """Borra un lote abierto o, sin `id_lote`, todos los lotes abiertos."""
+    if id_lote:
+        ids_lote = [id_lote]
+    elif os.path.isdir(_directorio_lotes_abiertos()):
+        ids_lote = os.listdir(_directorio_lotes_abiertos())
+    else:
+        ids_lote = []
+    for id_lote_abierto in ids_lote:
+        with _bloqueo_lote(id_lote_abierto):
+            eliminar_directorio(directorio_lote(id_lote_abierto))
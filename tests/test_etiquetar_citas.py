@@ -0,0 +1,77 @@
+"""
+Regresión de Etiqueta_Cita_Paciente: `procesador_datos.etiquetar_citas`
+(REGLAS_ETIQUETA_CITA con np.select) debe dar las mismas etiquetas que la
+implementación anterior con asignaciones `.loc`, que se conserva en
+benchmarks/bench_etiquetas_citas.py.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import procesador_datos
+from benchmarks.bench_etiquetas_citas import _etiquetar_con_loc, generar_citas
+
+HOY = pd.Timestamp('2024-03-15')
+NAT = pd.NaT
+T = pd.Timestamp
+
+
+def _comparar(citas: pd.DataFrame, hoy: pd.Timestamp = HOY):
+    esperadas = _etiquetar_con_loc(citas, hoy)
+    obtenidas = procesador_datos.etiquetar_citas(
+        citas['Fecha_Cita'], citas['Fecha_Primera_Cita_Atendida_Real'], citas['Cita_asistida'], hoy)
+    pd.testing.assert_series_equal(
+        esperadas, pd.Series(obtenidas, index=citas.index).astype(object), check_names=False)
+    return esperadas
+
+
+# (Fecha_Cita, Fecha_Primera_Cita_Atendida_Real, Cita_asistida, etiqueta esperada)
+CASOS_BORDE = [
+    # Nulos.
+    (NAT, NAT, 1, 'Indeterminada'),
+    (NAT, T('2024-01-10'), 1, 'Indeterminada'),
+    (T('2024-01-10'), NAT, 1, 'Paciente Nuevo Atendido'),
+    (T('2024-04-01'), NAT, 0, 'Paciente Nuevo en Agenda'),
+    (T('2024-01-10'), NAT, np.nan, 'Paciente Nuevo No Atendido'),
+    # Empates: la cita de debut es "nueva", no recurrente.
+    (T('2024-01-10'), T('2024-01-10'), 1, 'Paciente Nuevo Atendido'),
+    (T('2024-01-10'), T('2024-01-10'), 0, 'Paciente Nuevo No Atendido'),
+    (T('2024-01-09'), T('2024-01-10'), 1, 'Paciente Nuevo Atendido'),
+    # Fecha de referencia: la cita de hoy cuenta como agenda.
+    (HOY, NAT, 1, 'Paciente Nuevo en Agenda'),
+    (HOY - pd.Timedelta(1, 'ns'), NAT, 1, 'Paciente Nuevo Atendido'),
+    (HOY, T('2024-01-10'), 1, 'Paciente Recurrente en Agenda'),
+    (HOY - pd.Timedelta(1, 'ns'), T('2024-01-10'), 0, 'Paciente Recurrente No Atendido'),
+    # Límites de mes y de año entre el debut y la cita.
+    (T('2024-01-31 23:59'), T('2024-01-01'), 1, 'Paciente Atendido Mismo Mes que Debutó'),
+    (T('2024-02-01'), T('2024-01-31 23:59'), 1, 'Paciente Recurrente Atendido'),
+    (T('2024-01-01'), T('2023-12-31'), 0, 'Paciente Recurrente No Atendido'),
+    (T('2024-03-20'), T('2024-03-01'), 0, 'Paciente No Atendido Mismo Mes que Debutó'),
+    (T('2024-03-20'), T('2024-03-01'), 2, 'Paciente No Atendido Mismo Mes que Debutó'),
+]
+
+
+def test_casos_borde_iguales_a_la_implementacion_loc():
+    citas = pd.DataFrame(CASOS_BORDE, columns=[
+        'Fecha_Cita', 'Fecha_Primera_Cita_Atendida_Real', 'Cita_asistida', 'esperada'])
+    etiquetas = _comparar(citas.drop(columns='esperada'))
+    assert etiquetas.tolist() == citas['esperada'].tolist()
+
+
+@pytest.mark.parametrize('semilla', [0, 1, 2])
+def test_citas_sinteticas_iguales_a_la_implementacion_loc(semilla):
+    _comparar(generar_citas(20_000, HOY, semilla))
+
+
+def test_tabla_vacia():
+    citas = pd.DataFrame({'Fecha_Cita': pd.Series(dtype='datetime64[ns]'),
+                          'Fecha_Primera_Cita_Atendida_Real': pd.Series(dtype='datetime64[ns]'),
+                          'Cita_asistida': pd.Series(dtype='int64')})
+    assert len(_comparar(citas)) == 0
+
+
+def test_categorias_en_orden_de_reglas():
+    etiquetas = procesador_datos.etiquetar_citas(
+        pd.Series([NAT]), pd.Series([NAT]), pd.Series([1]), HOY)
+    assert list(etiquetas.categories) == [
+        etiqueta for etiqueta, _, _ in procesador_datos.REGLAS_ETIQUETA_CITA] + ['Indeterminada']
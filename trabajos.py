@@ -0,0 +1,205 @@
+import json
+import os
+import sqlite3
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional
+
+import bloqueos
+
+# --- Almacén local de trabajos (sobrevive a reinicios del servidor) ---
+RUTA_DB_TRABAJOS = os.environ.get("SHERLOCK_TRABAJOS_DB", "sherlock_trabajos.db")
+# Identifica a este proceso web en los trabajos que encola. Mientras vive,
+# tiene tomado el bloqueo <db>.procesos/<id>.lock: así otro worker que arranca
+# sabe qué trabajos activos siguen teniendo quien los ejecute.
+ID_PROCESO = uuid.uuid4().hex
+_bloqueo_proceso: Optional[BinaryIO] = None
+
+ESTADO_EN_COLA = "en_cola"
+ESTADO_EN_PROCESO = "en_proceso"
+ESTADO_COMPLETADO = "completado"
+ESTADO_FALLIDO = "fallido"
+ESTADO_INTERRUMPIDO = "interrumpido"
+ESTADOS_ACTIVOS = (ESTADO_EN_COLA, ESTADO_EN_PROCESO)
+
+
+def _ahora() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+@contextmanager
+def _conectar() -> Iterator[sqlite3.Connection]:
+    """Conexión al almacén: al salir del `with` confirma (o revierte) y la cierra."""
+    conexion = sqlite3.connect(RUTA_DB_TRABAJOS, timeout=30)
+    conexion.row_factory = sqlite3.Row
+    try:
+        with conexion:
+            yield conexion
+    finally:
+        conexion.close()
+
+
+def _ruta_bloqueo_proceso(id_proceso: str) -> str:
+    return os.path.join(f"{RUTA_DB_TRABAJOS}.procesos", f"{id_proceso}.lock")
+
+
+def proceso_vivo(id_proceso: Optional[str]) -> bool:
+    """True si el proceso web `id_proceso` (este u otro worker) sigue vivo."""
+    return bool(id_proceso) and (
+        id_proceso == ID_PROCESO or bloqueos.esta_bloqueado(_ruta_bloqueo_proceso(id_proceso)))
+
+
+def inicializar():
+    """Crea la tabla de trabajos si no existe y registra este proceso como vivo."""
+    global _bloqueo_proceso
+    if _bloqueo_proceso is None:
+        _bloqueo_proceso = bloqueos.tomar_bloqueo(_ruta_bloqueo_proceso(ID_PROCESO))
+    with _conectar() as conexion:
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS trabajos (
+                id TEXT PRIMARY KEY,
+                estado TEXT NOT NULL,
+                creado TEXT NOT NULL,
+                iniciado TEXT,
+                terminado TEXT,
+                etapas TEXT NOT NULL DEFAULT '[]',
+                filas TEXT NOT NULL DEFAULT '{}',
+                advertencias TEXT NOT NULL DEFAULT '[]',
+                error TEXT,
+                proceso TEXT
+            )""")
+        columnas = {fila["name"] for fila in conexion.execute("PRAGMA table_info(trabajos)")}
+        if "proceso" not in columnas:  # Base creada antes de que hubiera varios workers.
+            conexion.execute("ALTER TABLE trabajos ADD COLUMN proceso TEXT")
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS generacion_carga (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                generacion INTEGER NOT NULL
+            )""")
+
+
+def crear_trabajo() -> str:
+    id_trabajo = uuid.uuid4().hex
+    with _conectar() as conexion:
+        conexion.execute(
+            "INSERT INTO trabajos (id, estado, creado, proceso) VALUES (?, ?, ?, ?)",
+            (id_trabajo, ESTADO_EN_COLA, _ahora(), ID_PROCESO))
+    return id_trabajo
+
+
+def marcar_en_proceso(id_trabajo: str):
+    with _conectar() as conexion:
+        conexion.execute("UPDATE trabajos SET estado = ?, iniciado = ? WHERE id = ?",
+                         (ESTADO_EN_PROCESO, _ahora(), id_trabajo))
+
+
+def finalizar_trabajo(id_trabajo: str, estado: str, advertencias: Optional[List[str]] = None,
+                      error: Optional[str] = None):
+    with _conectar() as conexion:
+        conexion.execute(
+            "UPDATE trabajos SET estado = ?, terminado = ?, advertencias = ?, error = ? WHERE id = ?",
+            (estado, _ahora(), json.dumps(advertencias or [], ensure_ascii=False), error, id_trabajo))
+
+
+def registrar_etapa(id_trabajo: Optional[str], nombre: str, segundos: float,
+                    filas: Optional[int] = None, tabla: Optional[str] = None,
+                    rss_pico_mb: Optional[float] = None):
+    """
+    Agrega una etapa (nombre, duración, filas y memoria pico) al trabajo. Si
+    se indica `tabla`, también guarda sus filas en el resumen de filas por tabla.
+    """
+    if id_trabajo is None:
+        return
+    with _conectar() as conexion:
+        fila = conexion.execute(
+            "SELECT etapas, filas FROM trabajos WHERE id = ?", (id_trabajo,)).fetchone()
+        if fila is None:
+            return
+        etapas = json.loads(fila["etapas"])
+        etapa = {"etapa": nombre, "segundos": round(segundos, 3), "filas": filas}
+        if rss_pico_mb is not None:
+            etapa["rss_pico_mb"] = rss_pico_mb
+        etapas.append(etapa)
+        filas_por_tabla = json.loads(fila["filas"])
+        if tabla is not None and filas is not None:
+            filas_por_tabla[tabla] = filas
+        conexion.execute("UPDATE trabajos SET etapas = ?, filas = ? WHERE id = ?",
+                         (json.dumps(etapas), json.dumps(filas_por_tabla), id_trabajo))
+
+
+def obtener_trabajo(id_trabajo: str) -> Optional[Dict[str, Any]]:
+    with _conectar() as conexion:
+        fila = conexion.execute(
+            "SELECT * FROM trabajos WHERE id = ?", (id_trabajo,)).fetchone()
+    if fila is None:
+        return None
+    trabajo = dict(fila)
+    for campo in ("etapas", "filas", "advertencias"):
+        trabajo[campo] = json.loads(trabajo[campo])
+    return trabajo
+
+
+def contar_por_estado() -> Dict[str, int]:
+    with _conectar() as conexion:
+        filas = conexion.execute("SELECT estado, COUNT(*) FROM trabajos GROUP BY estado").fetchall()
+    return {estado: n for estado, n in filas}
+
+
+def ultimo_trabajo_terminado() -> Optional[Dict[str, Any]]:
+    with _conectar() as conexion:
+        fila = conexion.execute(
+            "SELECT id FROM trabajos WHERE terminado IS NOT NULL AND estado IN (?, ?) "
+            "ORDER BY terminado DESC LIMIT 1", (ESTADO_COMPLETADO, ESTADO_FALLIDO)).fetchone()
+    return obtener_trabajo(fila["id"]) if fila else None
+
+
+def marcar_interrumpidos() -> int:
+    """
+    Al arrancar el servidor, los trabajos que quedaron en cola o en proceso
+    ya no tienen quien los ejecute: se marcan como interrumpidos en vez de
+    perderse en silencio. Con varios workers solo se marcan los del proceso
+    que murió; los que encoló un worker vivo siguen su curso.
+    """
+    with _conectar() as conexion:
+        activos = conexion.execute(
+            "SELECT id, proceso FROM trabajos WHERE estado IN (?, ?)", ESTADOS_ACTIVOS).fetchall()
+        huerfanos = [fila["id"] for fila in activos if not proceso_vivo(fila["proceso"])]
+        for id_trabajo in huerfanos:
+            conexion.execute(
+                "UPDATE trabajos SET estado = ?, terminado = ?, error = ? WHERE id = ? AND estado IN (?, ?)",
+                (ESTADO_INTERRUMPIDO, _ahora(), "El servidor se reinició durante el trabajo.",
+                 id_trabajo, *ESTADOS_ACTIVOS))
+    for proceso in {fila["proceso"] for fila in activos if fila["id"] in huerfanos and fila["proceso"]}:
+        try:
+            os.remove(_ruta_bloqueo_proceso(proceso))
+        except OSError:
+            pass
+    return len(huerfanos)
+
+
+def turno_de_ejecucion():
+    """
+    Bloqueo que toma cada trabajo mientras corre: aunque cada worker web tenga
+    su propio proceso trabajador, en la máquina se procesa un lote a la vez
+    (dos cargas a la vez reemplazarían las mismas tablas).
+    """
+    return bloqueos.bloqueo(f"{RUTA_DB_TRABAJOS}.ejecucion.lock")
+
+
+# --- Generación de carga: cambia cada vez que el ETL escribe una tabla ---
+# La usa la caché de /execute_sql_query/ (en el proceso web) para saber que
+# los datos cambiaron en el proceso trabajador.
+def incrementar_generacion_carga() -> int:
+    with _conectar() as conexion:
+        conexion.execute("""
+            INSERT INTO generacion_carga (id, generacion) VALUES (1, 1)
+            ON CONFLICT (id) DO UPDATE SET generacion = generacion + 1""")
+        return conexion.execute("SELECT generacion FROM generacion_carga WHERE id = 1").fetchone()[0]
+
+
+def generacion_carga() -> int:
+    with _conectar() as conexion:
+        fila = conexion.execute("SELECT generacion FROM generacion_carga WHERE id = 1").fetchone()
+    return fila[0] if fila else 0